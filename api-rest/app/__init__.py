@@ -9,11 +9,24 @@ load_dotenv()
 db = SQLAlchemy()
 migrate = Migrate()
 
+def _in_memory_sqlite(uri):
+    # an in-memory database is a single shared connection; pool sizes don't apply
+    return uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in uri
+
+
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///data.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    from .config import Config
+    app.config['MAX_CONTENT_LENGTH'] = Config.MAX_REQUEST_BYTES
+    if not _in_memory_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': Config.DB_POOL_SIZE,
+            'max_overflow': Config.DB_MAX_OVERFLOW,
+            'pool_timeout': Config.DB_POOL_TIMEOUT,
+        }
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -21,5 +34,45 @@ def create_app():
     # register blueprints / routes
     from .routes import bp as routes_bp
     app.register_blueprint(routes_bp)
+    from .metrics import init_app as init_metrics
+    init_metrics(app)
+    from .profiling import init_app as init_profiling
+    init_profiling(app)
+
+    from .friendships import cli as friendships_cli
+    app.cli.add_command(friendships_cli)
+    from .vector_index import cli as vectors_cli
+    app.cli.add_command(vectors_cli)
+    # registers the multiplayer job handlers
+    from . import games  # noqa: F401
+    from .jobs import cli as jobs_cli
+    app.cli.add_command(jobs_cli)
+    # also registers the sweep_game_state job
+    from .sweeper import cli as sweeper_cli
+    app.cli.add_command(sweeper_cli)
+    from .history import cli as history_cli
+    app.cli.add_command(history_cli)
 
     return app
+
+
+def start_background(app):
+    """Start this process's background work: job workers, matchmaking and the periodic maintenance jobs.
+
+    Every entry point that serves requests calls this once per process (wsgi.py, so gunicorn
+    workers and WSGI hosts; run.py for the development server). create_app() does not, so
+    `flask` commands, scripts and benchmarks run jobs only when they ask to.
+    """
+    from . import history, jobs, matchmaking, sweeper
+    # results, timeouts and stats; JOB_WORKER_THREADS=0 leaves them to `flask jobs work`
+    jobs.start_workers(app)
+    # from the start, so tickets queued before a restart still get matched
+    matchmaking.service.start(app)
+    # every process asks; the dedupe key keeps one job per interval
+    try:
+        with app.app_context():
+            sweeper.schedule()
+            history.schedule()
+            db.session.commit()
+    except Exception:
+        app.logger.exception('failed scheduling the maintenance jobs')
@@ -1,12 +1,31 @@
 import os
 import json
+import time
+import hashlib
+import logging
+import threading
 from functools import wraps
 from flask import request, jsonify, g
 from firebase_admin import auth as firebase_auth, credentials, initialize_app
+from firebase_admin import db as firebase_db
+from firebase_admin import _token_gen
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import metrics
+from .cache import TTLCache
 from .config import Config
 
+# warm-up and the certificate refresher run outside any app context (post_worker_init, a daemon
+# thread), so they log here; records propagate to the Flask app's 'app' logger and the root
+log = logging.getLogger(__name__)
+
 firebase_app = None
 
+# process-wide caches keyed by a digest of the raw token (never the token itself)
+_verified_tokens = TTLCache(maxsize=Config.AUTH_TOKEN_CACHE_SIZE)
+_rejected_tokens = TTLCache(maxsize=Config.AUTH_TOKEN_CACHE_SIZE, ttl=Config.AUTH_NEGATIVE_CACHE_SECONDS)
+_cert_refresher = None
+
 def init_firebase():
     global firebase_app
     if firebase_app is not None:
@@ -19,10 +38,11 @@ def init_firebase():
         else:
             cred = credentials.ApplicationDefault()
 
+        options = {'httpTimeout': Config.FIREBASE_HTTP_TIMEOUT}
         # Prefer explicit DB URL from config if provided (handles regional DBs)
         db_url = getattr(Config, 'FIREBASE_DB_URL', None)
         if db_url:
-            firebase_app = initialize_app(cred, {'databaseURL': db_url})
+            firebase_app = initialize_app(cred, dict(options, databaseURL=db_url))
         else:
             # Try to derive Realtime Database URL from service account project_id
             # (fallback; may be incorrect for regional RTDB instances)
@@ -38,11 +58,97 @@ def init_firebase():
 
             if project_id:
                 database_url = f'https://{project_id}.firebaseio.com'
-                firebase_app = initialize_app(cred, {'databaseURL': database_url})
+                firebase_app = initialize_app(cred, dict(options, databaseURL=database_url))
             else:
-                firebase_app = initialize_app(cred)
-    except Exception as e:
-        print(f"Error initializing Firebase auth: {e}")
+                firebase_app = initialize_app(cred, options)
+        _configure_transport(firebase_app)
+    except Exception:
+        log.exception('failed initializing Firebase auth')
+        return
+    start_cert_refresher()
+
+
+def _pooled_adapter():
+    # read and status retries keep urllib3's idempotent-method default: a retried POST
+    # (RTDB push, user creation) could apply twice; connect errors are safe to retry for any method
+    retries = Retry(
+        connect=Config.FIREBASE_HTTP_RETRIES, read=1, status=Config.FIREBASE_HTTP_RETRIES,
+        status_forcelist=[500, 502, 503, 504], backoff_factor=0.3, raise_on_status=False)
+    return HTTPAdapter(pool_connections=2, pool_maxsize=Config.FIREBASE_HTTP_POOL_SIZE, max_retries=retries)
+
+
+def _configure_transport(app):
+    # replace the default adapters (pool of 10, one retry) on the auth and RTDB sessions
+    sessions = [firebase_auth._get_client(app)._user_manager.http_client.session]
+    if app.options.get('databaseURL'):
+        sessions.append(firebase_db.reference(app=app)._client.session)
+    for session in sessions:
+        adapter = _pooled_adapter()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+
+def warm_up():
+    """Initialize Firebase and fetch an access token before the worker takes traffic."""
+    init_firebase()
+    if firebase_app is None:
+        return
+    try:
+        firebase_app.credential.get_access_token()
+    except Exception:
+        log.exception('failed warming up Firebase credentials')
+
+
+def _refresh_certificates():
+    # bypass the HTTP cache so the verifier's cached copy is replaced before it expires
+    verifier = firebase_auth._get_client(firebase_app)._token_verifier
+    verifier.request(_token_gen.ID_TOKEN_CERT_URI, headers={'Cache-Control': 'no-cache'})
+
+
+def start_cert_refresher():
+    """Keep Google's token-signing certificates warm in a daemon thread."""
+    global _cert_refresher
+    interval = Config.AUTH_CERT_REFRESH_SECONDS
+    if firebase_app is None or interval <= 0:
+        return
+    if _cert_refresher is not None and _cert_refresher.is_alive():
+        return
+
+    def run():
+        while True:
+            try:
+                _refresh_certificates()
+            except Exception:
+                log.exception('failed refreshing Firebase certificates')
+            time.sleep(interval)
+
+    _cert_refresher = threading.Thread(target=run, name='firebase-cert-refresh', daemon=True)
+    _cert_refresher.start()
+
+
+def verify_token(token):
+    """Verify a Firebase ID token, serving repeat tokens from the process cache."""
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    decoded = _verified_tokens.get(key)
+    if decoded is not None:
+        return decoded
+    rejected = _rejected_tokens.get(key)
+    if rejected is not None:
+        raise ValueError(rejected)
+
+    init_firebase()
+    try:
+        with metrics.firebase_call('verify_id_token'):
+            decoded = firebase_auth.verify_id_token(token)
+    except firebase_auth.InvalidIdTokenError as e:
+        # only cache definitive rejections; transport errors must be retried
+        _rejected_tokens.set(key, str(e))
+        raise
+    ttl = decoded.get('exp', 0) - time.time()
+    if ttl > 0:
+        _verified_tokens.set(key, decoded, ttl=ttl)
+    return decoded
+
 
 def requires_auth(func):
     @wraps(func)
@@ -60,9 +166,7 @@ def requires_auth(func):
             return jsonify({'error': 'Invalid Authorization header'}), 401
         token = parts[1]
         try:
-            init_firebase()
-            decoded = firebase_auth.verify_id_token(token)
-            g.user = decoded
+            g.user = verify_token(token)
         except Exception as e:
             return jsonify({'error': 'Invalid token', 'details': str(e)}), 401
         return func(*args, **kwargs)
@@ -0,0 +1,162 @@
+"""Content-addressed storage for uploaded reference images.
+
+Each upload is stored once under the SHA-256 of its bytes, next to the
+downscaled variants generated on ingest:
+
+  images/<sha256>/original.<ext>   the uploaded bytes
+  images/<sha256>/score.png        224x224 RGB, the scoring model's input
+  images/<sha256>/preview.jpg      longest side Config.IMAGE_PREVIEW_SIZE
+
+Blobs never change once written, so they are served with a strong ETag,
+`Cache-Control: immutable` and range support. Files go to
+Config.BLOB_DIR by default, or to Config.GCS_BUCKET when it is set.
+"""
+import hashlib
+import io
+import os
+import re
+import tempfile
+from flask import current_app, request, send_file
+from werkzeug.wsgi import wrap_file
+from .config import Config
+
+ORIGINAL_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+VARIANTS = ('score.png', 'preview.jpg') + tuple(f'original.{ext}' for ext in ORIGINAL_FORMATS.values())
+MIMETYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+ONE_YEAR = 365 * 24 * 3600
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+def is_digest(value):
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
+
+
+def key_for(digest, variant):
+    return f'images/{digest}/{variant}'
+
+
+def mimetype_for(variant):
+    return MIMETYPES[variant.rsplit('.', 1)[1]]
+
+
+class LocalBlobStore:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data, content_type):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so a concurrent reader never serves a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def read(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def send(self, key, mimetype, etag):
+        return send_file(self._path(key), mimetype=mimetype, etag=etag, max_age=ONE_YEAR, conditional=True)
+
+
+class GCSBlobStore:
+    def __init__(self, bucket_name):
+        from firebase_admin import storage
+        from .auth import init_firebase
+        init_firebase()
+        self.bucket = storage.bucket(bucket_name)
+
+    def exists(self, key):
+        return self.bucket.blob(key).exists()
+
+    def put(self, key, data, content_type):
+        blob = self.bucket.blob(key)
+        blob.cache_control = f'public, max-age={ONE_YEAR}, immutable'
+        blob.upload_from_string(data, content_type=content_type)
+
+    def read(self, key):
+        return self.bucket.blob(key).download_as_bytes()
+
+    def send(self, key, mimetype, etag):
+        # streamed in chunks rather than downloaded whole; ranges seek in the blob
+        blob = self.bucket.get_blob(key)
+        resp = current_app.response_class(wrap_file(request.environ, blob.open('rb', chunk_size=256 * 1024)),
+                                          mimetype=mimetype, direct_passthrough=True)
+        resp.content_length = blob.size
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ONE_YEAR
+        return resp.make_conditional(request.environ, accept_ranges=True, complete_length=blob.size)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = GCSBlobStore(Config.GCS_BUCKET) if Config.GCS_BUCKET else LocalBlobStore(Config.BLOB_DIR)
+    return _store
+
+
+def original_name(image_bytes):
+    """Variant name for the upload itself; only the image header is read."""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        ext = ORIGINAL_FORMATS.get(img.format)
+    if ext is None:
+        raise ValueError('unsupported image format; use JPEG, PNG or WEBP')
+    return f'original.{ext}'
+
+
+def make_variants(image_bytes):
+    """Decode an upload and build its downscaled variants as {variant: bytes}."""
+    from PIL import Image, ImageOps
+    from .scoring import INPUT_SIZE
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+    out = {}
+    buf = io.BytesIO()
+    img.resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR).save(buf, format='PNG')
+    out['score.png'] = buf.getvalue()
+
+    img.thumbnail((Config.IMAGE_PREVIEW_SIZE, Config.IMAGE_PREVIEW_SIZE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=85, optimize=True, progressive=True)
+    out['preview.jpg'] = buf.getvalue()
+    return out
+
+
+def ingest(image_bytes):
+    """Store an upload and its variants. Returns (digest, {'original'|'score'|'preview': variant}, created).
+
+    Raises ValueError for anything that is not a supported image, including decompression bombs.
+    """
+    from PIL import Image
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        names = {'original': original_name(image_bytes), 'score': 'score.png', 'preview': 'preview.jpg'}
+        store = get_store()
+        # the original is written last, so its presence means the variants are complete
+        if store.exists(key_for(digest, names['original'])):
+            return digest, names, False
+        variants = make_variants(image_bytes)
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e))
+    for variant, data in variants.items():
+        store.put(key_for(digest, variant), data, mimetype_for(variant))
+    store.put(key_for(digest, names['original']), image_bytes, mimetype_for(names['original']))
+    return digest, names, True
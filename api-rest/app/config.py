@@ -7,3 +7,118 @@ class Config:
     FIREBASE_DB_URL = os.getenv('FIREBASE_DB_URL')
     GCS_BUCKET = os.getenv('GCS_BUCKET')
     AUTH_SKIP = os.getenv('AUTH_SKIP', '0') in ('1', 'true', 'True')
+    # verified ID tokens are cached per process until their own `exp`
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000'))
+    # rejected tokens are remembered briefly so retries don't re-run verification
+    AUTH_NEGATIVE_CACHE_SECONDS = float(os.getenv('AUTH_NEGATIVE_CACHE_SECONDS', '30'))
+    # how often Google's signing certificates are re-fetched in the background (0 disables)
+    AUTH_CERT_REFRESH_SECONDS = float(os.getenv('AUTH_CERT_REFRESH_SECONDS', '3600'))
+    # user directory rows older than this are refreshed from Firebase in the background
+    DIRECTORY_TTL_SECONDS = int(os.getenv('DIRECTORY_TTL_SECONDS', '86400'))
+    # leaderboard pages are served from an in-process cache for this many seconds
+    LEADERBOARD_CACHE_SECONDS = float(os.getenv('LEADERBOARD_CACHE_SECONDS', '10'))
+    # maximum number of results accepted by one POST /games/batch
+    GAMES_BATCH_MAX = int(os.getenv('GAMES_BATCH_MAX', '500'))
+    # gunicorn worker class (gunicorn.conf.py): gthread, or gevent to keep many more
+    # requests waiting on Firebase and the database per worker
+    WORKER_CLASS = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+    # SQLAlchemy connection pool per worker; a request holds its connection until it ends, so gevent
+    # workers need room for every request that touches the database while it also waits on Firebase
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20' if WORKER_CLASS == 'gevent' else '5'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '30' if WORKER_CLASS == 'gevent' else '10'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+    # Firebase Admin HTTP transport: one keep-alive pool per worker, sized to its thread count
+    # (gevent workers have no fixed thread count; size the pool for the expected in-flight requests)
+    FIREBASE_HTTP_POOL_SIZE = int(os.getenv('FIREBASE_HTTP_POOL_SIZE',
+                                            '100' if WORKER_CLASS == 'gevent' else os.getenv('GUNICORN_THREADS', '4')))
+    FIREBASE_HTTP_TIMEOUT = float(os.getenv('FIREBASE_HTTP_TIMEOUT', '10'))
+    FIREBASE_HTTP_RETRIES = int(os.getenv('FIREBASE_HTTP_RETRIES', '2'))
+    # server-side scoring: path to mobilenet_v3_small.tflite (the same model the Android app ships); unset disables it
+    SCORING_MODEL_PATH = os.getenv('SCORING_MODEL_PATH')
+    SCORING_MAX_BATCH = int(os.getenv('SCORING_MAX_BATCH', '16'))
+    SCORING_MAX_WAIT_MS = float(os.getenv('SCORING_MAX_WAIT_MS', '5'))
+    SCORING_THREADS = int(os.getenv('SCORING_THREADS')) if os.getenv('SCORING_THREADS') else None
+    SCORING_TIMEOUT = float(os.getenv('SCORING_TIMEOUT', '10'))
+    SCORING_FETCH_TIMEOUT = float(os.getenv('SCORING_FETCH_TIMEOUT', '10'))
+    SCORING_MAX_IMAGE_BYTES = int(os.getenv('SCORING_MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+    # hosts set_reference may download an imageUrl from (https only); empty allows no downloads
+    SCORING_FETCH_HOSTS = [h.strip().lower() for h in os.getenv(
+        'SCORING_FETCH_HOSTS', 'firebasestorage.googleapis.com,storage.googleapis.com').split(',') if h.strip()]
+    # reference-image embeddings: in-memory LRU written through to this directory ('' keeps them in memory only)
+    EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', 'instance/embeddings')
+    EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '1024'))
+    EMBEDDING_GAME_TTL_SECONDS = float(os.getenv('EMBEDDING_GAME_TTL_SECONDS', '3600'))
+    # uploaded reference images (app/blobstore.py): stored under BLOB_DIR unless GCS_BUCKET is set
+    BLOB_DIR = os.getenv('BLOB_DIR', 'instance/blobs')
+    IMAGE_UPLOAD_MAX_BYTES = int(os.getenv('IMAGE_UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+    # any request body above this is refused with 413 before it is read; it must fit an upload
+    # and a base64 drawing in submit
+    MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(16 * 1024 * 1024)))
+    IMAGE_PREVIEW_SIZE = int(os.getenv('IMAGE_PREVIEW_SIZE', '1080'))
+    # nearest-neighbour index over server-computed embeddings ('' disables it)
+    VECTOR_INDEX_DIR = os.getenv('VECTOR_INDEX_DIR', 'instance/vectors')
+    VECTOR_INDEX_NPROBE = int(os.getenv('VECTOR_INDEX_NPROBE', '16'))
+    NEAR_DUPLICATE_SIMILARITY = float(os.getenv('NEAR_DUPLICATE_SIMILARITY', '0.97'))
+    # games history (app/history.py): raw games are kept this many days, then rolled up into one row
+    # per player and day; MySQL partitions are created this many months ahead
+    HISTORY_RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', '90'))
+    HISTORY_PARTITIONS_AHEAD = int(os.getenv('HISTORY_PARTITIONS_AHEAD', '3'))
+    HISTORY_ROLLUP_BATCH = int(os.getenv('HISTORY_ROLLUP_BATCH', '5000'))
+    # the history_maintenance job (roll-ups, partitions) runs this often (0 = only `flask history`)
+    HISTORY_INTERVAL_SECONDS = float(os.getenv('HISTORY_INTERVAL_SECONDS', '3600'))
+    # background jobs (app/jobs.py): worker threads per gunicorn worker (0 = run `flask jobs work` separately)
+    JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', '2'))
+    JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '1'))
+    JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '300'))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+    # done and failed jobs are deleted this long after they finish; their dedupe keys only matter while
+    # the game they belong to can still be played, so keep this well above SWEEP_ABANDONED_GAME_SECONDS
+    JOB_RETENTION_SECONDS = float(os.getenv('JOB_RETENTION_SECONDS', str(7 * 86400)))
+    JOB_PURGE_BATCH = int(os.getenv('JOB_PURGE_BATCH', '1000'))
+    # a multiplayer game is finished this long after its reference image is set, submitted or not
+    GAME_SUBMIT_TIMEOUT_SECONDS = int(os.getenv('GAME_SUBMIT_TIMEOUT_SECONDS', '90'))
+    # Prometheus metrics at GET /metrics (app/metrics.py); scrapers must send METRICS_TOKEN as a
+    # bearer token, and without one set the endpoint answers 403
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') in ('1', 'true', 'True')
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # per-request sampling profiler (app/profiling.py): profile this fraction of requests, plus any
+    # request sending `X-Profile-Token: <PROFILE_TOKEN>`; the token also guards GET /debug/profiles
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+    PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+    PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+    PROFILE_DIR = os.getenv('PROFILE_DIR', 'instance/profiles')
+    PROFILE_MAX_TRACES = int(os.getenv('PROFILE_MAX_TRACES', '200'))
+    # players allowed in a room created with POST /multiplayer/room
+    ROOM_MAX_PLAYERS = int(os.getenv('ROOM_MAX_PLAYERS', '8'))
+    # multiplayer game/invite state (app/gamestate.py): firebase, sql or memory
+    GAME_STATE_BACKEND = os.getenv('GAME_STATE_BACKEND', 'firebase')
+    # random-opponent matchmaking (app/matchmaking.py): skill is the recent average score (0-100).
+    # A waiting player accepts opponents within BASE_GAP points, widening by GAP_PER_SECOND up to MAX_GAP
+    MATCHMAKING_DEFAULT_SKILL = float(os.getenv('MATCHMAKING_DEFAULT_SKILL', '50'))
+    MATCHMAKING_BASE_GAP = float(os.getenv('MATCHMAKING_BASE_GAP', '5'))
+    MATCHMAKING_GAP_PER_SECOND = float(os.getenv('MATCHMAKING_GAP_PER_SECOND', '2'))
+    MATCHMAKING_MAX_GAP = float(os.getenv('MATCHMAKING_MAX_GAP', '100'))
+    MATCHMAKING_MAX_WAIT_SECONDS = float(os.getenv('MATCHMAKING_MAX_WAIT_SECONDS', '120'))
+    MATCHMAKING_POLL_SECONDS = float(os.getenv('MATCHMAKING_POLL_SECONDS', '0.2'))
+    # game state garbage collection (app/sweeper.py): finished games stay this long for clients showing
+    # results, then are archived to SQL and deleted; games with no activity for ABANDONED_GAME are too
+    SWEEP_FINISHED_GAME_SECONDS = float(os.getenv('SWEEP_FINISHED_GAME_SECONDS', '3600'))
+    SWEEP_ABANDONED_GAME_SECONDS = float(os.getenv('SWEEP_ABANDONED_GAME_SECONDS', '86400'))
+    # answered invites and matchmaking notices are deleted after SWEEP_INVITE_SECONDS; pending invites
+    # once past their expiresAt, or after SWEEP_PENDING_INVITE_SECONDS when they have none
+    SWEEP_INVITE_SECONDS = float(os.getenv('SWEEP_INVITE_SECONDS', '600'))
+    SWEEP_PENDING_INVITE_SECONDS = float(os.getenv('SWEEP_PENDING_INVITE_SECONDS', '86400'))
+    # paths per multi-path delete, deletes per second and per run (0 = unlimited)
+    SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '100'))
+    SWEEP_MAX_DELETES_PER_SECOND = float(os.getenv('SWEEP_MAX_DELETES_PER_SECOND', '200'))
+    SWEEP_MAX_DELETES_PER_RUN = int(os.getenv('SWEEP_MAX_DELETES_PER_RUN', '10000'))
+    # the sweep_game_state job runs this often (0 = only `flask sweeper run`)
+    SWEEP_INTERVAL_SECONDS = float(os.getenv('SWEEP_INTERVAL_SECONDS', '900'))
+    # how often the sql backend checks watched games for changes made by other processes
+    GAME_STATE_POLL_SECONDS = float(os.getenv('GAME_STATE_POLL_SECONDS', '0.5'))
+    # server-sent game events: open streams per worker beyond which new ones get 503. A gthread
+    # worker holds a thread per stream, so keep this below GUNICORN_THREADS; gevent streams are cheap
+    SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', '10000' if WORKER_CLASS == 'gevent'
+                                    else str(max(1, int(os.getenv('GUNICORN_THREADS', '4')) // 2))))
+    SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+    SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', '3000'))
@@ -0,0 +1,169 @@
+"""SQL-backed mirror of Firebase Auth user records.
+
+Listing endpoints read emails and display names from the `user_directory`
+table instead of calling `firebase_auth.get_user()` per row. Unknown uids are
+filled in bulk through `get_users` (100 identifiers per call) and stale rows
+are refreshed in the background, so the steady state needs no Firebase calls.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import insert, update, bindparam
+from sqlalchemy.exc import IntegrityError
+from . import db, metrics
+from .auth import init_firebase, firebase_auth
+from .config import Config
+from .models import DirectoryUser
+
+# Firebase caps get_users() at 100 identifiers per call
+GET_USERS_BATCH = 100
+
+_refresh_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='directory-refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _normalize_email(email):
+    # Firebase treats emails case-insensitively; store them lowercased for indexed lookups
+    return email.strip().lower() if email else None
+
+
+def _entry(row):
+    return {'uid': row.uid, 'email': row.email, 'display_name': row.display_name}
+
+
+def _fetch_from_firebase(uids):
+    """Fetch user records for `uids` with batched get_users calls."""
+    init_firebase()
+    now = datetime.utcnow()
+    fetched = {}
+    for i in range(0, len(uids), GET_USERS_BATCH):
+        chunk = uids[i:i + GET_USERS_BATCH]
+        with metrics.firebase_call('get_users'):
+            result = firebase_auth.get_users([firebase_auth.UidIdentifier(u) for u in chunk])
+        for user in result.users:
+            fetched[user.uid] = {'uid': user.uid, 'email': _normalize_email(user.email), 'display_name': user.display_name, 'refreshed_at': now}
+        # remember unknown uids too so they are not looked up on every request
+        for ident in result.not_found:
+            fetched[ident.uid] = {'uid': ident.uid, 'email': None, 'display_name': None, 'refreshed_at': now}
+    return fetched
+
+
+def _store(entries, existing_uids):
+    """Upsert directory rows on a separate connection so the request session is untouched."""
+    table = DirectoryUser.__table__
+    updates = [dict(e, b_uid=e['uid']) for e in entries if e['uid'] in existing_uids]
+    inserts = [e for e in entries if e['uid'] not in existing_uids]
+    with db.engine.begin() as conn:
+        if updates:
+            conn.execute(
+                update(table).where(table.c.uid == bindparam('b_uid')).values(
+                    email=bindparam('email'), display_name=bindparam('display_name'), refreshed_at=bindparam('refreshed_at')),
+                updates)
+    for e in inserts:
+        # another worker may have inserted the same uid concurrently; that row is just as good
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(table), [e])
+        except IntegrityError:
+            pass
+
+
+def refresh(uids):
+    """Re-fetch `uids` from Firebase and upsert them into the directory."""
+    uids = list(dict.fromkeys(uids))
+    if not uids:
+        return {}
+    fetched = _fetch_from_firebase(uids)
+    existing = {r.uid for r in DirectoryUser.query.with_entities(DirectoryUser.uid).filter(DirectoryUser.uid.in_(uids))}
+    _store(list(fetched.values()), existing)
+    return fetched
+
+
+def _refresh_in_background(app, uids):
+    with _refreshing_lock:
+        uids = [u for u in uids if u not in _refreshing]
+        _refreshing.update(uids)
+    if not uids:
+        return
+
+    def run():
+        try:
+            with app.app_context():
+                refresh(uids)
+        except Exception:
+            app.logger.exception('user directory refresh failed')
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update(uids)
+
+    _refresh_pool.submit(run)
+
+
+def is_stale(refreshed_at):
+    cutoff = datetime.utcnow() - timedelta(seconds=Config.DIRECTORY_TTL_SECONDS)
+    return refreshed_at is None or refreshed_at < cutoff
+
+
+def refresh_in_background(uids):
+    if uids:
+        _refresh_in_background(current_app._get_current_object(), uids)
+
+
+def fill_missing(uids):
+    """Fetch never-seen uids from Firebase in one batched call and store them."""
+    uids = list(dict.fromkeys(u for u in uids if u))
+    if not uids:
+        return {}
+    try:
+        fetched = _fetch_from_firebase(uids)
+        _store(list(fetched.values()), set())
+    except Exception:
+        current_app.logger.exception('user directory fill failed')
+        return {}
+    return {uid: {'uid': uid, 'email': e['email'], 'display_name': e['display_name']} for uid, e in fetched.items()}
+
+
+def lookup(uids):
+    """Return {uid: {'uid', 'email', 'display_name'}} for the given uids.
+
+    Known rows are served from SQL (stale ones are refreshed asynchronously);
+    uids never seen before are fetched from Firebase in one batched call.
+    """
+    uids = list(dict.fromkeys(u for u in uids if u))
+    if not uids:
+        return {}
+    rows = DirectoryUser.query.filter(DirectoryUser.uid.in_(uids)).all()
+    found = {r.uid: _entry(r) for r in rows}
+    refresh_in_background([r.uid for r in rows if is_stale(r.refreshed_at)])
+    found.update(fill_missing([u for u in uids if u not in found]))
+    return found
+
+
+def resolve_email(email):
+    """Resolve an email to a Firebase uid, preferring the indexed directory lookup.
+
+    Only a fresh row is trusted: an email may have moved to another account or
+    been deleted since a stale row was stored, so those are checked with Firebase.
+    Returns None when no user with that email exists.
+    """
+    email = _normalize_email(email)
+    rows = DirectoryUser.query.filter_by(email=email).all()
+    for row in rows:
+        if not is_stale(row.refreshed_at):
+            return row.uid
+    init_firebase()
+    try:
+        with metrics.firebase_call('get_user_by_email'):
+            user = firebase_auth.get_user_by_email(email)
+    except firebase_auth.UserNotFoundError:
+        user = None
+    # stale rows that still hold this email are re-read, so they stop resolving to it
+    refresh_in_background([r.uid for r in rows if user is None or r.uid != user.uid])
+    if user is None:
+        return None
+    entry = {'uid': user.uid, 'email': _normalize_email(user.email), 'display_name': user.display_name, 'refreshed_at': datetime.utcnow()}
+    existing = {r.uid for r in DirectoryUser.query.with_entities(DirectoryUser.uid).filter_by(uid=user.uid)}
+    _store([entry], existing)
+    return user.uid
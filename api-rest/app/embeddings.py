@@ -0,0 +1,105 @@
+"""Content-addressed cache of reference-image embeddings.
+
+`set_reference_image` embeds the reference once and stores the vector under
+the SHA-256 of the image bytes; submissions for that game reuse it instead
+of downloading and decoding the original again. Vectors are kept in an
+in-memory LRU and written through to Config.EMBEDDING_CACHE_DIR as .npy
+files, so evicted entries and other workers can still find them.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from . import blobstore, scoring, vector_index
+from .cache import TTLCache
+from .config import Config
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class EmbeddingStore:
+    def __init__(self, directory=None, maxsize=1024):
+        self.directory = directory
+        self._memory = TTLCache(maxsize=maxsize)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.npy')
+
+    def get(self, digest):
+        # digests also arrive from RTDB, so never let one escape the cache directory
+        if not digest or not _DIGEST.fullmatch(digest):
+            return None
+        vector = self._memory.get(digest)
+        if vector is None and self.directory:
+            import numpy as np
+            try:
+                vector = np.load(self._path(digest))
+            except (OSError, ValueError):
+                return None
+            self._memory.set(digest, vector)
+        return vector
+
+    def put(self, digest, vector):
+        self._memory.set(digest, vector)
+        if not self.directory:
+            return
+        import numpy as np
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so concurrent readers never load a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, vector)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+store = EmbeddingStore(Config.EMBEDDING_CACHE_DIR, maxsize=Config.EMBEDDING_CACHE_SIZE)
+# game id -> digest of its reference, so this worker can skip the RTDB read on submit
+_game_digests = TTLCache(maxsize=10000, ttl=Config.EMBEDDING_GAME_TTL_SECONDS)
+
+
+def embed_reference(image_bytes, digest=None):
+    """Embed a reference image once. Returns (digest, vector).
+
+    `digest` lets a blob-store upload be cached under the hash of its original
+    while the smaller scoring variant is what gets decoded.
+    """
+    digest = digest or image_digest(image_bytes)
+    vector = store.get(digest)
+    if vector is None:
+        vector = scoring.embed_image(image_bytes)
+        store.put(digest, vector)
+    if Config.VECTOR_INDEX_DIR:
+        vector_index.get_index('references').add(digest, vector)
+    return digest, vector
+
+
+def reference(digest):
+    """The embedding of a game's stored reference, or None when the server has no copy of it.
+
+    Only images the server already holds are used: the cached vector, or a
+    POST /images upload embedded from its scoring variant.
+    """
+    vector = store.get(digest)
+    if vector is None and blobstore.is_digest(digest):
+        key = blobstore.key_for(digest, 'score.png')
+        blobs = blobstore.get_store()
+        if blobs.exists(key):
+            _, vector = embed_reference(blobs.read(key), digest=digest)
+    return vector
+
+
+def remember_game(game_id, digest):
+    _game_digests.set(game_id, digest)
+
+
+def game_digest(game_id):
+    return _game_digests.get(game_id)
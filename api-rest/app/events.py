@@ -0,0 +1,192 @@
+"""In-process fan-out of multiplayer game changes for the event stream.
+
+`GET /multiplayer/game/<id>/events` subscribes to a game here. The first
+subscriber to a game starts one watch on 'games/<id>' (app/gamestate.py) and
+the last one to leave closes it, so a game costs one watch per worker however
+many clients follow it. Each change is diffed against the previous snapshot
+into the transitions clients act on (joined, started, submitted, results)
+and put on every subscriber's queue.
+
+Subscribers only hold a queue; under the gevent worker an idle stream is a
+parked greenlet rather than a thread.
+"""
+import json
+import queue
+import threading
+from . import gamestate
+from .games import participants
+from .config import Config
+
+QUEUE_SIZE = 64
+CLOSED = object()
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def summary(game):
+    """The parts of a game node a waiting client needs."""
+    game = game or {}
+    submissions = game.get('submissions') or {}
+    return {
+        'state': game.get('state'),
+        'status': game.get('status'),
+        'playerA': game.get('playerA'),
+        'playerB': game.get('playerB'),
+        'players': participants(game),
+        'maxPlayers': game.get('maxPlayers'),
+        'imageUri': game.get('imageUri'),
+        'submitted': sorted(submissions),
+        'results': game.get('results'),
+    }
+
+
+def transitions(old, new):
+    """[(event, data)] that take a client from game `old` to game `new`."""
+    old = old or {}
+    if new is None:
+        return [('deleted', {})] if old else []
+    events = []
+    known = set(participants(old))
+    for uid in participants(new):
+        if uid not in known:
+            events.append(('joined', {'uid': uid, 'playerB': new.get('playerB'), 'status': new.get('status')}))
+    if new.get('state') == 'started' and (old.get('state') != 'started' or new.get('imageUri') != old.get('imageUri')):
+        events.append(('started', {'imageUri': new.get('imageUri')}))
+    seen = old.get('submissions') or {}
+    for uid, sub in sorted((new.get('submissions') or {}).items()):
+        if uid not in seen:
+            events.append(('submitted', {'uid': uid, 'timedOut': bool((sub or {}).get('timedOut'))}))
+    if new.get('results') and not old.get('results'):
+        events.append(('results', {'results': new['results']}))
+    return events
+
+
+class Subscription:
+    def __init__(self, game_id):
+        self.game_id = game_id
+        self._queue = queue.Queue(QUEUE_SIZE)
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        """Drop whatever is queued and end the stream."""
+        with self._queue.mutex:
+            self._queue.queue.clear()
+        self.put(CLOSED)
+
+    def get(self, timeout):
+        """The next (event, data), CLOSED, or None after `timeout` seconds without one."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class _Channel:
+    def __init__(self):
+        self.subscribers = set()
+        self.snapshot = None
+        self.loaded = False
+        self.watch = None
+
+
+class Broker:
+    def __init__(self, max_streams=None):
+        self.max_streams = max_streams
+        self._channels = {}
+        self._count = 0
+        # watch callbacks may run synchronously inside subscribe()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._count
+
+    def subscribe(self, game_id):
+        limit = Config.SSE_MAX_STREAMS if self.max_streams is None else self.max_streams
+        sub = Subscription(game_id)
+        with self._lock:
+            if self._count >= limit:
+                raise TooManyStreams(f'{self._count} streams open')
+            self._count += 1
+            channel = self._channels.get(game_id)
+            if channel is None:
+                channel = self._channels[game_id] = _Channel()
+            channel.subscribers.add(sub)
+            if channel.loaded:
+                sub.put(('state', summary(channel.snapshot)))
+            start = channel.watch is None
+            if start:
+                channel.watch = True
+        if start:
+            try:
+                handle = gamestate.get_store().watch(f'games/{game_id}', lambda value: self.publish(game_id, value))
+            except Exception:
+                self._fail(channel, game_id, sub)
+                raise
+            with self._lock:
+                if self._channels.get(game_id) is channel:
+                    channel.watch = handle
+                    handle = None
+            if handle is not None:
+                # everyone left while the watch was starting
+                handle.close()
+        return sub
+
+    def _fail(self, channel, game_id, starter):
+        """Drop a channel whose watch could not start; everyone who joined it meanwhile is closed."""
+        with self._lock:
+            if self._channels.get(game_id) is not channel:
+                return
+            del self._channels[game_id]
+            self._count -= len(channel.subscribers)
+            others = channel.subscribers - {starter}
+        # their streams end and the clients reconnect, starting a fresh watch
+        for other in others:
+            other.close()
+
+    def unsubscribe(self, sub):
+        handle = None
+        with self._lock:
+            channel = self._channels.get(sub.game_id)
+            if channel is None or sub not in channel.subscribers:
+                return
+            channel.subscribers.discard(sub)
+            self._count -= 1
+            if not channel.subscribers:
+                del self._channels[sub.game_id]
+                handle = channel.watch
+        if handle not in (None, True):
+            handle.close()
+
+    def publish(self, game_id, game):
+        """Fan a new value of games/<game_id> out to its subscribers."""
+        with self._lock:
+            channel = self._channels.get(game_id)
+            if channel is None:
+                return
+            if channel.loaded:
+                events = transitions(channel.snapshot, game)
+            else:
+                events = [('state', summary(game))]
+                channel.loaded = True
+            channel.snapshot = game
+            # queues never block, so fan out under the lock to keep every subscriber's events in order
+            for sub in channel.subscribers:
+                if not all(sub.put(e) for e in events):
+                    # too far behind: end the stream (the request unsubscribes it); the client
+                    # reconnects and gets a fresh state event
+                    sub.close()
+
+
+broker = Broker()
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
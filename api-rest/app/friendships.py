@@ -0,0 +1,178 @@
+"""Friend relationships stored as one row per ordered (user_low, user_high) pair.
+
+Send, accept and reject each cost one indexed read and one write. The old
+Friend/FriendRequest tables stay for the rolling deploy: `backfill_legacy()`
+copies what old workers wrote there, and `reject()` also deletes the pair's
+legacy pending requests so a later backfill cannot bring a rejected one back.
+"""
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, delete, or_, select, union_all
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import Friendship, Friend, FriendRequest, UserProfile
+
+
+def pair(a, b):
+    return (a, b) if a < b else (b, a)
+
+
+def get(a, b):
+    low, high = pair(a, b)
+    return Friendship.query.filter_by(user_low=low, user_high=high).first()
+
+
+def send(from_uid, to_uid):
+    """Create a pending request. Returns (friendship, error message)."""
+    existing = get(from_uid, to_uid)
+    if existing is None:
+        low, high = pair(from_uid, to_uid)
+        fr = Friendship(user_low=low, user_high=high, status='pending', requested_by=from_uid)
+        db.session.add(fr)
+        try:
+            db.session.commit()
+            return fr, None
+        except IntegrityError:
+            # the other user sent a request at the same moment
+            db.session.rollback()
+            existing = get(from_uid, to_uid)
+    if existing.status == 'accepted':
+        return None, 'already friends'
+    if existing.requested_by == from_uid:
+        return None, 'request already pending'
+    return None, 'friend request already exists with that person'
+
+
+def _respond(request_id, uid):
+    fr = db.session.get(Friendship, request_id)
+    if not fr:
+        return None, ('request not found', 404)
+    if uid not in (fr.user_low, fr.user_high) or fr.requested_by == uid:
+        return fr, ('not authorized', 403)
+    return fr, None
+
+
+def accept(request_id, uid):
+    """Accept a pending request addressed to `uid`. Returns (friendship, (error, status))."""
+    fr, err = _respond(request_id, uid)
+    if err:
+        if err[1] == 403:
+            err = ('not authorized to accept this request', 403)
+        return fr, err
+    if fr.status == 'accepted':
+        return fr, ('request already accepted', 400)
+    fr.status = 'accepted'
+    fr.responded_at = datetime.utcnow()
+    db.session.commit()
+    return fr, None
+
+
+def reject(request_id, uid):
+    """Delete a pending request addressed to `uid` so the sender may send again later."""
+    fr, err = _respond(request_id, uid)
+    if err:
+        if err[1] == 403:
+            err = ('not authorized to reject this request', 403)
+        return fr, err
+    if fr.status != 'pending':
+        return fr, ('request already responded', 400)
+    db.session.delete(fr)
+    db.session.execute(delete(FriendRequest).where(
+        FriendRequest.status == 'pending',
+        or_(and_(FriendRequest.from_uid == fr.user_low, FriendRequest.to_uid == fr.user_high),
+            and_(FriendRequest.from_uid == fr.user_high, FriendRequest.to_uid == fr.user_low))))
+    db.session.commit()
+    return fr, None
+
+
+def edges(uid, status, direction=None, after=None):
+    """Subquery of (id, other_uid, created_at) for the rows touching `uid`.
+
+    `direction` narrows pending rows to 'incoming' or 'outgoing' requests.
+    Each branch of the union is served by its own (user_*, status) index.
+    """
+    branches = []
+    for mine, other in ((Friendship.user_low, Friendship.user_high), (Friendship.user_high, Friendship.user_low)):
+        q = (select(Friendship.id.label('id'), other.label('other_uid'), Friendship.created_at.label('created_at'))
+             .where(mine == uid, Friendship.status == status))
+        if direction == 'incoming':
+            q = q.where(Friendship.requested_by == other)
+        elif direction == 'outgoing':
+            q = q.where(Friendship.requested_by == uid)
+        if after is not None:
+            q = q.where(Friendship.id > after)
+        branches.append(q)
+    return union_all(*branches).subquery('edges')
+
+
+def friend_uids(uid):
+    sub = edges(uid, 'accepted')
+    return [r.other_uid for r in db.session.execute(select(sub.c.other_uid))]
+
+
+def backfill_legacy():
+    """Copy pairs from the legacy friends/friend_requests tables that are not yet in friendships.
+
+    Idempotent; pending request ids are preserved so clients holding an old id keep working
+    (the migration keeps new friendship ids above the legacy ones). A pair still pending here
+    that an old worker accepted becomes accepted. Returns the number of rows inserted or accepted.
+    """
+    known = {(r.user_low, r.user_high): r for r in Friendship.query}
+    taken_ids = {r.id for r in known.values()}
+    rows = {}
+    accepted = set()
+    for fr in FriendRequest.query.filter(FriendRequest.status.in_(('pending', 'accepted'))).order_by(FriendRequest.id):
+        key = pair(fr.from_uid, fr.to_uid)
+        if fr.from_uid == fr.to_uid:
+            continue
+        if key in known:
+            if fr.status == 'accepted' and known[key].status == 'pending':
+                accepted.add(key)
+            continue
+        current = rows.get(key)
+        # an accepted request wins over a pending one for the same pair
+        if current is None or (current['status'] == 'pending' and fr.status == 'accepted'):
+            rows[key] = {
+                'id': fr.id if fr.id not in taken_ids else None,
+                'user_low': key[0], 'user_high': key[1], 'status': fr.status,
+                'requested_by': fr.from_uid, 'created_at': fr.created_at, 'responded_at': fr.responded_at,
+            }
+    legacy_friends = (db.session.query(UserProfile.uid, Friend.friend_uid)
+                      .join(UserProfile, UserProfile.id == Friend.user_id))
+    for owner_uid, friend_uid in legacy_friends:
+        key = pair(owner_uid, friend_uid)
+        if owner_uid == friend_uid:
+            continue
+        if key in known:
+            if known[key].status == 'pending':
+                accepted.add(key)
+            continue
+        current = rows.get(key)
+        if current is None:
+            rows[key] = {'id': None, 'user_low': key[0], 'user_high': key[1], 'status': 'accepted',
+                         'requested_by': owner_uid, 'created_at': datetime.utcnow(), 'responded_at': None}
+        else:
+            current['status'] = 'accepted'
+    for values in rows.values():
+        if values['id'] is None:
+            del values['id']
+        db.session.add(Friendship(**values))
+    for key in accepted:
+        known[key].status = 'accepted'
+        known[key].responded_at = datetime.utcnow()
+    db.session.commit()
+    return len(rows) + len(accepted)
+
+
+@click.group('friendships')
+def cli():
+    """Friend relationship maintenance."""
+
+
+@cli.command('backfill')
+@with_appcontext
+def backfill_command():
+    """Copy legacy friends/friend_requests rows into friendships."""
+    changed = backfill_legacy()
+    click.echo(f'inserted or accepted {changed} friendship rows')
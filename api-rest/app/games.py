@@ -0,0 +1,224 @@
+"""Multiplayer game lifecycle.
+
+A game's participants are the keys of its `players` node plus the legacy
+`playerA`/`playerB` fields, so two-player invites and N-player rooms share
+one flow. `start` locks the participants in: it writes `awaiting` (one
+flag per player who still owes a drawing) and the `remaining` counter.
+Each submission's finalize job (`record_submission`) clears its flag and
+lowers the counter to the flags left, touching nothing else, so a
+submission costs the same number of round trips in a room of 2 or 20 and
+nothing re-reads every submission; only the job that takes `remaining` to 0
+reads the game, once, to write the results.
+
+The handlers below run on the job queue (app/jobs.py): they compute results,
+finish games whose players never submit and fold scores into the SQL
+aggregates. `create_match` opens the game for a pair found by matchmaking.
+"""
+from datetime import datetime
+from . import gamestate, jobs, rtdb, stats
+
+
+class CannotJoin(Exception):
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.status = status
+
+
+class CannotStart(CannotJoin):
+    """The game is missing, the caller does not play in it, or it is already under way."""
+
+
+def participants(game):
+    """Every player of `game`, host (playerA) first."""
+    game = game or {}
+    out = [p for p in (game.get('playerA'), game.get('playerB')) if p]
+    out.extend(p for p in (game.get('players') or {}) if p not in out)
+    return out
+
+
+def new_game(player_a, player_b, now, **extra):
+    """The node of a game both players have agreed to, before a reference image is chosen."""
+    return dict({
+        'playerA': player_a,
+        'playerB': player_b,
+        'players': {player_a: {'joinedAt': now}, player_b: {'joinedAt': now}},
+        'status': 'waiting_for_image_selection',
+        'createdAt': now,
+    }, **extra)
+
+
+def new_room(host, max_players, now):
+    """The node of a room others join until the host (playerA) chooses the reference image."""
+    return {
+        'playerA': host,
+        'players': {host: {'joinedAt': now}},
+        'maxPlayers': max_players,
+        'status': 'waiting_for_players',
+        'createdAt': now,
+    }
+
+
+def join(game_id, uid, now):
+    """Add `uid` to a room that has not started; returns the number of players.
+
+    Only rooms (nodes with `maxPlayers`) take players this way; a two-player
+    invite or matchmade game is joined by its invitee through `accept` alone.
+    """
+    def add(game):
+        if not game:
+            raise CannotJoin('game not found', 404)
+        players = game.setdefault('players', {})
+        if uid in participants(game):
+            return game
+        if 'maxPlayers' not in game:
+            raise CannotJoin('game is not a room', 403)
+        if 'remaining' in game or game.get('state') in ('started', 'finishing', 'results'):
+            raise CannotJoin('game already started')
+        if len(participants(game)) >= game.get('maxPlayers', 2):
+            raise CannotJoin('room is full')
+        players[uid] = {'joinedAt': now}
+        game['updatedAt'] = now
+        return game
+
+    return len(participants(gamestate.get_store().transaction(f'games/{game_id}', add)))
+
+
+def accept(game_id, host, uid, now):
+    """Make `uid` the opponent in the two-player game `host` created for an invite."""
+    def add(game):
+        if not game:
+            return new_game(host, uid, now)
+        if any(p not in (host, uid) for p in participants(game)):
+            raise CannotJoin('game already has another opponent')
+        game.update({'playerB': uid, 'status': 'waiting_for_image_selection', 'updatedAt': now})
+        return game
+
+    gamestate.get_store().transaction(f'games/{game_id}', add)
+
+
+def check_startable(game, uid):
+    """Raise CannotStart unless `uid` may choose the reference image of `game` now."""
+    if not game:
+        raise CannotStart('game not found', 404)
+    if uid not in participants(game):
+        raise CannotStart('not a player in this game', 403)
+    if 'remaining' in game or game.get('state') in ('started', 'finishing', 'results'):
+        raise CannotStart('game already started')
+
+
+def start(game_id, uid, updates):
+    """Apply `updates` (reference image, state) for player `uid` and lock in who must submit before results."""
+    now = datetime.utcnow().isoformat()
+
+    def begin(game):
+        # checked again here: another player may have started the game since the caller read it
+        check_startable(game, uid)
+        game.update(updates)
+        players = game.setdefault('players', {})
+        owed = participants(game)
+        for p in owed:
+            players.setdefault(p, {'joinedAt': now})
+        game['awaiting'] = {p: True for p in owed}
+        game['remaining'] = len(owed)
+        return game
+
+    gamestate.get_store().transaction(f'games/{game_id}', begin)
+
+
+def record_submission(game_id, uid):
+    """Count `uid`'s submission: True when nobody owes one any more, False otherwise.
+
+    None means the game was started without `start` (a client writing the node
+    directly), so it has no counter and the game is checked submission by submission.
+    Safe to repeat: `remaining` is lowered to the number of flags left rather than
+    decremented, so a job retried after clearing its flag still brings it to 0.
+    """
+    state = gamestate.get_store()
+    left = []
+
+    def take(awaiting):
+        # may run more than once; only the last call's view counts
+        awaiting = dict(awaiting or {})
+        awaiting.pop(uid, None)
+        left[:] = [len(awaiting)]
+        return awaiting or None
+
+    state.transaction(f'games/{game_id}/awaiting', take)
+    remaining = state.transaction(f'games/{game_id}/remaining', lambda n: n if n is None else min(n, left[0]))
+    if remaining is None:
+        return None
+    return remaining == 0 and left[0] == 0
+
+
+def _can_finish(game, force):
+    if not game or game.get('state') == 'results':
+        return False
+    if force or game.get('remaining') == 0:
+        return True
+    submissions = game.get('submissions') or {}
+    return len(submissions) >= 2 and all(p in submissions for p in participants(game))
+
+
+def _finish(game_id, force):
+    state = gamestate.get_store()
+    path = f'games/{game_id}'
+    game = state.get(path)
+    if not _can_finish(game, force):
+        return
+    prior = []
+
+    def claim(current):
+        prior[:] = [current]
+        return current if current == 'results' else 'finishing'
+
+    state.transaction(f'{path}/state', claim)
+    # finished already, or another finalize job is on it; game_timeout (force) completes a finish that died midway
+    if prior[0] == 'results' or (prior[0] == 'finishing' and not force):
+        return
+    now = datetime.utcnow().isoformat()
+    # read again after the claim so a drawing that landed meanwhile still counts
+    submissions = state.get(f'{path}/submissions') or {}
+    updates = {}
+    for p in participants(game):
+        if p not in submissions:
+            submissions[p] = updates[f'submissions/{p}'] = {'score': 0, 'timedOut': True, 'submittedAt': now}
+    results = rtdb.compute_results(submissions)
+    updates.update({'results': results, 'state': 'results', 'finishedAt': now})
+    for entry in results['ranking']:
+        updates[f'players/{entry["uid"]}/rank'] = entry['rank']
+        updates[f'players/{entry["uid"]}/score'] = entry['score']
+    # results, every participant's rank and the final state land in one multi-location update
+    state.update(path, updates)
+
+
+@jobs.handler('finalize_game')
+def finalize_game(game_id, uid=None):
+    """Count `uid`'s submission and write results once nobody owes one; enqueued by each submission."""
+    if uid is not None and record_submission(game_id, uid) is False:
+        return
+    _finish(game_id, force=False)
+
+
+@jobs.handler('game_timeout')
+def game_timeout(game_id):
+    """Finish a game whose players did not all submit in time; they score 0."""
+    _finish(game_id, force=True)
+
+
+@jobs.handler('record_score')
+def record_score(uid, game_id, score):
+    # keyed by game so a re-submitted drawing is only counted once
+    stats.record_game(stats.get_or_create_profile(uid), float(score), key=f'{stats.SERVER_KEY_PREFIX}{game_id}')
+
+
+@jobs.handler('create_match')
+def create_match(game_id, player_a, player_b):
+    """Create the game for a matchmade pair and tell both players where it is."""
+    state = gamestate.get_store()
+    now = datetime.utcnow().isoformat()
+    # a retried job must not reset a game the players already started
+    state.transaction(f'games/{game_id}', lambda game: game or new_game(player_a, player_b, now, matchmade=True))
+    state.update('matchmaking', {
+        player_a: {'gameId': game_id, 'opponent': player_b, 'matchedAt': now},
+        player_b: {'gameId': game_id, 'opponent': player_a, 'matchedAt': now},
+    })
@@ -0,0 +1,453 @@
+"""Where multiplayer game and invite state lives.
+
+The routes and job handlers address state by Realtime Database style paths
+('games/<id>/submissions/<uid>', 'invites/<uid>/<invite_id>') through the
+GameStateStore interface. Config.GAME_STATE_BACKEND selects the backend:
+
+  firebase  the Realtime Database, as the Android app reads it (default)
+  sql       one JSON document per game / per invitee in the application database
+  memory    a process-local tree, for tests, benchmarks and single-node setups
+
+The sql and memory backends are not visible to clients that listen on the
+Realtime Database directly; the server-sent event stream (app/events.py)
+works with all three through `watch()`.
+"""
+import copy
+import json
+import random
+import threading
+from datetime import datetime
+from flask import current_app
+from firebase_admin import db as firebase_db
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from . import db, metrics, rtdb
+from .auth import init_firebase
+from .config import Config
+from .models import StateDocument
+
+MAX_TRANSACTION_RETRIES = 25
+# new sql documents start at a random version below this, leaving room to count up in an INT column
+NEW_VERSION_RANGE = 2 ** 30
+
+
+class TransactionAborted(Exception):
+    pass
+
+
+def split(path):
+    return [p for p in path.strip('/').split('/') if p]
+
+
+def _get_in(tree, parts):
+    node = tree
+    for p in parts:
+        if not isinstance(node, dict) or p not in node:
+            return None
+        node = node[p]
+    return node
+
+
+def _set_in(tree, parts, value):
+    """Set (or delete, for None) the value at `parts` under `tree`; returns the new tree."""
+    if not parts:
+        return copy.deepcopy(value)
+    tree = tree if isinstance(tree, dict) else {}
+    node = tree
+    for p in parts[:-1]:
+        if not isinstance(node.get(p), dict):
+            node[p] = {}
+        node = node[p]
+    if value is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = copy.deepcopy(value)
+    return tree
+
+
+class GameStateStore:
+    """Path-addressed JSON state with RTDB semantics: writing None deletes."""
+
+    def get(self, path):
+        raise NotImplementedError
+
+    def set(self, path, value):
+        raise NotImplementedError
+
+    def update(self, path, values):
+        """Write several children of `path` at once; keys may themselves be paths."""
+        raise NotImplementedError
+
+    def delete(self, path):
+        self.set(path, None)
+
+    def transaction(self, path, fn):
+        """Atomically replace the value at `path` with fn(current value); returns the new value."""
+        raise NotImplementedError
+
+    def children(self, path, start_after=None, limit=100):
+        """Up to `limit` (key, value) children of `path` in key order, starting after key `start_after`.
+
+        A value may be None for a child deleted meanwhile; page on with the last key.
+        """
+        raise NotImplementedError
+
+    def push_key(self):
+        return rtdb.push_key()
+
+    def watch(self, path, on_change):
+        """Call on_change(value) with the value at `path` now and after every change; returns a Watch.
+
+        Callbacks may run on a background thread and may skip intermediate values.
+        """
+        raise NotImplementedError
+
+
+class Watch:
+    def __init__(self, close):
+        self._close = close
+
+    def close(self):
+        self._close()
+
+
+class FirebaseStore(GameStateStore):
+    def _ref(self, path):
+        init_firebase()
+        return firebase_db.reference(path)
+
+    def get(self, path):
+        with metrics.firebase_call('rtdb_get'):
+            return self._ref(path).get()
+
+    def set(self, path, value):
+        with metrics.firebase_call('rtdb_set'):
+            self._ref(path).set(value)
+
+    def update(self, path, values):
+        with metrics.firebase_call('rtdb_update'):
+            self._ref(path).update(values)
+
+    def delete(self, path):
+        with metrics.firebase_call('rtdb_delete'):
+            self._ref(path).delete()
+
+    def transaction(self, path, fn):
+        # a GET plus one conditional PUT per attempt, timed as one operation
+        with metrics.firebase_call('rtdb_transaction'):
+            return self._ref(path).transaction(fn)
+
+    def children(self, path, start_after=None, limit=100):
+        query = self._ref(path).order_by_key()
+        if start_after is not None:
+            # start_at is inclusive: fetch one more and drop the cursor itself
+            query = query.start_at(start_after)
+            limit += 1
+        with metrics.firebase_call('rtdb_query'):
+            value = query.limit_to_first(limit).get() or {}
+        return [(k, v) for k, v in value.items() if k != start_after]
+
+    def watch(self, path, on_change):
+        # one streaming connection (and listener thread) per watched path, mirrored locally
+        mirror = {'value': None}
+
+        def on_event(event):
+            parts = split(event.path)
+            if event.event_type == 'put':
+                mirror['value'] = _set_in(mirror['value'], parts, event.data)
+            elif event.event_type == 'patch':
+                for key, value in event.data.items():
+                    mirror['value'] = _set_in(mirror['value'], parts + split(key), value)
+            on_change(copy.deepcopy(mirror['value'] or None))
+
+        registration = self._ref(path).listen(on_event)
+        return Watch(registration.close)
+
+
+def _overlaps(a, b):
+    n = min(len(a), len(b))
+    return a[:n] == b[:n]
+
+
+class MemoryStore(GameStateStore):
+    def __init__(self):
+        self._root = {}
+        self._lock = threading.RLock()
+        self._watchers = []
+
+    def _changed(self, written):
+        """Values for the watchers of any path overlapping the written ones; call them outside the lock."""
+        return [(fn, copy.deepcopy(_get_in(self._root, parts))) for parts, fn in self._watchers
+                if any(_overlaps(parts, w) for w in written)]
+
+    def _notify(self, pending):
+        for fn, value in pending:
+            fn(value)
+
+    def get(self, path):
+        with self._lock:
+            return copy.deepcopy(_get_in(self._root, split(path)))
+
+    def set(self, path, value):
+        parts = split(path)
+        with self._lock:
+            self._root = _set_in(self._root, parts, value) or {}
+            pending = self._changed([parts])
+        self._notify(pending)
+
+    def update(self, path, values):
+        base = split(path)
+        written = [base + split(key) for key in values]
+        with self._lock:
+            for parts, value in zip(written, values.values()):
+                self._root = _set_in(self._root, parts, value) or {}
+            pending = self._changed(written)
+        self._notify(pending)
+
+    def transaction(self, path, fn):
+        parts = split(path)
+        with self._lock:
+            value = fn(copy.deepcopy(_get_in(self._root, parts)))
+            self._root = _set_in(self._root, parts, value) or {}
+            pending = self._changed([parts])
+        self._notify(pending)
+        return value
+
+    def children(self, path, start_after=None, limit=100):
+        with self._lock:
+            node = _get_in(self._root, split(path))
+            if not isinstance(node, dict):
+                return []
+            keys = sorted(k for k in node if start_after is None or k > start_after)[:limit]
+            return [(k, copy.deepcopy(node[k])) for k in keys]
+
+    def watch(self, path, on_change):
+        entry = (split(path), on_change)
+        with self._lock:
+            self._watchers.append(entry)
+            value = copy.deepcopy(_get_in(self._root, entry[0]))
+        on_change(value)
+
+        def close():
+            with self._lock:
+                if entry in self._watchers:
+                    self._watchers.remove(entry)
+        return Watch(close)
+
+
+class SqlStore(GameStateStore):
+    """Each 'games/<id>' or 'invites/<uid>' subtree is one state_documents row.
+
+    Writes are optimistic: the row's version is checked on update and the
+    read-modify-write is retried on conflict, across threads and processes.
+    Multi-location updates touching several documents commit together. A
+    document whose last value is removed is deleted, not kept empty.
+
+    Watches are served by one poller thread per process that reads the
+    versions of every watched document in a single query each
+    Config.GAME_STATE_POLL_SECONDS; writes made by this process wake it
+    immediately.
+    """
+
+    DEPTH = 2
+
+    def __init__(self):
+        self._watched = {}  # doc key -> {'version': int or None, 'watchers': [(subpath, fn)]}
+        self._watch_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._poller = None
+
+    def _doc_key(self, parts):
+        if len(parts) < self.DEPTH:
+            raise ValueError(f'paths must address at least {self.DEPTH} levels, got {"/".join(parts)!r}')
+        return '/'.join(parts[:self.DEPTH]), parts[self.DEPTH:]
+
+    def _load(self, conn, key):
+        row = conn.execute(select(StateDocument.data, StateDocument.version)
+                           .where(StateDocument.key == key)).first()
+        return (json.loads(row.data), row.version) if row else (None, None)
+
+    def _save(self, conn, key, data, version):
+        """Write a document read at `version` (None: absent). Returns False on a concurrent change."""
+        now = datetime.utcnow()
+        if version is None:
+            if data is None:
+                return True
+            try:
+                # not 1: a document deleted and created again must not look like the copy a writer
+                # or watcher read before the delete
+                conn.execute(insert(StateDocument).values(key=key, data=json.dumps(data),
+                                                          version=random.randint(1, NEW_VERSION_RANGE), updated_at=now))
+            except IntegrityError:
+                # created concurrently; the caller rolls back and retries
+                return False
+            return True
+        if data is None:
+            # the row goes away; a concurrent writer finds it gone (or re-created) and retries
+            return conn.execute(delete(StateDocument)
+                                .where(StateDocument.key == key, StateDocument.version == version)).rowcount == 1
+        return conn.execute(update(StateDocument)
+                            .where(StateDocument.key == key, StateDocument.version == version)
+                            .values(data=json.dumps(data), version=version + 1, updated_at=now)).rowcount == 1
+
+    def get(self, path):
+        parts = split(path)
+        with db.engine.connect() as conn:
+            if len(parts) < self.DEPTH:
+                # e.g. 'games': assemble the children from their documents
+                prefix = '/'.join(parts) + '/'
+                rows = conn.execute(select(StateDocument.key, StateDocument.data)
+                                    .where(StateDocument.key.startswith(prefix, autoescape=True)))
+                out = {}
+                for key, data in rows:
+                    value = json.loads(data)
+                    if value:
+                        out[key[len(prefix):]] = value
+                return out or None
+            key, rest = self._doc_key(parts)
+            data, _ = self._load(conn, key)
+        value = _get_in(data, rest)
+        return value if value != {} else None
+
+    def _apply(self, conn, changes, results):
+        for key, edits in sorted(changes.items()):
+            data, version = self._load(conn, key)
+            for rest, value in edits:
+                if callable(value):
+                    current = _get_in(data, rest)
+                    value = value(copy.deepcopy(current if current != {} else None))
+                    results[key] = value
+                data = _set_in(data, rest, value)
+            if not self._save(conn, key, data or None, version):
+                return False
+        return True
+
+    def _write(self, changes):
+        """Apply {doc key: [(subpath, value or fn)]} in one database transaction, retrying on conflicts."""
+        with db.engine.connect() as conn:
+            for _ in range(MAX_TRANSACTION_RETRIES):
+                results = {}
+                trans = conn.begin()
+                try:
+                    ok = self._apply(conn, changes, results)
+                except Exception:
+                    trans.rollback()
+                    raise
+                if ok:
+                    trans.commit()
+                    if self._watched:
+                        self._wake.set()
+                    return results
+                trans.rollback()
+        raise TransactionAborted('too many concurrent writers')
+
+    def set(self, path, value):
+        key, rest = self._doc_key(split(path))
+        self._write({key: [(rest, value)]})
+
+    def update(self, path, values):
+        base = split(path)
+        changes = {}
+        for sub, value in values.items():
+            key, rest = self._doc_key(base + split(sub))
+            changes.setdefault(key, []).append((rest, value))
+        self._write(changes)
+
+    def transaction(self, path, fn):
+        key, rest = self._doc_key(split(path))
+        return self._write({key: [(rest, fn)]})[key]
+
+    def children(self, path, start_after=None, limit=100):
+        parts = split(path)
+        if len(parts) != self.DEPTH - 1:
+            node = self.get(path)
+            if not isinstance(node, dict):
+                return []
+            keys = sorted(k for k in node if start_after is None or k > start_after)[:limit]
+            return [(k, node[k]) for k in keys]
+        # one level above the documents: page through their keys in the table
+        prefix = parts[0] + '/'
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(StateDocument.key, StateDocument.data)
+                                .where(StateDocument.key > prefix + (start_after or ''),
+                                       StateDocument.key < parts[0] + chr(ord('/') + 1))
+                                .order_by(StateDocument.key).limit(limit)).all()
+        # an empty document (left by older versions instead of deleting the row) reads as None
+        return [(row.key[len(prefix):], json.loads(row.data) or None) for row in rows]
+
+    def watch(self, path, on_change):
+        key, rest = self._doc_key(split(path))
+        entry = (rest, on_change)
+        with self._watch_lock:
+            # version -1: the poller reports the current value to the document's watchers on its next pass
+            doc = self._watched.setdefault(key, {'version': -1, 'watchers': []})
+            doc['version'] = -1
+            doc['watchers'].append(entry)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, args=(current_app._get_current_object(),),
+                                                name='state-watch', daemon=True)
+                self._poller.start()
+        self._wake.set()
+
+        def close():
+            with self._watch_lock:
+                doc = self._watched.get(key)
+                if doc and entry in doc['watchers']:
+                    doc['watchers'].remove(entry)
+                    if not doc['watchers']:
+                        del self._watched[key]
+        return Watch(close)
+
+    def _poll(self, app):
+        while True:
+            self._wake.clear()
+            with self._watch_lock:
+                if not self._watched:
+                    self._poller = None
+                    return
+                keys = list(self._watched)
+            try:
+                with app.app_context(), db.engine.connect() as conn:
+                    versions = dict(conn.execute(select(StateDocument.key, StateDocument.version)
+                                                 .where(StateDocument.key.in_(keys))).all())
+                    with self._watch_lock:
+                        changed = [k for k in keys if k in self._watched
+                                   and self._watched[k]['version'] != versions.get(k)]
+                    for key in changed:
+                        data, version = self._load(conn, key)
+                        with self._watch_lock:
+                            doc = self._watched.get(key)
+                            if doc is None:
+                                continue
+                            doc['version'] = version
+                            watchers = list(doc['watchers'])
+                        for rest, fn in watchers:
+                            value = _get_in(data, rest)
+                            fn(value if value != {} else None)
+            except Exception:
+                app.logger.exception('game state watch poll failed')
+            self._wake.wait(Config.GAME_STATE_POLL_SECONDS)
+
+
+BACKENDS = {'firebase': FirebaseStore, 'sql': SqlStore, 'memory': MemoryStore}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = BACKENDS.get(Config.GAME_STATE_BACKEND)
+                if backend is None:
+                    raise ValueError(f'unknown GAME_STATE_BACKEND {Config.GAME_STATE_BACKEND!r}; use one of {sorted(BACKENDS)}')
+                _store = backend()
+    return _store
+
+
+def use(store):
+    """Replace the process-wide store (tests and benchmarks)."""
+    global _store
+    _store = store
@@ -0,0 +1,231 @@
+"""Retention for the games table: monthly partitions, recent raw rows, daily roll-ups.
+
+Every row of `games` carries `month`, the yyyymm of its created_at. On MySQL
+the table is RANGE-partitioned on it, one partition per month; on SQLite the
+(user_id, month, created_at) index stands in for the partitions. Either way a
+query bounded by month reads only the months it names, so `recent_games`
+touches only the hot partitions however long the table's history is.
+
+Raw rows are kept for Config.HISTORY_RAW_DAYS. `roll_up` folds older ones
+into game_daily_rollups (games, total and best score per player and UTC day)
+and deletes them, by id, in the same transaction, so each game is counted
+exactly once. Batch uploads of games already past the window go straight
+into the roll-ups. `daily` adds both sources together, so per-day and
+long-range totals stay exact however much has been rolled up.
+
+On MySQL `maintain_partitions` adds partitions HISTORY_PARTITIONS_AHEAD months
+ahead and drops the ones the roll-up emptied. It keeps one empty month below
+the cutoff for batch uploads racing it. The history_maintenance job runs both,
+and purges old finished jobs (jobs.purge_finished), every HISTORY_INTERVAL_SECONDS.
+"""
+from datetime import date, datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case, delete, func, insert, select, text, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db, jobs
+from .config import Config
+from .models import GameDailyRollup, GameRecord, UserProfile
+
+# longest range GET /profiles/me/history serves in one response
+MAX_HISTORY_DAYS = 3660
+
+
+def month_of(when):
+    return when.year * 100 + when.month
+
+
+def add_months(month, n):
+    year, index = divmod(month // 100 * 12 + month % 100 - 1 + n, 12)
+    return year * 100 + index + 1
+
+
+def cutoff(now=None):
+    """Start of the oldest UTC day whose games are still kept raw."""
+    now = now or datetime.utcnow()
+    return datetime(now.year, now.month, now.day) - timedelta(days=Config.HISTORY_RAW_DAYS)
+
+
+def _merge(totals):
+    """Add {(user_id, day): [games, total, best]} to the roll-ups in the current transaction."""
+    table = GameDailyRollup.__table__
+    dialect = db.engine.dialect.name
+
+    def added(count, total, best):
+        return dict(games_count=table.c.games_count + count, total_score=table.c.total_score + total,
+                    best_score=case((table.c.best_score < best, best), else_=table.c.best_score))
+
+    for (user_id, day), (count, total, best) in sorted(totals.items()):
+        values = dict(user_id=user_id, day=day, games_count=count, total_score=total, best_score=best)
+        # one atomic upsert: a day created by a concurrent transaction is added to, never skipped
+        if dialect == 'mysql':
+            stmt = mysql_insert(table).values(**values)
+            new = stmt.inserted
+            db.session.execute(stmt.on_duplicate_key_update(**added(new.games_count, new.total_score, new.best_score)))
+        elif dialect == 'sqlite':
+            stmt = sqlite_insert(table).values(**values)
+            new = stmt.excluded
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id', 'day'], set_=added(new.games_count, new.total_score, new.best_score)))
+        elif not db.session.execute(update(table).where((table.c.user_id == user_id) & (table.c.day == day))
+                                    .values(**added(count, total, best))).rowcount:
+            # a concurrent insert of the same day fails here, and the caller's transaction with it
+            db.session.execute(insert(table).values(**values))
+
+
+def _totals(rows):
+    totals = {}
+    for user_id, score, played_at in rows:
+        entry = totals.setdefault((user_id, played_at.date()), [0, 0.0, score])
+        entry[0] += 1
+        entry[1] += score
+        entry[2] = max(entry[2], score)
+    return totals
+
+
+def add_rolled_up(user_id, games):
+    """Record (score, played_at) games that are already past the raw window. The caller commits."""
+    _merge(_totals((user_id, score, played_at) for score, played_at in games))
+
+
+def roll_up(now=None, batch=None):
+    """Fold raw games older than the window into the daily roll-ups; returns how many were folded."""
+    before = cutoff(now)
+    batch = batch or Config.HISTORY_ROLLUP_BATCH
+    folded = 0
+    while True:
+        rows = db.session.execute(
+            select(GameRecord.id, GameRecord.user_id, GameRecord.score, GameRecord.created_at)
+            .where(GameRecord.month <= month_of(before), GameRecord.created_at < before).limit(batch)).all()
+        if not rows:
+            db.session.rollback()
+            return folded
+        _merge(_totals((r.user_id, r.score, r.created_at) for r in rows))
+        deleted = db.session.execute(delete(GameRecord).where(GameRecord.month <= month_of(before),
+                                                              GameRecord.id.in_([r.id for r in rows]))).rowcount
+        if deleted != len(rows):
+            # a concurrent roll-up took some of these rows; counting them again would double them
+            db.session.rollback()
+            continue
+        db.session.commit()
+        folded += len(rows)
+
+
+def _partitions():
+    rows = db.session.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'games' AND PARTITION_NAME IS NOT NULL")).scalars()
+    return sorted(int(name[1:]) for name in rows if name != 'pmax')
+
+
+def maintain_partitions(now=None):
+    """MySQL: add the coming months' partitions, drop emptied old ones. Returns (added, dropped) months."""
+    if db.engine.dialect.name != 'mysql':
+        return [], []
+    months = _partitions()
+    if not months:
+        # not partitioned: the migration ran on another database
+        return [], []
+    now = now or datetime.utcnow()
+    last = add_months(month_of(now), Config.HISTORY_PARTITIONS_AHEAD)
+    added = []
+    while (added or months)[-1] < last:
+        added.append(add_months((added or months)[-1], 1))
+    if added:
+        # pmax is empty while partitions are kept ahead, so splitting it moves no rows
+        defs = ', '.join(f'PARTITION p{m} VALUES LESS THAN ({add_months(m, 1)})' for m in added)
+        db.session.execute(text(f'ALTER TABLE games REORGANIZE PARTITION pmax INTO '
+                                f'({defs}, PARTITION pmax VALUES LESS THAN MAXVALUE)'))
+    # the month just below the cutoff stays even when empty: a batch upload racing the cutoff may still land there
+    keep_from = add_months(month_of(cutoff(now)), -1)
+    dropped = [m for m in months[:-1] if m < keep_from
+               and db.session.execute(text(f'SELECT 1 FROM games PARTITION (p{m}) LIMIT 1')).first() is None]
+    if dropped:
+        db.session.execute(text('ALTER TABLE games DROP PARTITION ' + ', '.join(f'p{m}' for m in dropped)))
+    db.session.commit()
+    return added, dropped
+
+
+def recent_games(uid, days, limit):
+    """A player's newest raw games from the last `days` days, newest first; reads only those months."""
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = db.session.execute(
+        select(GameRecord.id, GameRecord.score, GameRecord.created_at)
+        .join(UserProfile, UserProfile.id == GameRecord.user_id)
+        .where(UserProfile.uid == uid, GameRecord.month >= month_of(since), GameRecord.created_at >= since)
+        .order_by(GameRecord.month.desc(), GameRecord.created_at.desc()).limit(limit)).all()
+    return [{'id': r.id, 'score': r.score, 'created_at': r.created_at.isoformat()} for r in rows]
+
+
+def _day(value):
+    # DATE() comes back as a string from SQLite and as a date from MySQL
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+
+def daily(uid, first, last):
+    """Per-day games, mean and best score between two dates (inclusive), plus totals over the range."""
+    days = {}
+
+    def add(day, count, total, best):
+        entry = days.setdefault(day, [0, 0.0, best])
+        entry[0] += count
+        entry[1] += total
+        entry[2] = max(entry[2], best)
+
+    for r in db.session.execute(
+            select(GameDailyRollup.day, GameDailyRollup.games_count, GameDailyRollup.total_score, GameDailyRollup.best_score)
+            .join(UserProfile, UserProfile.id == GameDailyRollup.user_id)
+            .where(UserProfile.uid == uid, GameDailyRollup.day >= first, GameDailyRollup.day <= last)):
+        add(r.day, r.games_count, r.total_score, r.best_score)
+    # raw rows: in practice only the hot months still hold any
+    start = datetime(first.year, first.month, first.day)
+    end = datetime(last.year, last.month, last.day) + timedelta(days=1)
+    day = func.date(GameRecord.created_at)
+    for r in db.session.execute(
+            select(day.label('day'), func.count(), func.sum(GameRecord.score), func.max(GameRecord.score))
+            .join(UserProfile, UserProfile.id == GameRecord.user_id)
+            .where(UserProfile.uid == uid, GameRecord.month >= month_of(start), GameRecord.month <= month_of(last),
+                   GameRecord.created_at >= start, GameRecord.created_at < end)
+            .group_by(day)):
+        add(_day(r[0]), r[1], r[2], r[3])
+
+    out = [{'day': d.isoformat(), 'games': n, 'mean': round(total / n, 2), 'best': best}
+           for d, (n, total, best) in sorted(days.items())]
+    games = sum(n for n, _, _ in days.values())
+    totals = {'games': games, 'mean': round(sum(t for _, t, _ in days.values()) / games, 2) if games else None,
+              'best': max((b for _, _, b in days.values()), default=None)}
+    return out, totals
+
+
+def schedule(now=None):
+    """Enqueue the next periodic maintenance unless a worker already has; the caller commits."""
+    jobs.schedule_periodic('history_maintenance', Config.HISTORY_INTERVAL_SECONDS, now)
+
+
+@jobs.handler('history_maintenance')
+def maintenance_job(slot):
+    with jobs.rescheduling(schedule):
+        roll_up()
+        maintain_partitions()
+        jobs.purge_finished()
+
+
+@click.group('history')
+def cli():
+    """Games history retention."""
+
+
+@cli.command('rollup')
+@with_appcontext
+def rollup_command():
+    """Fold games older than HISTORY_RAW_DAYS into the daily roll-ups."""
+    click.echo(f'rolled up {roll_up()} games older than {cutoff().date().isoformat()}')
+
+
+@cli.command('partitions')
+@with_appcontext
+def partitions_command():
+    """MySQL: create upcoming monthly partitions and drop emptied ones."""
+    added, dropped = maintain_partitions()
+    click.echo(f'added {len(added)} partitions {added}, dropped {len(dropped)} {dropped}')
@@ -0,0 +1,264 @@
+"""Durable background jobs stored in the application database.
+
+`enqueue()` adds a row to the jobs table inside the caller's transaction, so
+a job exists exactly when the work that triggered it was committed. A
+dedupe key makes enqueueing idempotent: a second job with the same key is
+silently dropped, even after the first one has finished.
+
+Worker threads claim due jobs with a conditional UPDATE (safe across threads
+and gunicorn workers), run the registered handler and mark the job done.
+A handler's database writes commit in the same transaction that marks the
+job done. Failures are retried with exponential backoff up to
+`max_attempts`, and jobs still running after Config.JOB_LEASE_SECONDS
+(their worker most likely died) are re-queued, so handlers that touch
+anything outside the database must be idempotent.
+
+Done and failed jobs are kept for Config.JOB_RETENTION_SECONDS, so their
+dedupe keys keep working while the game they belong to is live, then
+`purge_finished` deletes them from the history_maintenance job.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from . import db
+from .config import Config
+from .models import Job
+
+MAX_BACKOFF_SECONDS = 600
+
+_handlers = {}
+_wake = threading.Event()
+_started = False
+
+
+def handler(kind):
+    """Register the function that runs jobs of `kind`; it is called with the payload as keyword arguments."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(kind, payload=None, dedupe_key=None, delay=0, max_attempts=None):
+    """Add a job in the current transaction; the caller commits."""
+    now = datetime.utcnow()
+    values = dict(
+        kind=kind, payload=json.dumps(payload or {}), dedupe_key=dedupe_key, status='queued', attempts=0,
+        max_attempts=max_attempts or Config.JOB_MAX_ATTEMPTS, run_at=now + timedelta(seconds=delay), created_at=now)
+    dialect = db.engine.dialect.name
+    # duplicates only: INSERT IGNORE / OR IGNORE would also swallow NOT NULL, truncation or bad-value errors
+    if dedupe_key is not None and dialect == 'mysql':
+        stmt = mysql_insert(Job).values(**values).on_duplicate_key_update(id=Job.id)
+    elif dedupe_key is not None and dialect == 'sqlite':
+        stmt = sqlite_insert(Job).values(**values).on_conflict_do_nothing()
+    else:
+        stmt = insert(Job).values(**values)
+    db.session.execute(stmt)
+    if not delay:
+        db.session.info['jobs_enqueued'] = True
+
+
+def schedule_periodic(kind, interval, now=None):
+    """Enqueue the next run of a periodic job, due at the next multiple of `interval` seconds.
+
+    Every worker may ask; the dedupe key keeps one job per slot. The handler gets the
+    slot as `slot` and calls this again when it is done. The caller commits.
+    """
+    if interval <= 0:
+        return
+    now = time.time() if now is None else now
+    slot = int(now // interval) + 1
+    enqueue(kind, {'slot': slot}, dedupe_key=f'{kind}:{slot}', delay=slot * interval - now)
+
+
+@contextmanager
+def rescheduling(schedule):
+    """Run a periodic job's body, then call `schedule` for its next run even if the body fails.
+
+    On failure the body's work is rolled back and the next run is committed on its own,
+    so a job that keeps failing until it runs out of attempts does not end the chain.
+    """
+    try:
+        yield
+    except Exception:
+        db.session.rollback()
+        schedule()
+        db.session.commit()
+        raise
+    schedule()
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_workers(session):
+    # jobs enqueued by this process start right away instead of at the next poll
+    if session.info.pop('jobs_enqueued', False):
+        _wake.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_enqueued(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+def claim(worker_id):
+    """Mark the oldest due job as running for `worker_id` and return it, or None."""
+    now = datetime.utcnow()
+    for _ in range(5):
+        row = (db.session.query(Job.id).filter(Job.status == 'queued', Job.run_at <= now)
+               .order_by(Job.run_at).first())
+        if row is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.execute(
+            update(Job).where(Job.id == row.id, Job.status == 'queued')
+            .values(status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, row.id)
+        # another worker took it first; try the next one
+    return None
+
+
+def run(job):
+    """Run one claimed job and record the outcome. Returns True if it succeeded."""
+    job_id = job.id
+    fn = _handlers.get(job.kind)
+    try:
+        if fn is None:
+            raise LookupError(f'no handler for job kind {job.kind!r}')
+        fn(**json.loads(job.payload))
+        db.session.execute(update(Job).where(Job.id == job_id)
+                           .values(status='done', locked_by=None, last_error=None, finished_at=datetime.utcnow()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = f'{type(e).__name__}: {e}'
+        job.locked_by = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=min(MAX_BACKOFF_SECONDS, 2 ** job.attempts))
+        db.session.commit()
+        return False
+    return True
+
+
+def requeue_stale():
+    """Put jobs that have been running longer than the lease back in the queue."""
+    cutoff = datetime.utcnow() - timedelta(seconds=Config.JOB_LEASE_SECONDS)
+    count = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.locked_at < cutoff)
+        .values(status='queued', locked_by=None)).rowcount
+    db.session.commit()
+    return count
+
+
+def purge_finished(now=None, batch=None):
+    """Delete done and failed jobs that finished more than JOB_RETENTION_SECONDS ago; returns how many."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=Config.JOB_RETENTION_SECONDS)
+    batch = batch or Config.JOB_PURGE_BATCH
+    purged = 0
+    for status in ('done', 'failed'):
+        while True:
+            ids = db.session.execute(select(Job.id).where(Job.status == status, Job.finished_at < cutoff)
+                                     .limit(batch)).scalars().all()
+            if not ids:
+                break
+            purged += db.session.execute(delete(Job).where(Job.id.in_(ids))).rowcount
+            db.session.commit()
+    db.session.rollback()
+    return purged
+
+
+def drain(worker_id='inline'):
+    """Run due jobs in the calling thread until none are left; for scripts and benchmarks."""
+    ran = 0
+    while True:
+        job = claim(worker_id)
+        if job is None:
+            return ran
+        run(job)
+        ran += 1
+
+
+def work(app, worker_id, stop=None):
+    """Claim and run jobs until `stop` is set."""
+    stop = stop or threading.Event()
+    last_reap = 0
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                if time.monotonic() - last_reap > Config.JOB_LEASE_SECONDS / 2:
+                    requeue_stale()
+                    last_reap = time.monotonic()
+                job = claim(worker_id)
+                if job is not None:
+                    run(job)
+                    continue
+        except Exception:
+            app.logger.exception('job worker error')
+        _wake.wait(Config.JOB_POLL_SECONDS)
+        _wake.clear()
+
+
+def start_workers(app, threads=None):
+    """Start the in-process worker pool (once per process)."""
+    global _started
+    threads = Config.JOB_WORKER_THREADS if threads is None else threads
+    if _started or threads <= 0:
+        return
+    _started = True
+    prefix = f'{socket.gethostname()}:{os.getpid()}'
+    for i in range(threads):
+        threading.Thread(target=work, args=(app, f'{prefix}:{i}'), name=f'job-worker-{i}', daemon=True).start()
+
+
+@click.group('jobs')
+def cli():
+    """Background job queue."""
+
+
+@cli.command('work')
+@click.option('--threads', default=2, show_default=True)
+@with_appcontext
+def work_command(threads):
+    """Run job workers in the foreground (instead of inside gunicorn)."""
+    from flask import current_app
+    app = current_app._get_current_object()
+    prefix = f'{socket.gethostname()}:{os.getpid()}'
+    pool = [threading.Thread(target=work, args=(app, f'{prefix}:{i}'), daemon=True) for i in range(threads)]
+    for t in pool:
+        t.start()
+    click.echo(f'{threads} job workers running')
+    for t in pool:
+        t.join()
+
+
+@cli.command('purge')
+@with_appcontext
+def purge_command():
+    """Delete done and failed jobs older than JOB_RETENTION_SECONDS."""
+    click.echo(f'purged {purge_finished()} finished jobs')
+
+
+@cli.command('status')
+@with_appcontext
+def status_command():
+    """Count jobs by kind and status."""
+    rows = (db.session.query(Job.kind, Job.status, db.func.count())
+            .group_by(Job.kind, Job.status).order_by(Job.kind, Job.status))
+    for kind, status, count in rows:
+        click.echo(f'{kind:<20} {status:<8} {count}')
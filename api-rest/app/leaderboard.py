@@ -0,0 +1,83 @@
+"""Leaderboards served from the player_stats aggregates.
+
+`stats.record_game()` keeps the aggregates current inside the caller's
+transaction, so reading a leaderboard never touches the games table. Pages
+are cached in-process for Config.LEADERBOARD_CACHE_SECONDS.
+"""
+from . import db, stats as player_stats
+from .cache import TTLCache
+from .config import Config
+from .models import PlayerStats, ScoreBucket, UserProfile
+
+MAX_LEADERBOARD_SIZE = 100
+
+_pages = TTLCache(maxsize=1024, ttl=Config.LEADERBOARD_CACHE_SECONDS)
+
+
+def _entry(rank, stats, profile):
+    return {
+        'rank': rank,
+        'uid': profile.uid,
+        'display_name': profile.display_name,
+        'best_score': stats.best_score,
+        'games_played': stats.games_count,
+    }
+
+
+def _ranked(rows):
+    # competition ranking: tied players share a rank
+    out = []
+    for i, (stats, profile) in enumerate(rows):
+        if out and stats.best_score == out[-1]['best_score']:
+            rank = out[-1]['rank']
+        else:
+            rank = i + 1
+        out.append(_entry(rank, stats, profile))
+    return out
+
+
+def top(limit):
+    key = ('global', limit)
+    page = _pages.get(key)
+    if page is None:
+        rows = (db.session.query(PlayerStats, UserProfile)
+                .join(UserProfile, UserProfile.id == PlayerStats.user_id)
+                .order_by(PlayerStats.best_score.desc(), PlayerStats.user_id)
+                .limit(limit).all())
+        page = _ranked(rows)
+        _pages.set(key, page)
+    return page
+
+
+def rank_of(uid):
+    """The caller's global position, or None if they have no games yet."""
+    row = (db.session.query(PlayerStats, UserProfile)
+           .join(UserProfile, UserProfile.id == PlayerStats.user_id)
+           .filter(UserProfile.uid == uid).first())
+    if row is None:
+        return None
+    stats, profile = row
+    # whole buckets above the caller's come from the histogram; only their own bucket is counted
+    mine = player_stats.bucket_for(stats.best_score)
+    buckets = (db.select(db.func.coalesce(db.func.sum(ScoreBucket.players), 0))
+               .where(ScoreBucket.bucket > mine).scalar_subquery())
+    same = db.select(db.func.count()).select_from(PlayerStats).where(PlayerStats.best_score > stats.best_score)
+    if mine < player_stats.HISTOGRAM_BUCKETS - 1:
+        same = same.where(PlayerStats.best_score < mine + 1)
+    above = db.session.execute(db.select(buckets + same.scalar_subquery())).scalar()
+    return _entry(above + 1, stats, profile)
+
+
+def friends(uid, friend_uids, limit):
+    key = ('friends', uid, limit)
+    page = _pages.get(key)
+    if page is None:
+        uids = list(friend_uids) + [uid]
+        rows = (db.session.query(PlayerStats, UserProfile)
+                .join(UserProfile, UserProfile.id == PlayerStats.user_id)
+                .filter(UserProfile.uid.in_(uids))
+                .order_by(PlayerStats.best_score.desc(), PlayerStats.user_id)
+                .limit(limit).all())
+        page = _ranked(rows)
+        _pages.set(key, page)
+    return page
@@ -0,0 +1,259 @@
+"""Random-opponent matchmaking.
+
+`POST /multiplayer/queue` stores a ticket in matchmaking_tickets with the
+player's skill: their recent average score (PlayerStats.recent_avg, folded
+from every GameRecord), or Config.MATCHMAKING_DEFAULT_SKILL for new players.
+Every process that serves requests runs a MatchmakingService thread
+(started by app.start_background) which re-reads the waiting tickets on each step, feeds the
+ones it has not seen into an in-memory Matchmaker and claims the pairs it finds
+with a conditional UPDATE, so two workers never use the same ticket. A
+claimed pair enqueues a `create_match` job (app/games.py) in the same
+transaction, which creates the game node like an accepted invite.
+
+The Matchmaker keeps waiting tickets in skill buckets; a bisect over the
+occupied buckets finds the nearest opponent in O(log n). A ticket accepts an
+opponent within its window, which starts at MATCHMAKING_BASE_GAP points and
+widens by MATCHMAKING_GAP_PER_SECOND while it waits, so nobody waits long
+for a perfect match.
+"""
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from . import db, jobs, rtdb
+from .config import Config
+from .models import MatchTicket, PlayerStats, UserProfile
+
+
+class Ticket:
+    __slots__ = ('uid', 'skill', 'enqueued_at', 'ref')
+
+    def __init__(self, uid, skill, enqueued_at, ref=None):
+        self.uid = uid
+        self.skill = skill
+        self.enqueued_at = enqueued_at
+        # matchmaking_tickets.id, when the ticket came from the database
+        self.ref = ref
+
+
+class Matchmaker:
+    """Waiting tickets in skill buckets, oldest first within a bucket."""
+
+    def __init__(self, base_gap=None, gap_per_second=None, max_gap=None, max_wait=None, bucket_width=1.0):
+        self.base_gap = Config.MATCHMAKING_BASE_GAP if base_gap is None else base_gap
+        self.gap_per_second = Config.MATCHMAKING_GAP_PER_SECOND if gap_per_second is None else gap_per_second
+        self.max_gap = Config.MATCHMAKING_MAX_GAP if max_gap is None else max_gap
+        self.max_wait = Config.MATCHMAKING_MAX_WAIT_SECONDS if max_wait is None else max_wait
+        self.bucket_width = bucket_width
+        self._buckets = {}
+        self._occupied = []
+        self._tickets = OrderedDict()
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def __contains__(self, uid):
+        return uid in self._tickets
+
+    def __iter__(self):
+        return iter(list(self._tickets.values()))
+
+    def _bucket(self, skill):
+        return int(math.floor(skill / self.bucket_width))
+
+    def window(self, ticket, now):
+        """Largest skill gap `ticket` accepts after waiting until `now`."""
+        return min(self.max_gap, self.base_gap + self.gap_per_second * max(0.0, now - ticket.enqueued_at))
+
+    def _add(self, ticket):
+        b = self._bucket(ticket.skill)
+        bucket = self._buckets.get(b)
+        if bucket is None:
+            bucket = self._buckets[b] = OrderedDict()
+            insort(self._occupied, b)
+        bucket[ticket.uid] = ticket
+        self._tickets[ticket.uid] = ticket
+
+    def remove(self, uid):
+        ticket = self._tickets.pop(uid, None)
+        if ticket is None:
+            return None
+        b = self._bucket(ticket.skill)
+        bucket = self._buckets[b]
+        del bucket[uid]
+        if not bucket:
+            del self._buckets[b]
+            del self._occupied[bisect_left(self._occupied, b)]
+        return ticket
+
+    def _nearest(self, ticket, limit):
+        """The closest waiting ticket within `limit` skill points (oldest first in a bucket), or None."""
+        home = self._bucket(ticket.skill)
+        right = bisect_left(self._occupied, home)
+        left = right - 1
+        # buckets are visited in order of distance until they are too far to hold a match
+        reach = int(math.ceil(limit / self.bucket_width)) + 1
+        while True:
+            lb = self._occupied[left] if left >= 0 else None
+            rb = self._occupied[right] if right < len(self._occupied) else None
+            if lb is not None and home - lb > reach:
+                lb = None
+            if rb is not None and rb - home > reach:
+                rb = None
+            if lb is None and rb is None:
+                return None
+            if rb is None or (lb is not None and home - lb < rb - home):
+                b, left = lb, left - 1
+            else:
+                b, right = rb, right + 1
+            for other in self._buckets[b].values():
+                if other.uid != ticket.uid and abs(other.skill - ticket.skill) <= limit:
+                    return other
+
+    def offer(self, ticket, now):
+        """Match `ticket` with a waiting opponent (returned as (older, newer)) or start it waiting."""
+        if ticket.uid in self._tickets:
+            return None
+        other = self._nearest(ticket, self.window(ticket, now))
+        if other is None:
+            self._add(ticket)
+            return None
+        self.remove(other.uid)
+        return other, ticket
+
+    def sweep(self, now):
+        """Pair tickets whose windows have widened since they arrived, oldest first.
+
+        Returns (matches, expired): expired tickets waited longer than max_wait and are dropped.
+        """
+        matches, expired = [], []
+        for uid in list(self._tickets):
+            ticket = self._tickets.get(uid)
+            if ticket is None:
+                continue
+            if self.max_wait and now - ticket.enqueued_at > self.max_wait:
+                expired.append(self.remove(uid))
+                continue
+            other = self._nearest(ticket, self.window(ticket, now))
+            if other is not None:
+                self.remove(uid)
+                self.remove(other.uid)
+                matches.append((ticket, other))
+        return matches, expired
+
+
+def skill_of(uid):
+    row = db.session.execute(select(PlayerStats.recent_avg).join(UserProfile, UserProfile.id == PlayerStats.user_id)
+                             .where(UserProfile.uid == uid)).first()
+    return row.recent_avg if row is not None and row.recent_avg is not None else Config.MATCHMAKING_DEFAULT_SKILL
+
+
+def _epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+class MatchmakingService:
+    """Feeds waiting tickets from the database into a Matchmaker and records its matches."""
+
+    def __init__(self, matchmaker=None):
+        self.matchmaker = matchmaker or Matchmaker()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+
+    def wake(self):
+        self._wake.set()
+
+    def _load_waiting(self):
+        """Bring the Matchmaker in line with the waiting tickets in the database; returns the ones it lacks."""
+        rows = db.session.execute(select(MatchTicket.id, MatchTicket.uid, MatchTicket.skill, MatchTicket.created_at)
+                                  .where(MatchTicket.status == 'waiting').order_by(MatchTicket.id)).all()
+        db.session.rollback()
+        waiting = {row.uid: row.id for row in rows}
+        for ticket in self.matchmaker:
+            # cancelled, expired, matched by another worker, or replaced by a re-queue
+            if waiting.get(ticket.uid) != ticket.ref:
+                self.matchmaker.remove(ticket.uid)
+        return [Ticket(row.uid, row.skill, _epoch(row.created_at), ref=row.id) for row in rows
+                if row.uid not in self.matchmaker]
+
+    def _claim(self, a, b):
+        """Mark both tickets matched and enqueue the game in the current transaction.
+
+        Returns False, changing nothing, if either was taken or cancelled meanwhile.
+        """
+        game_id = rtdb.push_key()
+        now = datetime.utcnow()
+        done = []
+        for ticket, other in ((a, b), (b, a)):
+            claimed = db.session.execute(
+                update(MatchTicket).where(MatchTicket.id == ticket.ref, MatchTicket.status == 'waiting')
+                .values(status='matched', game_id=game_id, opponent_uid=other.uid, matched_at=now)).rowcount
+            if not claimed:
+                # undo only this pair, so the step's other claims still commit together
+                for t in done:
+                    db.session.execute(update(MatchTicket).where(MatchTicket.id == t.ref, MatchTicket.game_id == game_id)
+                                       .values(status='waiting', game_id=None, opponent_uid=None, matched_at=None))
+                return False
+            done.append(ticket)
+        # the ticket that waited longer picks the reference image
+        jobs.enqueue('create_match', {'game_id': game_id, 'player_a': a.uid, 'player_b': b.uid},
+                     dedupe_key=f'match:{game_id}')
+        return True
+
+    def step(self, now=None):
+        """Take in new tickets, pair what can be paired and record it. Returns the number of games created."""
+        with self._lock:
+            now = time.time() if now is None else now
+            pending = []
+            for ticket in self._load_waiting():
+                match = self.matchmaker.offer(ticket, now)
+                if match:
+                    pending.append(match)
+            matches, expired = self.matchmaker.sweep(now)
+            pending.extend(matches)
+            if self.matchmaker.max_wait:
+                # by age in the database too, so tickets expire even if no matcher has them in memory
+                cutoff = datetime.utcnow() - timedelta(seconds=self.matchmaker.max_wait)
+                db.session.execute(update(MatchTicket).where(MatchTicket.status == 'waiting',
+                                                             MatchTicket.created_at < cutoff)
+                                   .values(status='expired'))
+            if expired:
+                db.session.execute(update(MatchTicket).where(MatchTicket.id.in_([t.ref for t in expired]),
+                                                             MatchTicket.status == 'waiting')
+                                   .values(status='expired'))
+            created = 0
+            for a, b in pending:
+                # a pair whose claim fails was taken or cancelled elsewhere; the next step reloads what still waits
+                if self._claim(a, b):
+                    created += 1
+            # one commit for the whole step: every claimed pair and its create_match job
+            db.session.commit()
+            return created
+
+    def run(self, app, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    self.step()
+            except Exception:
+                app.logger.exception('matchmaking step failed')
+            self._wake.wait(Config.MATCHMAKING_POLL_SECONDS)
+
+    def start(self, app):
+        """Start this process's matchmaking thread (once)."""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self.run, args=(app,), name='matchmaking', daemon=True).start()
+
+
+service = MatchmakingService()
@@ -0,0 +1,172 @@
+"""Prometheus metrics for routes, SQL and Firebase calls, served at GET /metrics.
+
+Every request records its latency and status under its Flask endpoint
+('api.list_friends', ...), plus how many SQL statements it ran and how long
+they and its Firebase calls took, so a slow route can be pinned on the
+database, Firebase or the route itself. Firebase calls are also counted and
+timed per operation (verify_id_token, get_users, rtdb_get, ...) wherever
+they happen, including in job workers.
+
+Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a fresh
+directory before the workers start: each worker then writes its samples to
+memory-mapped files there and /metrics sums every worker's files, whichever
+worker serves the scrape.
+"""
+import hmac
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .config import Config
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram('drawmaster_request_duration_seconds', 'Time to produce a response, by endpoint',
+                            ['endpoint', 'method'], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('drawmaster_requests_total', 'Responses by endpoint and status', ['endpoint', 'method', 'status'])
+REQUEST_QUERIES = Histogram('drawmaster_request_sql_queries', 'SQL statements run per request',
+                            ['endpoint'], buckets=QUERY_COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram('drawmaster_request_sql_seconds', 'Time spent in SQL per request',
+                                ['endpoint'], buckets=LATENCY_BUCKETS)
+REQUEST_FIREBASE_SECONDS = Histogram('drawmaster_request_firebase_seconds', 'Time spent in Firebase calls per request',
+                                     ['endpoint'], buckets=LATENCY_BUCKETS)
+FIREBASE_SECONDS = Histogram('drawmaster_firebase_call_duration_seconds', 'Firebase call latency by operation',
+                             ['operation'], buckets=LATENCY_BUCKETS)
+FIREBASE_CALLS = Counter('drawmaster_firebase_calls_total', 'Firebase calls by operation and outcome',
+                         ['operation', 'outcome'])
+
+
+# per-request totals; a ContextVar read is much cheaper than going through flask.g on every statement
+_current = ContextVar('drawmaster_request_metrics', default=None)
+# labelled children are looked up once per label set, not on every observation
+_route_children = {}
+_status_children = {}
+_firebase_children = {}
+
+
+class _Totals:
+    __slots__ = ('started', 'queries', 'sql_seconds', 'firebase_seconds', 'recorded')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.firebase_seconds = 0.0
+        self.recorded = False
+
+
+def _firebase_metrics(operation, outcome):
+    key = (operation, outcome)
+    children = _firebase_children.get(key)
+    if children is None:
+        children = _firebase_children[key] = (FIREBASE_SECONDS.labels(operation), FIREBASE_CALLS.labels(operation, outcome))
+    return children
+
+
+@contextmanager
+def firebase_call(operation):
+    """Time one Firebase call: `with metrics.firebase_call('rtdb_get'): ...`."""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = time.perf_counter() - started
+        seconds, calls = _firebase_metrics(operation, outcome)
+        seconds.observe(elapsed)
+        calls.inc()
+        totals = _current.get()
+        if totals is not None:
+            totals.firebase_seconds += elapsed
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the execution context, which is dropped with the statement even when it raises
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    # statements outside a request (job workers, pollers) are not attributed to any route
+    totals = _current.get()
+    if totals is not None and started is not None:
+        totals.queries += 1
+        totals.sql_seconds += time.perf_counter() - started
+
+
+def _before_request():
+    _current.set(_Totals())
+
+
+def _record(status):
+    totals = _current.get()
+    if totals is None or totals.recorded:
+        return
+    totals.recorded = True
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method
+    children = _route_children.get((endpoint, method))
+    if children is None:
+        children = _route_children[(endpoint, method)] = (
+            REQUEST_SECONDS.labels(endpoint, method), REQUEST_QUERIES.labels(endpoint),
+            REQUEST_SQL_SECONDS.labels(endpoint), REQUEST_FIREBASE_SECONDS.labels(endpoint))
+    key = (endpoint, method, status)
+    counter = _status_children.get(key)
+    if counter is None:
+        counter = _status_children[key] = REQUESTS.labels(endpoint, method, str(status))
+    seconds, queries, sql_seconds, firebase_seconds = children
+    seconds.observe(time.perf_counter() - totals.started)
+    counter.inc()
+    queries.observe(totals.queries)
+    sql_seconds.observe(totals.sql_seconds)
+    firebase_seconds.observe(totals.firebase_seconds)
+
+
+def _after_request(response):
+    # a streamed response is measured up to its headers; the stream itself is not timed
+    _record(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    if exc is not None:
+        _record(500)
+    _current.set(None)
+
+
+def _registry():
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_view():
+    # private unless a scraper token is configured
+    token = Config.METRICS_TOKEN
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                            f'Bearer {token}'.encode()):
+        return {'error': 'forbidden'}, 403
+    return generate_latest(_registry()), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def init_app(app):
+    if not Config.METRICS_ENABLED:
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_execute):
+        # every engine, including the ones Flask-SQLAlchemy creates lazily per app
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,5 +1,6 @@
 from datetime import datetime
 from . import db
+from .config import Config
 
 class UserProfile(db.Model):
     __tablename__ = 'user_profiles'
@@ -16,8 +17,14 @@ class UserProfile(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+# Friend and FriendRequest are the legacy relationship tables. They are no longer
+# written by the API (see Friendship) and are kept only until every worker runs
+# the new code and `flask friendships backfill` has copied any late rows.
 class Friend(db.Model):
     __tablename__ = 'friends'
+    __table_args__ = (
+        db.Index('uq_friends_user_friend', 'user_id', 'friend_uid', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user_profiles.id'), nullable=False)
     friend_uid = db.Column(db.String(128), nullable=False)
@@ -25,6 +32,10 @@ class Friend(db.Model):
 
 class FriendRequest(db.Model):
     __tablename__ = 'friend_requests'
+    __table_args__ = (
+        db.Index('ix_friend_requests_to_status', 'to_uid', 'status'),
+        db.Index('ix_friend_requests_from_to', 'from_uid', 'to_uid'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     from_uid = db.Column(db.String(128), nullable=False)
     to_uid = db.Column(db.String(128), nullable=False)
@@ -42,9 +53,191 @@ class FriendRequest(db.Model):
             'responded_at': self.responded_at.isoformat() if self.responded_at else None,
         }
 
+class Friendship(db.Model):
+    """One row per pair of users, keyed by the ordered (user_low, user_high) uids.
+
+    `status` is 'pending' or 'accepted'; `requested_by` records who sent the
+    request, so the row also carries the direction of a pending request.
+    """
+    __tablename__ = 'friendships'
+    __table_args__ = (
+        db.UniqueConstraint('user_low', 'user_high', name='uq_friendships_pair'),
+        db.Index('ix_friendships_low_status', 'user_low', 'status'),
+        db.Index('ix_friendships_high_status', 'user_high', 'status'),
+        # new ids start above a range kept free for legacy request ids (see the f6a7b8c9d0e1 migration)
+        {'sqlite_autoincrement': True},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_low = db.Column(db.String(128), nullable=False)
+    user_high = db.Column(db.String(128), nullable=False)
+    status = db.Column(db.String(32), nullable=False, default='pending')
+    requested_by = db.Column(db.String(128), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    responded_at = db.Column(db.DateTime, nullable=True)
+
+    def other(self, uid):
+        return self.user_high if uid == self.user_low else self.user_low
+
+    def to_dict(self):
+        # same shape FriendRequest.to_dict() used to return
+        return {
+            'id': self.id,
+            'from_uid': self.requested_by,
+            'to_uid': self.other(self.requested_by),
+            'status': self.status,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'responded_at': self.responded_at.isoformat() if self.responded_at else None,
+        }
+
+
+# whether `games` is partitioned, as the migrations do on MySQL only
+PARTITIONED_GAMES = Config.SQLALCHEMY_DATABASE_URI.startswith('mysql')
+
+
 class GameRecord(db.Model):
+    """One recorded game. Rows older than Config.HISTORY_RAW_DAYS are rolled up; see app/history.py."""
     __tablename__ = 'games'
+    __table_args__ = (
+        # a player's history, bounded to the months asked for
+        db.Index('ix_games_user_month', 'user_id', 'month', 'created_at'),
+        # the roll-up's scan for rows past the cutoff
+        db.Index('ix_games_month', 'month', 'created_at'),
+    )
+    # on MySQL the table is partitioned by month (migration b4c5d6e7f8a9), which requires the
+    # primary key (id, month) and no foreign keys; ids stay unique on their own. SQLite keeps
+    # `id` alone as its rowid key, so it can still assign ids.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, *(() if PARTITIONED_GAMES else (db.ForeignKey('user_profiles.id'),)),
+                        nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # yyyymm of created_at, the partition key
+    month = db.Column(db.Integer, primary_key=PARTITIONED_GAMES, autoincrement=False, nullable=False)
+
+
+class GameDailyRollup(db.Model):
+    """A player's games on one UTC day, once their raw rows have been rolled up."""
+    __tablename__ = 'game_daily_rollups'
+    user_id = db.Column(db.Integer, db.ForeignKey('user_profiles.id'), primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    games_count = db.Column(db.Integer, nullable=False, default=0)
+    total_score = db.Column(db.Float, nullable=False, default=0)
+    best_score = db.Column(db.Float, nullable=False, default=0)
+
+
+class DirectoryUser(db.Model):
+    """Local mirror of Firebase Auth user records (uid -> email/display name)."""
+    __tablename__ = 'user_directory'
+    id = db.Column(db.Integer, primary_key=True)
+    uid = db.Column(db.String(128), unique=True, nullable=False)
+    email = db.Column(db.String(320), index=True)
+    display_name = db.Column(db.String(128))
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class PlayerStats(db.Model):
+    """Per-player score aggregates, updated in the same transaction as each game."""
+    __tablename__ = 'player_stats'
+    __table_args__ = (
+        db.Index('ix_player_stats_best', 'best_score', 'user_id'),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('user_profiles.id'), primary_key=True, autoincrement=False)
+    best_score = db.Column(db.Float, nullable=False, default=0)
+    total_score = db.Column(db.Float, nullable=False, default=0)
+    games_count = db.Column(db.Integer, nullable=False, default=0)
+    # exponentially weighted average of recent scores, for the trend in /profiles/me/stats
+    recent_avg = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ScoreBucket(db.Model):
+    """Number of players whose best score falls in each 0-100 bucket."""
+    __tablename__ = 'score_histogram'
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    players = db.Column(db.Integer, nullable=False, default=0)
+
+
+class GameIngestKey(db.Model):
+    """Client-supplied idempotency keys for recorded games, one per (user, key)."""
+    __tablename__ = 'game_ingest_keys'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'client_key', name='uq_game_ingest_keys_user_key'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user_profiles.id'), nullable=False)
-    score = db.Column(db.Float, nullable=False)
+    client_key = db.Column(db.String(128), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Job(db.Model):
+    """Durable background work item; see app/jobs.py."""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.UniqueConstraint('dedupe_key', name='uq_jobs_dedupe_key'),
+        # workers claim the oldest due job of a status
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        # the retention purge finds finished jobs by age
+        db.Index('ix_jobs_status_finished_at', 'status', 'finished_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # at most one job per key is ever enqueued, e.g. 'finalize:<game_id>'
+    dedupe_key = db.Column(db.String(191), nullable=True)
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class StateDocument(db.Model):
+    """One JSON subtree of multiplayer state ('games/<id>', 'invites/<uid>') for the sql GameStateStore."""
+    __tablename__ = 'state_documents'
+    key = db.Column(db.String(191), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    # bumped on every write; updates are conditional on the version that was read
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class MatchTicket(db.Model):
+    """A player waiting for a random opponent; see app/matchmaking.py."""
+    __tablename__ = 'matchmaking_tickets'
+    __table_args__ = (
+        db.UniqueConstraint('uid', name='uq_matchmaking_tickets_uid'),
+        # matchers re-read the waiting tickets on every step and expire them by age
+        db.Index('ix_matchmaking_tickets_status_created_at', 'status', 'created_at'),
+        # a re-queued player's new ticket must not reuse the old id, or matchers would keep the stale one
+        {'sqlite_autoincrement': True},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    uid = db.Column(db.String(128), nullable=False)
+    skill = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='waiting')  # waiting, matched, cancelled, expired
+    game_id = db.Column(db.String(64), nullable=True)
+    opponent_uid = db.Column(db.String(128), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    matched_at = db.Column(db.DateTime, nullable=True)
+
+
+class ArchivedGame(db.Model):
+    """A finished or abandoned multiplayer game, moved out of the game state store by app/sweeper.py."""
+    __tablename__ = 'archived_games'
+    __table_args__ = (
+        db.UniqueConstraint('game_id', name='uq_archived_games_game_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    game_id = db.Column(db.String(64), nullable=False)
+    outcome = db.Column(db.String(16), nullable=False)  # finished, abandoned
+    players = db.Column(db.Integer, nullable=False, default=0)
+    winner_uid = db.Column(db.String(128), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # the whole game node as it was last seen: players, submissions, results
+    data = db.Column(db.Text, nullable=False)
@@ -0,0 +1,295 @@
+"""Opt-in wall-clock sampling profiler for individual requests.
+
+A request is profiled when a random draw falls under Config.PROFILE_SAMPLE_RATE,
+or when it carries `X-Profile-Token: <PROFILE_TOKEN>`. While it runs, one
+sampler thread per process records the request's stack every
+PROFILE_INTERVAL_MS, including while it waits on a socket, so database,
+token verification and RTDB time all show up. Under gevent the sampler is a
+real OS thread and reads the request greenlet's own frame when it is parked.
+
+Each trace is written to PROFILE_DIR as `<id>.folded` (collapsed stacks, one
+`frame;frame;... count` line per stack, for flamegraph.pl or speedscope) and
+`<id>.json` (route, status, duration and time per category). Only the newest
+PROFILE_MAX_TRACES traces are kept. `GET /debug/profiles` lists them.
+"""
+import hmac
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from flask import current_app, request
+from .config import Config
+
+# leaf-to-root: the first frame from one of these files decides where a sample's time went
+CATEGORIES = (
+    ('sql', ('sqlalchemy/', 'pymysql/', 'sqlite3/')),
+    # game state not served by SQL: the Realtime Database (or MemoryStore in tests and benchmarks)
+    ('rtdb', ('firebase_admin/db.py', 'app/gamestate.py')),
+    # not google/auth/transport: every Firebase HTTP call, RTDB included, goes through it
+    ('auth', ('firebase_admin/_token_gen.py', 'firebase_admin/_auth_client.py', 'firebase_admin/_user_mgt.py',
+              'firebase_admin/auth.py', 'google/oauth2/')),
+    ('scoring', ('app/scoring.py', 'app/embeddings.py')),
+)
+
+
+def _category(frames):
+    for frame in frames:
+        filename = frame.f_code.co_filename.replace(os.sep, '/')
+        for name, markers in CATEGORIES:
+            if any(m in filename for m in markers):
+                return name
+    return 'app'
+
+
+def _label(code):
+    parts = code.co_filename.replace(os.sep, '/').rsplit('/', 2)
+    return f'{code.co_name} ({"/".join(parts[-2:])}:{code.co_firstlineno})'
+
+
+class Trace:
+    def __init__(self, thread_id, greenlet=None):
+        self.thread_id = thread_id
+        self.greenlet = greenlet
+        self.started = time.perf_counter()
+        self.stacks = {}
+        self.categories = {}
+        self.samples = 0
+
+    def frame(self, frames):
+        # a parked greenlet keeps its frame; a running one is its thread's current frame
+        if self.greenlet is not None and self.greenlet.gr_frame is not None:
+            return self.greenlet.gr_frame
+        return frames.get(self.thread_id)
+
+    def sample(self, frame):
+        chain = []
+        while frame is not None:
+            chain.append(frame)
+            frame = frame.f_back
+        key = ';'.join(_label(f.f_code) for f in reversed(chain))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        category = _category(chain)
+        self.categories[category] = self.categories.get(category, 0) + 1
+        self.samples += 1
+
+
+class Sampler:
+    """One OS thread sampling every active trace each `interval` seconds; it exits after a second idle."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._running = False
+        # a real lock even under gevent: the sampler thread takes it too
+        self._lock = _os_lock()
+
+    def start(self, trace):
+        with self._lock:
+            self._active[id(trace)] = trace
+            if not self._running:
+                self._running = True
+                _start_os_thread(self._run)
+
+    def stop(self, trace):
+        with self._lock:
+            self._active.pop(id(trace), None)
+
+    def _run(self):
+        sleep = _os_sleep()
+        idle = 0.0
+        while True:
+            sleep(self.interval)
+            with self._lock:
+                traces = list(self._active.values())
+                if not traces:
+                    idle += self.interval
+                    if idle >= 1.0:
+                        self._running = False
+                        return
+                    continue
+            idle = 0.0
+            frames = sys._current_frames()
+            for trace in traces:
+                frame = trace.frame(frames)
+                if frame is not None:
+                    trace.sample(frame)
+
+
+def _gevent_monkey():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey if monkey is not None and monkey.is_module_patched('threading') else None
+
+
+def _start_os_thread(fn):
+    # under gevent `threading` makes greenlets, which would only run when the request yields
+    monkey = _gevent_monkey()
+    if monkey is not None:
+        monkey.get_original('_thread', 'start_new_thread')(fn, ())
+    else:
+        import threading
+        threading.Thread(target=fn, name='profile-sampler', daemon=True).start()
+
+
+def _os_sleep():
+    monkey = _gevent_monkey()
+    return monkey.get_original('time', 'sleep') if monkey is not None else time.sleep
+
+
+def _os_lock():
+    monkey = _gevent_monkey()
+    if monkey is not None:
+        return monkey.get_original('_thread', 'allocate_lock')()
+    import threading
+    return threading.Lock()
+
+
+def _os_thread_id():
+    monkey = _gevent_monkey()
+    if monkey is not None:
+        return monkey.get_original('_thread', 'get_ident')()
+    import threading
+    return threading.get_ident()
+
+
+def _current_greenlet():
+    if _gevent_monkey() is None:
+        return None
+    from greenlet import getcurrent
+    return getcurrent()
+
+
+_sampler = None
+
+
+def _get_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = Sampler(Config.PROFILE_INTERVAL_MS / 1000)
+    return _sampler
+
+
+def _wanted():
+    if request.path.startswith('/debug/'):
+        # reading traces must not rotate them away
+        return None
+    if authorized():
+        return 'header'
+    if Config.PROFILE_SAMPLE_RATE > 0 and random.random() < Config.PROFILE_SAMPLE_RATE:
+        return 'rate'
+    return None
+
+
+def _write(trace, reason, status):
+    elapsed_ms = (time.perf_counter() - trace.started) * 1000
+    now = datetime.utcnow()
+    endpoint = request.endpoint or 'unmatched'
+    trace_id = f'{now:%Y%m%dT%H%M%S%f}-{os.getpid()}-{endpoint.replace(".", "_")}'
+    per_sample_ms = elapsed_ms / trace.samples if trace.samples else 0.0
+    meta = {
+        'id': trace_id,
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.path,
+        'status': status,
+        'reason': reason,
+        'startedAt': now.isoformat(),
+        'durationMs': round(elapsed_ms, 2),
+        'samples': trace.samples,
+        # samples are evenly spaced, so a category's share of them is its share of the request
+        'categoriesMs': {k: round(v * per_sample_ms, 2) for k, v in sorted(trace.categories.items())},
+    }
+    os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+    base = os.path.join(Config.PROFILE_DIR, trace_id)
+    with open(base + '.folded', 'w', encoding='utf-8') as f:
+        for stack, count in sorted(trace.stacks.items()):
+            f.write(f'{stack} {count}\n')
+    # the .json is written last: listing only picks up complete traces
+    with open(base + '.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    _rotate()
+
+
+def _rotate():
+    names = sorted(n for n in os.listdir(Config.PROFILE_DIR) if n.endswith('.json'))
+    for name in names[:max(0, len(names) - Config.PROFILE_MAX_TRACES)]:
+        for suffix in ('.json', '.folded'):
+            try:
+                os.remove(os.path.join(Config.PROFILE_DIR, name[:-len('.json')] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def recent(limit, min_ms=0.0):
+    """Metadata of the newest traces that took at least `min_ms`, newest first."""
+    if not os.path.isdir(Config.PROFILE_DIR):
+        return []
+    out = []
+    for name in sorted((n for n in os.listdir(Config.PROFILE_DIR) if n.endswith('.json')), reverse=True):
+        try:
+            with open(os.path.join(Config.PROFILE_DIR, name), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            # rotated away by another worker meanwhile
+            continue
+        if meta['durationMs'] >= min_ms:
+            out.append(meta)
+            if len(out) >= limit:
+                break
+    return out
+
+
+def folded_path(trace_id):
+    """Path of a trace's collapsed stacks, or None when `trace_id` is unknown."""
+    if not trace_id or '/' in trace_id or '\\' in trace_id or trace_id.startswith('.'):
+        return None
+    path = os.path.join(Config.PROFILE_DIR, trace_id + '.folded')
+    return path if os.path.exists(path) else None
+
+
+def _before_request():
+    reason = _wanted()
+    if reason is None:
+        return
+    trace = Trace(_os_thread_id(), _current_greenlet())
+    request.environ['drawmaster.profile'] = (trace, reason)
+    _get_sampler().start(trace)
+
+
+def _finish(status):
+    entry = request.environ.pop('drawmaster.profile', None)
+    if entry is None:
+        return
+    trace, reason = entry
+    _get_sampler().stop(trace)
+    try:
+        _write(trace, reason, status)
+    except OSError:
+        current_app.logger.exception('failed writing profile trace')
+
+
+def _after_request(response):
+    # like the metrics, a streamed response is profiled up to its headers
+    _finish(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    if exc is not None:
+        _finish(500)
+
+
+def authorized():
+    """Whether the request carries PROFILE_TOKEN; compared in constant time."""
+    token = request.headers.get('X-Profile-Token')
+    return bool(Config.PROFILE_TOKEN) and token is not None and hmac.compare_digest(token.encode(),
+                                                                                     Config.PROFILE_TOKEN.encode())
+
+
+def init_app(app):
+    if Config.PROFILE_SAMPLE_RATE <= 0 and not Config.PROFILE_TOKEN:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
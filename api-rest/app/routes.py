@@ -1,12 +1,17 @@
 import io
+import math
 import os
-from flask import Blueprint, current_app, request, jsonify, g
+import base64
+from flask import Blueprint, current_app, request, jsonify, g, url_for
 from . import db
-from .models import UserProfile, Friend, GameRecord
-from .auth import requires_auth, init_firebase, firebase_auth
-from firebase_admin import db as firebase_db
-from .models import FriendRequest
-from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from .models import UserProfile, DirectoryUser, MatchTicket
+from .auth import requires_auth, firebase_auth
+from . import (blobstore, directory, embeddings, events, friendships, games, gamestate, history, jobs, leaderboard,
+               matchmaking, profiling, scoring, stats, vector_index)
+from datetime import date, datetime, timedelta, timezone
 from .config import Config
 
 bp = Blueprint('api', __name__)
@@ -43,23 +48,176 @@ def get_my_profile():
     return jsonify(profile.to_dict())
 
 
+@bp.route('/profiles/me/stats', methods=['GET'])
+@requires_auth
+def get_my_stats():
+    uid = g.user.get('uid')
+    return jsonify(stats.summary(uid))
+
+
+@bp.route('/profiles/me/games', methods=['GET'])
+@requires_auth
+def get_my_games():
+    # raw games only exist for HISTORY_RAW_DAYS; older ones are in /profiles/me/history
+    days = max(1, min(request.args.get('days', 30, type=int), Config.HISTORY_RAW_DAYS))
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    uid = g.user.get('uid')
+    return jsonify({'games': history.recent_games(uid, days, limit), 'days': days})
+
+
+@bp.route('/profiles/me/history', methods=['GET'])
+@requires_auth
+def get_my_history():
+    today = datetime.utcnow().date()
+    try:
+        last = date.fromisoformat(request.args['to']) if request.args.get('to') else today
+        first = date.fromisoformat(request.args['from']) if request.args.get('from') else last - timedelta(days=29)
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD dates'}), 400
+    if first > last:
+        return jsonify({'error': 'from must not be after to'}), 400
+    if (last - first).days >= history.MAX_HISTORY_DAYS:
+        return jsonify({'error': f'at most {history.MAX_HISTORY_DAYS} days per request'}), 400
+    days, totals = history.daily(g.user.get('uid'), first, last)
+    return jsonify({'from': first.isoformat(), 'to': last.isoformat(), 'days': days, 'totals': totals})
+
+
 @bp.route('/games', methods=['POST'])
 @requires_auth
 def post_game():
     data = request.json or {}
+    key = data.get('key')
+    # optional client idempotency key so a retried request is not counted twice
+    if key is not None:
+        error = _key_error(key)
+        if error:
+            return jsonify({'error': error}), 400
+    score, error = _parse_score(data.get('score', 0))
+    if error:
+        return jsonify({'error': error}), 400
     uid = g.user.get('uid')
-    profile = UserProfile.query.filter_by(uid=uid).first()
-    if not profile:
-        profile = UserProfile(uid=uid)
-        db.session.add(profile)
-        db.session.commit()
-    score = float(data.get('score', 0))
-    game = GameRecord(user_id=profile.id, score=score)
-    db.session.add(game)
-    db.session.commit()
+    profile = stats.get_or_create_profile(uid)
+    try:
+        game = stats.record_game(profile, score, key=key)
+        if game is not None:
+            db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if key is None:
+            raise
+        # a concurrent request with the same key claimed it first
+        game = None
+    if game is None:
+        db.session.rollback()
+        return jsonify({'status': 'duplicate', 'key': key}), 200
     return jsonify({'id': game.id, 'score': game.score, 'created_at': game.created_at.isoformat()}), 201
 
 
+def _parse_score(value):
+    """A client score as a float, or an error: it must be a finite number from 0 to stats.MAX_SCORE."""
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None, 'score must be a number'
+    if not math.isfinite(score) or not 0 <= score <= stats.MAX_SCORE:
+        return None, f'score must be a finite number from 0 to {stats.MAX_SCORE}'
+    return score, None
+
+
+def _key_error(key):
+    if not isinstance(key, str) or not key or len(key) > 128:
+        return 'key must be a non-empty string of at most 128 characters'
+    if key.startswith(stats.SERVER_KEY_PREFIX):
+        return f'keys starting with {stats.SERVER_KEY_PREFIX!r} are reserved'
+    return None
+
+
+def _parse_batch_item(item):
+    if not isinstance(item, dict):
+        return None, 'item must be an object'
+    key = item.get('key')
+    error = _key_error(key)
+    if error:
+        return None, error
+    score, error = _parse_score(item.get('score'))
+    if error:
+        return None, error
+    played_at = datetime.utcnow()
+    if item.get('played_at'):
+        try:
+            when = datetime.fromisoformat(item['played_at'].replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            return None, 'played_at must be an ISO-8601 timestamp'
+        if when.tzinfo is not None:
+            when = when.astimezone(timezone.utc).replace(tzinfo=None)
+        # games can't be played in the future
+        played_at = min(when, played_at)
+    return (key, score, played_at), None
+
+
+# Games: record many results at once (offline play, client retries)
+@bp.route('/games/batch', methods=['POST'])
+@requires_auth
+def post_games_batch():
+    data = request.json or {}
+    items = data.get('games')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'games must be a non-empty list'}), 400
+    if len(items) > Config.GAMES_BATCH_MAX:
+        return jsonify({'error': f'at most {Config.GAMES_BATCH_MAX} games per batch'}), 400
+
+    results = []
+    parsed = []
+    for item in items:
+        value, error = _parse_batch_item(item)
+        if error:
+            results.append({'key': item.get('key') if isinstance(item, dict) else None, 'status': 'invalid', 'error': error})
+        else:
+            results.append({'key': value[0], 'status': None})
+            parsed.append(value)
+
+    uid = g.user.get('uid')
+    profile = stats.get_or_create_profile(uid)
+    claimed = stats.claim_keys(profile, [key for key, _, _ in parsed])
+    games = []
+    created = set()
+    for (key, score, played_at), r in zip(parsed, [r for r in results if r['status'] is None]):
+        # only the first occurrence of a newly claimed key is recorded
+        if key in claimed and key not in created:
+            created.add(key)
+            games.append((score, played_at))
+            r['status'] = 'created'
+        else:
+            r['status'] = 'duplicate'
+    stats.record_games(profile, games)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # an overlapping batch for the same player committed first; a retry reports those keys as duplicates
+        db.session.rollback()
+        return jsonify({'error': 'concurrent batch with overlapping keys, retry'}), 409
+    return jsonify({'results': results, 'created': len(games)})
+
+
+def _leaderboard_limit():
+    limit = request.args.get('limit', 10, type=int)
+    return max(1, min(limit, leaderboard.MAX_LEADERBOARD_SIZE))
+
+
+@bp.route('/leaderboard', methods=['GET'])
+@requires_auth
+def get_leaderboard():
+    uid = g.user.get('uid')
+    return jsonify({'leaderboard': leaderboard.top(_leaderboard_limit()), 'me': leaderboard.rank_of(uid)})
+
+
+@bp.route('/leaderboard/friends', methods=['GET'])
+@requires_auth
+def get_friends_leaderboard():
+    uid = g.user.get('uid')
+    return jsonify({'leaderboard': leaderboard.friends(uid, friendships.friend_uids(uid), _leaderboard_limit())})
+
+
 # Friends: send request
 @bp.route('/friends/request', methods=['POST'])
 @requires_auth
@@ -73,46 +231,18 @@ def send_friend_request():
     # If client provided an email, resolve it to a Firebase UID
     if to_email and not to_uid:
         try:
-            init_firebase()
-            user = firebase_auth.get_user_by_email(to_email)
-            to_uid = user.uid
+            to_uid = directory.resolve_email(to_email)
         except Exception as e:
             return jsonify({'error': 'user with provided email not found', 'details': str(e)}), 404
+        if not to_uid:
+            return jsonify({'error': 'user with provided email not found'}), 404
     from_uid = g.user.get('uid')
     if from_uid == to_uid:
         return jsonify({'error': 'cannot friend yourself'}), 400
 
-    # check if they are already friends (either direction)
-    from_profile = UserProfile.query.filter_by(uid=from_uid).first()
-    to_profile = UserProfile.query.filter_by(uid=to_uid).first()
-    already_friends = False
-    if from_profile:
-        existing = Friend.query.filter_by(user_id=from_profile.id, friend_uid=to_uid).first()
-        if existing:
-            already_friends = True
-    if not already_friends and to_profile:
-        existing_rev = Friend.query.filter_by(user_id=to_profile.id, friend_uid=from_uid).first()
-        if existing_rev:
-            already_friends = True
-    if already_friends:
-        return jsonify({'error': 'already friends'}), 400
-
-    # check existing pending or accepted
-    # check existing pending or accepted in same direction
-    existing = FriendRequest.query.filter_by(from_uid=from_uid, to_uid=to_uid).first()
-    if existing and existing.status == 'pending':
-        return jsonify({'error': 'request already pending'}), 400
-    if existing and existing.status == 'accepted':
-        return jsonify({'error': 'already friends'}), 400
-
-    # check if there is a pending request in the opposite direction
-    reverse = FriendRequest.query.filter_by(from_uid=to_uid, to_uid=from_uid, status='pending').first()
-    if reverse:
-        return jsonify({'error': 'friend request already exists with that person'}), 400
-
-    fr = FriendRequest(from_uid=from_uid, to_uid=to_uid, status='pending')
-    db.session.add(fr)
-    db.session.commit()
+    fr, error = friendships.send(from_uid, to_uid)
+    if error:
+        return jsonify({'error': error}), 400
     return jsonify(fr.to_dict()), 201
 
 
@@ -125,43 +255,9 @@ def accept_friend_request():
     if not req_id:
         return jsonify({'error': 'request_id required'}), 400
     uid = g.user.get('uid')
-    fr = FriendRequest.query.get(req_id)
-    if not fr:
-        return jsonify({'error': 'request not found'}), 404
-    if fr.to_uid != uid:
-        return jsonify({'error': 'not authorized to accept this request'}), 403
-    if fr.status == 'accepted':
-        return jsonify({'error': 'request already accepted'}), 400
-
-    # mark accepted
-    fr.status = 'accepted'
-    fr.responded_at = datetime.utcnow()
-
-    # ensure profiles exist
-    from_profile = UserProfile.query.filter_by(uid=fr.from_uid).first()
-    if not from_profile:
-        from_profile = UserProfile(uid=fr.from_uid)
-        db.session.add(from_profile)
-        db.session.flush()
-
-    to_profile = UserProfile.query.filter_by(uid=fr.to_uid).first()
-    if not to_profile:
-        to_profile = UserProfile(uid=fr.to_uid)
-        db.session.add(to_profile)
-        db.session.flush()
-
-    # create Friend records for both sides if not exist
-    existing_a = Friend.query.filter_by(user_id=to_profile.id, friend_uid=from_profile.uid).first()
-    if not existing_a:
-        f1 = Friend(user_id=to_profile.id, friend_uid=from_profile.uid)
-        db.session.add(f1)
-
-    existing_b = Friend.query.filter_by(user_id=from_profile.id, friend_uid=to_profile.uid).first()
-    if not existing_b:
-        f2 = Friend(user_id=from_profile.id, friend_uid=to_profile.uid)
-        db.session.add(f2)
-
-    db.session.commit()
+    fr, error = friendships.accept(req_id, uid)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
     return jsonify(fr.to_dict())
 
 
@@ -173,41 +269,79 @@ def reject_friend_request():
     if not req_id:
         return jsonify({'error': 'request_id required'}), 400
     uid = g.user.get('uid')
-    fr = FriendRequest.query.get(req_id)
-    if not fr:
-        return jsonify({'error': 'request not found'}), 404
-    if fr.to_uid != uid:
-        return jsonify({'error': 'not authorized to reject this request'}), 403
-    if fr.status != 'pending':
-        return jsonify({'error': 'request already responded'}), 400
-
-    # delete the friend request so the sender may send again later
-    db.session.delete(fr)
-    db.session.commit()
+    fr, error = friendships.reject(req_id, uid)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
     return jsonify({'status': 'deleted', 'id': req_id})
 
 
+# keyset pagination for the list endpoints: ?limit=N&after=<id of the last row seen>
+MAX_PAGE_SIZE = 200
+
+
+def _page_args():
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, after
+
+
+def _paginate(query, id_col, limit):
+    query = query.order_by(id_col)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = query.all()
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1].id
+    return rows, next_after
+
+
+def _with_user_columns(query, uid_col):
+    # join the other user's profile and directory entry so each page is a single query
+    other = aliased(UserProfile)
+    return (query
+            .outerjoin(other, other.uid == uid_col)
+            .outerjoin(DirectoryUser, DirectoryUser.uid == uid_col)
+            .add_columns(other.display_name.label('profile_name'),
+                         DirectoryUser.email.label('email'),
+                         DirectoryUser.display_name.label('directory_name'),
+                         DirectoryUser.refreshed_at.label('directory_refreshed_at')))
+
+
+def _complete_directory(rows, uids):
+    # rows whose directory entry is missing are filled in one batched call; stale ones refresh in the background
+    directory.refresh_in_background([u for r, u in zip(rows, uids)
+                                     if r.directory_refreshed_at is not None and directory.is_stale(r.directory_refreshed_at)])
+    filled = directory.fill_missing([u for r, u in zip(rows, uids) if r.directory_refreshed_at is None])
+    users = []
+    for r, u in zip(rows, uids):
+        extra = filled.get(u, {})
+        users.append({
+            'email': r.email or extra.get('email'),
+            'display_name': r.profile_name or r.directory_name or extra.get('display_name'),
+        })
+    return users
+
+
+def _list_edges(uid, status, direction=None):
+    limit, after = _page_args()
+    edges = friendships.edges(uid, status, direction, after)
+    query = db.session.query(edges.c.id, edges.c.other_uid, edges.c.created_at)
+    rows, next_after = _paginate(_with_user_columns(query, edges.c.other_uid), edges.c.id, limit)
+    return rows, _complete_directory(rows, [r.other_uid for r in rows]), next_after
+
+
 @bp.route('/friends', methods=['GET'])
 @requires_auth
 def list_friends():
     uid = g.user.get('uid')
-    profile = UserProfile.query.filter_by(uid=uid).first()
-    if not profile:
-        return jsonify({'friends': []})
-    friends = Friend.query.filter_by(user_id=profile.id).all()
-    result = []
-    for f in friends:
-        # try to include display name if profile exists
-        p = UserProfile.query.filter_by(uid=f.friend_uid).first()
-        email = None
-        try:
-            init_firebase()
-            user = firebase_auth.get_user(f.friend_uid)
-            email = user.email
-        except Exception:
-            pass
-        result.append({'friend_uid': f.friend_uid, 'email': email, 'display_name': p.display_name if p else None})
-    return jsonify({'friends': result})
+    rows, users, next_after = _list_edges(uid, 'accepted')
+    result = [{'friend_uid': r.other_uid, 'email': u['email'], 'display_name': u['display_name']}
+              for r, u in zip(rows, users)]
+    return jsonify({'friends': result, 'next_after': next_after})
 
 
 @bp.route('/friends/requests', methods=['GET'])
@@ -215,20 +349,11 @@ def list_friends():
 def list_friend_requests():
     uid = g.user.get('uid')
     # pending requests where current user is the recipient
-    reqs = FriendRequest.query.filter_by(to_uid=uid, status='pending').all()
-    out = []
-    for r in reqs:
-        p = UserProfile.query.filter_by(uid=r.from_uid).first()
-        # try to get email from Firebase as fallback
-        email = None
-        try:
-            init_firebase()
-            user = firebase_auth.get_user(r.from_uid)
-            email = user.email
-        except Exception:
-            pass
-        out.append({'id': r.id, 'from_uid': r.from_uid, 'from_email': email, 'display_name': p.display_name if p else None, 'created_at': r.created_at.isoformat() if r.created_at else None})
-    return jsonify({'requests': out})
+    rows, users, next_after = _list_edges(uid, 'pending', 'incoming')
+    out = [{'id': r.id, 'from_uid': r.other_uid, 'from_email': u['email'], 'display_name': u['display_name'],
+            'created_at': r.created_at.isoformat() if r.created_at else None}
+           for r, u in zip(rows, users)]
+    return jsonify({'requests': out, 'next_after': next_after})
 
 
 @bp.route('/friends/requests/sent', methods=['GET'])
@@ -236,19 +361,11 @@ def list_friend_requests():
 def list_sent_friend_requests():
     uid = g.user.get('uid')
     # pending requests where current user is the sender
-    reqs = FriendRequest.query.filter_by(from_uid=uid, status='pending').all()
-    out = []
-    for r in reqs:
-        p = UserProfile.query.filter_by(uid=r.to_uid).first()
-        email = None
-        try:
-            init_firebase()
-            user = firebase_auth.get_user(r.to_uid)
-            email = user.email
-        except Exception:
-            pass
-        out.append({'id': r.id, 'to_uid': r.to_uid, 'to_email': email, 'display_name': p.display_name if p else None, 'created_at': r.created_at.isoformat() if r.created_at else None})
-    return jsonify({'requests': out})
+    rows, users, next_after = _list_edges(uid, 'pending', 'outgoing')
+    out = [{'id': r.id, 'to_uid': r.other_uid, 'to_email': u['email'], 'display_name': u['display_name'],
+            'created_at': r.created_at.isoformat() if r.created_at else None}
+           for r, u in zip(rows, users)]
+    return jsonify({'requests': out, 'next_after': next_after})
 
 
 # Multiplayer: accept invite (called by the recipient)
@@ -261,13 +378,9 @@ def accept_invite():
         return jsonify({'error': 'invite_id required'}), 400
     to_uid = g.user.get('uid')
 
-    # initialize firebase admin (with RTDB)
-    init_firebase()
-
-    used_game_id = None
+    state = gamestate.get_store()
     try:
-        ref = firebase_db.reference(f"invites/{to_uid}/{invite_id}")
-        invite = ref.get()
+        invite = state.get(f'invites/{to_uid}/{invite_id}')
     except Exception as e:
         return jsonify({'error': 'failed to read invite', 'details': str(e)}), 500
 
@@ -275,34 +388,40 @@ def accept_invite():
         return jsonify({'error': 'invite not found'}), 404
 
     from_uid = invite.get('fromUid') or invite.get('fromUid')
-    # create a game entry in RTDB so both players can observe it
+    now = datetime.utcnow().isoformat()
+    # create (or join) the game and answer the invite in a single multi-location update
+    existing_game_id = invite.get('gameId')
+    if existing_game_id and invite.get('room'):
+        # a room takes players until it starts; join it, then answer the invite
+        try:
+            games.join(existing_game_id, to_uid, now)
+        except games.CannotJoin as e:
+            return jsonify({'error': str(e)}), e.status
+        except Exception as e:
+            return jsonify({'error': 'failed to join game', 'details': str(e)}), 500
+        used_game_id = existing_game_id
+        updates = {}
+    elif existing_game_id:
+        # the inviter already created the game node: add playerB and preserve other fields,
+        # unless someone else already holds that seat
+        try:
+            games.accept(existing_game_id, from_uid, to_uid, now)
+        except games.CannotJoin as e:
+            return jsonify({'error': str(e)}), e.status
+        except Exception as e:
+            return jsonify({'error': 'failed to join game', 'details': str(e)}), 500
+        used_game_id = existing_game_id
+        updates = {}
+    else:
+        used_game_id = state.push_key()
+        updates = {f'games/{used_game_id}': games.new_game(from_uid, to_uid, now)}
+    updates.update({
+        f'invites/{to_uid}/{invite_id}/status': 'accepted',
+        f'invites/{to_uid}/{invite_id}/gameId': used_game_id,
+        f'invites/{to_uid}/{invite_id}/respondedAt': now,
+    })
     try:
-        games_ref = firebase_db.reference('games')
-        # if the invite already referenced a gameId (created by the inviter), reuse it
-        existing_game_id = invite.get('gameId')
-        if existing_game_id:
-            game_ref = games_ref.child(existing_game_id)
-            # update existing game node with playerB and preserve other fields
-            game_updates = {
-                'playerB': to_uid,
-                'status': 'waiting_for_image_selection',
-                'updatedAt': datetime.utcnow().isoformat()
-            }
-            game_ref.update(game_updates)
-            used_game_id = existing_game_id
-        else:
-            new_game_ref = games_ref.push()
-            game_data = {
-                'playerA': from_uid,
-                'playerB': to_uid,
-                'status': 'waiting_for_image_selection',
-                'createdAt': datetime.utcnow().isoformat()
-            }
-            new_game_ref.set(game_data)
-            used_game_id = new_game_ref.key
-
-        # update invite with accepted status and ensure gameId is set
-        ref.update({'status': 'accepted', 'gameId': used_game_id, 'respondedAt': datetime.utcnow().isoformat()})
+        state.update('/', updates)
     except Exception as e:
         return jsonify({'error': 'failed to create game or update invite', 'details': str(e)}), 500
 
@@ -320,10 +439,9 @@ def reject_invite():
         return jsonify({'error': 'invite_id required'}), 400
     to_uid = g.user.get('uid')
 
-    init_firebase()
+    state = gamestate.get_store()
     try:
-        ref = firebase_db.reference(f"invites/{to_uid}/{invite_id}")
-        invite = ref.get()
+        invite = state.get(f'invites/{to_uid}/{invite_id}')
     except Exception as e:
         return jsonify({'error': 'failed to read invite', 'details': str(e)}), 500
 
@@ -332,112 +450,426 @@ def reject_invite():
 
     try:
         # mark as rejected so the sender can see the reply, then optionally remove
-        ref.update({'status': 'rejected', 'respondedAt': datetime.utcnow().isoformat()})
+        state.update(f'invites/{to_uid}/{invite_id}', {'status': 'rejected', 'respondedAt': datetime.utcnow().isoformat()})
     except Exception as e:
         return jsonify({'error': 'failed to update invite', 'details': str(e)}), 500
 
     return jsonify({'status': 'rejected', 'id': invite_id})
 
 
+# Multiplayer: open a room for up to maxPlayers (the caller is the host and picks the image)
+@bp.route('/multiplayer/room', methods=['POST'])
+@requires_auth
+def create_room():
+    data = request.json or {}
+    try:
+        max_players = int(data.get('maxPlayers', Config.ROOM_MAX_PLAYERS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'maxPlayers must be an integer'}), 400
+    if not 2 <= max_players <= Config.ROOM_MAX_PLAYERS:
+        return jsonify({'error': f'maxPlayers must be between 2 and {Config.ROOM_MAX_PLAYERS}'}), 400
+    state = gamestate.get_store()
+    game_id = state.push_key()
+    try:
+        state.set(f'games/{game_id}', games.new_room(g.user.get('uid'), max_players, datetime.utcnow().isoformat()))
+    except Exception as e:
+        return jsonify({'error': 'failed to create room', 'details': str(e)}), 500
+    return jsonify({'gameId': game_id, 'maxPlayers': max_players}), 201
+
+
+@bp.route('/multiplayer/game/<game_id>/join', methods=['POST'])
+@requires_auth
+def join_room(game_id):
+    try:
+        players = games.join(game_id, g.user.get('uid'), datetime.utcnow().isoformat())
+    except games.CannotJoin as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': 'failed to join game', 'details': str(e)}), 500
+    return jsonify({'status': 'joined', 'gameId': game_id, 'players': players})
+
+
+def _ticket_json(ticket):
+    if ticket is None:
+        return {'status': 'none'}
+    out = {'status': ticket.status, 'skill': round(ticket.skill, 2), 'queuedAt': ticket.created_at.isoformat()}
+    if ticket.status == 'matched':
+        out.update(gameId=ticket.game_id, opponent=ticket.opponent_uid)
+    return out
+
+
+# Multiplayer: wait for a random opponent of similar skill
+@bp.route('/multiplayer/queue', methods=['POST'])
+@requires_auth
+def join_queue():
+    uid = g.user.get('uid')
+    ticket = MatchTicket.query.filter_by(uid=uid).first()
+    if ticket is not None and ticket.status == 'waiting':
+        return jsonify(_ticket_json(ticket)), 202
+    try:
+        if ticket is not None:
+            # a finished, cancelled or expired ticket is replaced so matchers see it as new
+            db.session.delete(ticket)
+            db.session.flush()
+        ticket = MatchTicket(uid=uid, skill=matchmaking.skill_of(uid), status='waiting', created_at=datetime.utcnow())
+        db.session.add(ticket)
+        db.session.commit()
+    except IntegrityError:
+        # the same player queued twice at once
+        db.session.rollback()
+        ticket = MatchTicket.query.filter_by(uid=uid).first()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': 'failed to join queue', 'details': str(e)}), 500
+    matchmaking.service.wake()
+    return jsonify(_ticket_json(ticket)), 202
+
+
+@bp.route('/multiplayer/queue', methods=['GET'])
+@requires_auth
+def get_queue_status():
+    return jsonify(_ticket_json(MatchTicket.query.filter_by(uid=g.user.get('uid')).first()))
+
+
+@bp.route('/multiplayer/queue', methods=['DELETE'])
+@requires_auth
+def leave_queue():
+    uid = g.user.get('uid')
+    cancelled = db.session.execute(
+        update(MatchTicket).where(MatchTicket.uid == uid, MatchTicket.status == 'waiting')
+        .values(status='cancelled')).rowcount
+    db.session.commit()
+    ticket = MatchTicket.query.filter_by(uid=uid).first()
+    if not cancelled and ticket is not None and ticket.status == 'matched':
+        # too late: the game already exists
+        return jsonify(_ticket_json(ticket)), 409
+    return jsonify(_ticket_json(ticket))
+
+
 # Multiplayer: submit drawing for a game (called by either participant)
 @bp.route('/multiplayer/game/<game_id>/submit', methods=['POST'])
 @requires_auth
 def submit_game_drawing(game_id):
     data = request.json or {}
     drawing_uri = data.get('drawingUri')
-    original_uri = data.get('originalUri')
     timed_out = data.get('timedOut', False)
     provided_score = data.get('score')
 
     uid = g.user.get('uid')
     if not uid:
         return jsonify({'error': 'not authenticated'}), 403
-
-    init_firebase()
+    # scores feed the player's stats and leaderboard entry: only a player of a running game may submit
     try:
-        submissions_ref = firebase_db.reference(f'games/{game_id}/submissions')
-        # Require client to provide a numeric 'score' (computed locally). Do not compute score server-side.
-        if provided_score is None:
-            return jsonify({'error': 'score is required; compute locally and include it in the payload'}), 400
+        game = gamestate.get_store().get(f'games/{game_id}')
+    except Exception as e:
+        return jsonify({'error': 'failed to read game', 'details': str(e)}), 500
+    if not game:
+        return jsonify({'error': 'game not found'}), 404
+    if uid not in games.participants(game):
+        return jsonify({'error': 'not a player in this game'}), 403
+    if game.get('state') == 'results':
+        return jsonify({'error': 'game already finished'}), 409
+    if game.get('state') not in ('started', 'finishing'):
+        return jsonify({'error': 'game has not started'}), 409
+
+    score = None
+    scored_by = 'client'
+    # with scoring configured the server scores every drawing; a client score is never trusted then
+    if scoring.get_engine() is not None:
+        scored_by = 'server'
+        if not data.get('drawing'):
+            if not timed_out:
+                return jsonify({'error': 'drawing is required; the server scores submissions'}), 400
+            # out of time with nothing drawn, as game_timeout would record it
+            score = 0
+    if score is None and scored_by == 'server':
         try:
-            score = int(provided_score)
+            drawing_bytes = base64.b64decode(data['drawing'], validate=True)
         except Exception:
-            return jsonify({'error': 'score must be an integer'}), 400
-
-        # write this player's submission as a score-only record
-        payload = {
-            'score': score,
-            'submittedAt': datetime.utcnow().isoformat(),
-            'timedOut': bool(timed_out)
-        }
-        submissions_ref.child(uid).set(payload)
+            return jsonify({'error': 'drawing must be a base64-encoded image'}), 400
+        # score only against the game's own reference, as set_reference stored it; never a client URL
+        digest = embeddings.game_digest(game_id) or game.get('imageHash')
+        try:
+            reference = embeddings.reference(digest) if digest else None
+            if reference is None:
+                return jsonify({'error': 'game has no reference image the server can score against'}), 409
+            drawing_vector = scoring.embed_image(drawing_bytes)
+            score = scoring.score_embeddings(drawing_vector, reference)
+        except ValueError as e:
+            return jsonify({'error': 'drawing is not a readable image', 'details': str(e)}), 400
+        except Exception as e:
+            current_app.logger.exception('server-side scoring failed')
+            return jsonify({'error': 'failed to score drawing', 'details': str(e)}), 502
+        if Config.VECTOR_INDEX_DIR:
+            try:
+                vector_index.get_index('drawings').add(f'{game_id}/{uid}', drawing_vector, ref=digest, score=score, uid=uid)
+            except Exception:
+                current_app.logger.exception('failed indexing drawing')
+
+    if score is None:
+        # otherwise require client to provide a numeric 'score' (computed locally)
+        if provided_score is None:
+            return jsonify({'error': 'score is required; compute locally and include it in the payload'}), 400
+        score, error = _parse_score(provided_score)
+        if error:
+            return jsonify({'error': error}), 400
+        score = int(score)
+
+    # score-only record for this player
+    payload = {
+        'score': score,
+        'scoredBy': scored_by,
+        'submittedAt': datetime.utcnow().isoformat(),
+        'timedOut': bool(timed_out)
+    }
+    try:
+        gamestate.get_store().set(f'games/{game_id}/submissions/{uid}', payload)
     except Exception as e:
         return jsonify({'error': 'failed to write submission', 'details': str(e)}), 500
 
-    # after writing, check if there are two submissions and compute results if so
+    # results and stats are computed by the job workers; a retried submit enqueues nothing new
     try:
-        submissions = submissions_ref.get() or {}
-        # If there are at least two submissions, compute final results using stored scores only
-        if isinstance(submissions, dict) and len(submissions.keys()) >= 2:
-            uids = list(submissions.keys())
-            # gather scores from submissions (they were saved as {'score': N, ...})
-            scores_map = {}
-            for k in uids:
-                entry = submissions.get(k) or {}
-                if isinstance(entry, dict):
-                    sc = entry.get('score')
-                    try:
-                        sc_int = int(sc) if sc is not None else 0
-                    except Exception:
-                        sc_int = 0
-                else:
-                    sc_int = 0
-                scores_map[k] = sc_int
-
-            # determine winner (or None on tie)
-            sorted_items = sorted(scores_map.items(), key=lambda kv: kv[1], reverse=True)
-            winner_uid = None
-            if len(sorted_items) >= 2 and sorted_items[0][1] != sorted_items[1][1]:
-                winner_uid = sorted_items[0][0]
-
-            results = {
-                'scores': scores_map,
-                'winner': winner_uid
-            }
-            # write results and set game state
-            firebase_db.reference(f'games/{game_id}/results').set(results)
-            firebase_db.reference(f'games/{game_id}/state').set('results')
-            return jsonify({'status': 'submitted', 'results': results}), 200
+        jobs.enqueue('finalize_game', {'game_id': game_id, 'uid': uid}, dedupe_key=f'finalize:{game_id}:{uid}')
+        jobs.enqueue('record_score', {'uid': uid, 'game_id': game_id, 'score': score},
+                     dedupe_key=f'score:{game_id}:{uid}')
+        db.session.commit()
     except Exception as e:
-        # non-fatal: submission succeeded but result computation failed
-        current_app.logger.exception('failed computing results')
-        return jsonify({'status': 'submitted', 'warning': 'result computation failed', 'details': str(e)}), 200
-
+        db.session.rollback()
+        current_app.logger.exception('failed enqueueing game jobs')
+        return jsonify({'error': 'failed to queue game finalization', 'details': str(e)}), 500
     return jsonify({'status': 'submitted'})
 
 
+def _near_duplicates(digest):
+    """Hashes of earlier reference images that are visually the same picture."""
+    references = vector_index.get_index('references')
+    vector = references.vector(digest)
+    if vector is None:
+        return []
+    hits = references.search(vector, k=5, exclude={digest})
+    return [key for key, _, similarity in hits if similarity >= Config.NEAR_DUPLICATE_SIMILARITY]
 
 
 @bp.route('/multiplayer/game/<game_id>/set_reference', methods=['POST'])
 @requires_auth
 def set_reference_image(game_id):
     data = request.json or {}
+    uid = g.user.get('uid')
+    if not uid:
+        return jsonify({'error': 'not authenticated'}), 403
+    # only a player may choose the image, and only once: a new image mid-game would change every score
+    try:
+        game = gamestate.get_store().get(f'games/{game_id}')
+    except Exception as e:
+        return jsonify({'error': 'failed to read game', 'details': str(e)}), 500
+    try:
+        games.check_startable(game, uid)
+    except games.CannotStart as e:
+        return jsonify({'error': str(e)}), e.status
     image_url = data.get('imageUrl')
+    # an image uploaded through POST /images is referenced by its hash
+    image_hash = data.get('imageHash')
+    if image_hash:
+        if not blobstore.is_digest(image_hash) or not blobstore.get_store().exists(blobstore.key_for(image_hash, 'preview.jpg')):
+            return jsonify({'error': 'unknown imageHash; upload the image first'}), 400
+        image_url = url_for('api.get_image', digest=image_hash, variant='preview.jpg', _external=True)
     if not image_url:
-        return jsonify({'error': 'imageUrl is required'}), 400
+        return jsonify({'error': 'imageUrl or imageHash is required'}), 400
+
+    # embed the reference once here so every submission for this game can reuse the vector
+    digest = None
+    if scoring.get_engine() is not None:
+        try:
+            if image_hash:
+                score_bytes = blobstore.get_store().read(blobstore.key_for(image_hash, 'score.png'))
+                digest, _ = embeddings.embed_reference(score_bytes, digest=image_hash)
+            else:
+                # only from the storage hosts in SCORING_FETCH_HOSTS; anything else is not scored server-side
+                scoring.check_fetch_url(image_url)
+                digest, _ = embeddings.embed_reference(scoring.fetch_image(image_url))
+            embeddings.remember_game(game_id, digest)
+        except ValueError as e:
+            current_app.logger.info('reference image not embedded: %s', e)
+        except Exception:
+            current_app.logger.exception('failed embedding reference image')
 
-    # initialize firebase admin for RTDB access
-    init_firebase()
     try:
-        games_ref = firebase_db.reference(f'games/{game_id}')
         updates = {
             'imageUri': image_url,
             'state': 'started',
             'startedAt': datetime.utcnow().isoformat(),
             'updatedAt': datetime.utcnow().isoformat()
         }
-        games_ref.update(updates)
-        return jsonify({'status': 'ok', 'imageUrl': image_url}), 200
+        if digest:
+            updates['imageHash'] = digest
+        games.start(game_id, uid, updates)
+        # finish the game even if a player never submits
+        jobs.enqueue('game_timeout', {'game_id': game_id}, dedupe_key=f'timeout:{game_id}',
+                     delay=Config.GAME_SUBMIT_TIMEOUT_SECONDS)
+        db.session.commit()
+        resp = {'status': 'ok', 'imageUrl': image_url}
+        if digest and Config.VECTOR_INDEX_DIR:
+            resp['nearDuplicates'] = _near_duplicates(digest)
+        return jsonify(resp), 200
+    except games.CannotStart as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         current_app.logger.exception('failed updating RTDB with image url')
         return jsonify({'error': 'failed updating game node', 'details': str(e)}), 500
+
+
+def _image_urls(digest, names):
+    return {kind: url_for('api.get_image', digest=digest, variant=name, _external=True) for kind, name in names.items()}
+
+
+@bp.route('/images', methods=['POST'])
+@requires_auth
+def upload_image():
+    # raw image body, or a multipart form with a `file` field
+    if request.content_length is not None and request.content_length > Config.IMAGE_UPLOAD_MAX_BYTES + 64 * 1024:
+        # a multipart body carries a little more than the file itself
+        return jsonify({'error': 'image too large', 'max_bytes': Config.IMAGE_UPLOAD_MAX_BYTES}), 413
+    upload = request.files.get('file')
+    image_bytes = upload.read(Config.IMAGE_UPLOAD_MAX_BYTES + 1) if upload else request.get_data()
+    if not image_bytes:
+        return jsonify({'error': 'image body is required'}), 400
+    if len(image_bytes) > Config.IMAGE_UPLOAD_MAX_BYTES:
+        return jsonify({'error': 'image too large', 'max_bytes': Config.IMAGE_UPLOAD_MAX_BYTES}), 413
+    try:
+        digest, names, created = blobstore.ingest(image_bytes)
+    except (ValueError, OSError) as e:
+        return jsonify({'error': 'invalid image', 'details': str(e)}), 400
+    except Exception as e:
+        current_app.logger.exception('failed storing image')
+        return jsonify({'error': 'failed storing image', 'details': str(e)}), 500
+    return jsonify({'hash': digest, 'urls': _image_urls(digest, names)}), 201 if created else 200
+
+
+@bp.route('/images/<digest>/<variant>', methods=['GET'])
+def get_image(digest, variant):
+    # public: the 256-bit hash is the capability, and it lets image loaders fetch without a token
+    if not blobstore.is_digest(digest) or variant not in blobstore.VARIANTS:
+        return jsonify({'error': 'not found'}), 404
+    store = blobstore.get_store()
+    key = blobstore.key_for(digest, variant)
+    if not store.exists(key):
+        return jsonify({'error': 'not found'}), 404
+    resp = store.send(key, blobstore.mimetype_for(variant), etag=f'{digest}-{variant}')
+    resp.cache_control.immutable = True
+    return resp
+
+
+@bp.route('/images/<digest>/stats', methods=['GET'])
+@requires_auth
+def get_image_stats(digest):
+    if not blobstore.is_digest(digest):
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(vector_index.reference_stats(digest))
+
+
+@bp.route('/multiplayer/game/<game_id>/similar', methods=['GET'])
+@requires_auth
+def get_similar_drawings(game_id):
+    uid = g.user.get('uid')
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    try:
+        game = gamestate.get_store().get(f'games/{game_id}')
+    except Exception as e:
+        return jsonify({'error': 'failed to read game', 'details': str(e)}), 500
+    if not game:
+        return jsonify({'error': 'game not found'}), 404
+    if uid not in games.participants(game):
+        return jsonify({'error': 'not a player in this game'}), 403
+    drawings = vector_index.get_index('drawings')
+    key = f'{game_id}/{uid}'
+    vector = drawings.vector(key)
+    if vector is None:
+        return jsonify({'error': 'no server-scored drawing for this game'}), 404
+    out = []
+    for other, meta, similarity in drawings.search(vector, k=limit, exclude={key}):
+        other_game, _, other_uid = other.partition('/')
+        entry = {'score': meta.get('score'), 'similarity': round(similarity, 4), 'mine': other_uid == uid}
+        # other players' drawings are anonymous: no uid, and no game id to look them up by
+        if other_uid == uid:
+            entry['gameId'] = other_game
+        out.append(entry)
+    return jsonify({'similar': out})
+
+
+@bp.route('/multiplayer/game/<game_id>/events', methods=['GET'])
+@requires_auth
+def stream_game_events(game_id):
+    """Server-sent events for one game: state, then joined/started/submitted/results as they happen."""
+    uid = g.user.get('uid')
+    try:
+        game = gamestate.get_store().get(f'games/{game_id}')
+    except Exception as e:
+        return jsonify({'error': 'failed to read game', 'details': str(e)}), 500
+    if not game:
+        return jsonify({'error': 'game not found'}), 404
+    if uid not in games.participants(game):
+        return jsonify({'error': 'not a player in this game'}), 403
+    try:
+        sub = events.broker.subscribe(game_id)
+    except events.TooManyStreams:
+        resp = jsonify({'error': 'too many open event streams; poll the game instead'})
+        resp.headers['Retry-After'] = str(max(1, Config.SSE_RETRY_MS // 1000))
+        return resp, 503
+    except Exception as e:
+        return jsonify({'error': 'failed to watch game', 'details': str(e)}), 500
+
+    def stream():
+        try:
+            yield f'retry: {Config.SSE_RETRY_MS}\n\n'
+            while True:
+                item = sub.get(Config.SSE_HEARTBEAT_SECONDS)
+                if item is None:
+                    # keeps proxies and the client's read timeout from closing an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is events.CLOSED:
+                    return
+                name, payload = item
+                yield events.format_event(name, payload)
+                if name in ('results', 'deleted') or (name == 'state' and payload.get('results')):
+                    return
+        finally:
+            events.broker.unsubscribe(sub)
+
+    return current_app.response_class(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@bp.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+    # operators only: hidden unless the caller sends PROFILE_TOKEN
+    if not profiling.authorized():
+        return jsonify({'error': 'not found'}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 200)
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and min_ms must be numbers'}), 400
+    traces = profiling.recent(limit, min_ms)
+    if request.args.get('sort') == 'duration':
+        traces.sort(key=lambda t: t['durationMs'], reverse=True)
+    for trace in traces:
+        trace['folded'] = url_for('api.get_profile', trace_id=trace['id'], _external=True)
+    return jsonify({'traces': traces})
+
+
+@bp.route('/debug/profiles/<trace_id>', methods=['GET'])
+def get_profile(trace_id):
+    """Collapsed stacks of one trace, for flamegraph.pl or speedscope."""
+    if not profiling.authorized():
+        return jsonify({'error': 'not found'}), 404
+    path = profiling.folded_path(trace_id)
+    if path is None:
+        return jsonify({'error': 'not found'}), 404
+    with open(path, encoding='utf-8') as f:
+        return current_app.response_class(f.read(), mimetype='text/plain')
@@ -0,0 +1,62 @@
+"""Helpers for keeping Realtime Database round trips to a minimum."""
+import random
+import threading
+import time
+
+# Firebase push ids: 8 chars of timestamp + 12 random chars, lexicographically ordered by time
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+_push_lock = threading.Lock()
+_last_push_time = 0
+_last_rand_chars = [0] * 12
+
+
+def push_key():
+    """Generate a push id locally, like the client SDKs do, instead of a POST round trip."""
+    global _last_push_time
+    with _push_lock:
+        now = int(time.time() * 1000)
+        duplicate_time = now == _last_push_time
+        _last_push_time = now
+        time_chars = []
+        for _ in range(8):
+            time_chars.append(PUSH_CHARS[now % 64])
+            now //= 64
+        if not duplicate_time:
+            for i in range(12):
+                _last_rand_chars[i] = random.randrange(64)
+        else:
+            # same millisecond: increment the random part so ids stay unique and ordered
+            i = 11
+            while i >= 0 and _last_rand_chars[i] == 63:
+                _last_rand_chars[i] = 0
+                i -= 1
+            if i >= 0:
+                _last_rand_chars[i] += 1
+        return ''.join(reversed(time_chars)) + ''.join(PUSH_CHARS[c] for c in _last_rand_chars)
+
+
+def compute_results(submissions):
+    """Final scores, ranking and winner (None on a tie) from the stored submissions.
+
+    Tied players share a rank and the next rank is skipped (1, 2, 2, 4).
+    """
+    scores_map = {}
+    for k, entry in submissions.items():
+        sc_int = 0
+        if isinstance(entry, dict):
+            try:
+                sc_int = int(entry.get('score')) if entry.get('score') is not None else 0
+            except (TypeError, ValueError):
+                sc_int = 0
+        scores_map[k] = sc_int
+
+    sorted_items = sorted(scores_map.items(), key=lambda kv: (-kv[1], kv[0]))
+    winner_uid = None
+    if len(sorted_items) >= 2 and sorted_items[0][1] != sorted_items[1][1]:
+        winner_uid = sorted_items[0][0]
+    ranking = []
+    for i, (uid, sc) in enumerate(sorted_items):
+        rank = ranking[-1]['rank'] if ranking and ranking[-1]['score'] == sc else i + 1
+        ranking.append({'uid': uid, 'score': sc, 'rank': rank})
+    return {'scores': scores_map, 'winner': winner_uid, 'ranking': ranking}
@@ -0,0 +1,238 @@
+"""Server-side drawing scoring with the same MobileNetV3 model as the Android client.
+
+Images are embedded into 1024-d vectors by a micro-batching queue: concurrent
+requests are grouped into one interpreter invocation (up to
+Config.SCORING_MAX_BATCH images, waiting at most Config.SCORING_MAX_WAIT_MS
+for a batch to fill). Similarity is cosine, mapped to 0-100 exactly like
+ScoringUtil.computeScore on the client.
+
+numpy, Pillow and a TFLite runtime (ai-edge-litert or tflite-runtime) are
+only needed when Config.SCORING_MODEL_PATH is set.
+"""
+import io
+import ipaddress
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+import requests
+from .config import Config
+
+EMBEDDING_SIZE = 1024
+INPUT_SIZE = 224
+# batches are padded up to one of these sizes so each size keeps its own allocated interpreter
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class ScoringUnavailable(Exception):
+    pass
+
+
+def _interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tensorflow.lite import Interpreter
+        return Interpreter
+    except ImportError:
+        raise ScoringUnavailable('no TFLite runtime installed (pip install ai-edge-litert)')
+
+
+def _run_native(fn):
+    """Run CPU-heavy native code (decoding, inference); under gevent workers, on a real
+    thread so the event loop keeps serving other requests meanwhile."""
+    import sys
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn)
+    return fn()
+
+
+def preprocess(image_bytes):
+    """Decode an image into the model input: RGB 224x224, scaled to [-1, 1].
+
+    Raises ValueError for bytes that are not a readable image.
+    """
+    import numpy as np
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img = img.convert('RGB').resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR)
+            pixels = np.asarray(img, dtype=np.float32)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise ValueError(str(e))
+    return (pixels - 127.5) / 127.5
+
+
+def similarity_to_score(similarity):
+    """Vectorized version of the client mapping: clamp to [0, 1], x100 x2, truncate, cap at 100.
+
+    Done in float32 like the Kotlin code so boundary values round the same way.
+    """
+    import numpy as np
+    clipped = np.clip(np.asarray(similarity, dtype=np.float32), np.float32(0), np.float32(1))
+    scores = (clipped * np.float32(100) * np.float32(2)).astype(np.int64)
+    return np.minimum(scores, 100)
+
+
+def cosine_similarity(a, b):
+    """Row-wise cosine similarity of two (n, d) arrays."""
+    import numpy as np
+    a = np.atleast_2d(a)
+    b = np.atleast_2d(b)
+    dot = np.einsum('ij,ij->i', a, b)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0)
+
+
+class BatchingEmbedder:
+    """Collects embedding requests from many threads and runs them in batches on one worker thread."""
+
+    def __init__(self, model_path, max_batch=16, max_wait_ms=5, num_threads=None):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.num_threads = num_threads
+        self._interpreter_cls = _interpreter_class()
+        self._interpreters = {}
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        self._worker = threading.Thread(target=self._run, name='scoring-embedder', daemon=True)
+        self._worker.start()
+
+    def submit(self, pixels):
+        """Queue one preprocessed image; the returned Future resolves to its embedding."""
+        future = Future()
+        self._queue.put((pixels, future))
+        return future
+
+    def embed(self, pixels, timeout=None):
+        return self.submit(pixels).result(timeout)
+
+    def _interpreter(self, size):
+        interpreter = self._interpreters.get(size)
+        if interpreter is None:
+            interpreter = self._interpreter_cls(model_path=self.model_path, num_threads=self.num_threads)
+            index = interpreter.get_input_details()[0]['index']
+            interpreter.resize_tensor_input(index, [size, INPUT_SIZE, INPUT_SIZE, 3])
+            interpreter.allocate_tensors()
+            self._interpreters[size] = interpreter
+        return interpreter
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        import numpy as np
+        while True:
+            batch = self._collect()
+            try:
+                size = next((s for s in BATCH_SIZES if s >= len(batch)), len(batch))
+                inputs = np.zeros((size, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+                for i, (pixels, _) in enumerate(batch):
+                    inputs[i] = pixels
+                interpreter = self._interpreter(size)
+                interpreter.set_tensor(interpreter.get_input_details()[0]['index'], inputs)
+                _run_native(interpreter.invoke)
+                outputs = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+                self.batches += 1
+                self.images += len(batch)
+                for i, (_, future) in enumerate(batch):
+                    future.set_result(outputs[i].copy())
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def get_engine():
+    """The process-wide embedder, or None when server-side scoring is not configured."""
+    global _engine
+    if not Config.SCORING_MODEL_PATH:
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = BatchingEmbedder(Config.SCORING_MODEL_PATH, max_batch=Config.SCORING_MAX_BATCH,
+                                           max_wait_ms=Config.SCORING_MAX_WAIT_MS, num_threads=Config.SCORING_THREADS)
+    return _engine
+
+
+def check_fetch_url(url):
+    """Raise ValueError unless `url` is https on an allowed storage host that resolves only to public addresses."""
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if parts.scheme != 'https' or host not in Config.SCORING_FETCH_HOSTS:
+        raise ValueError('image URL must be https on one of SCORING_FETCH_HOSTS')
+    try:
+        infos = socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError) as e:
+        raise ValueError(f'cannot resolve {host}: {e}')
+    for info in infos:
+        # no private, loopback or link-local (instance metadata) targets, whatever DNS says
+        if not ipaddress.ip_address(info[4][0].split('%', 1)[0]).is_global:
+            raise ValueError(f'{host} resolves to a non-public address')
+
+
+def fetch_image(url):
+    """Download an image from an allowed host, refusing anything larger than Config.SCORING_MAX_IMAGE_BYTES."""
+    check_fetch_url(url)
+    # no redirects: they could lead off the allowed hosts
+    with requests.get(url, timeout=Config.SCORING_FETCH_TIMEOUT, stream=True, allow_redirects=False) as resp:
+        resp.raise_for_status()
+        if resp.is_redirect:
+            raise ValueError('image URL redirects')
+        data = io.BytesIO()
+        for chunk in resp.iter_content(64 * 1024):
+            data.write(chunk)
+            if data.tell() > Config.SCORING_MAX_IMAGE_BYTES:
+                raise ValueError('image too large')
+    return data.getvalue()
+
+
+def embed_image(image_bytes):
+    engine = get_engine()
+    if engine is None:
+        raise ScoringUnavailable('server-side scoring is not configured')
+    pixels = _run_native(lambda: preprocess(image_bytes))
+    return engine.embed(pixels, timeout=Config.SCORING_TIMEOUT)
+
+
+def score_embeddings(drawing, reference):
+    return int(similarity_to_score(cosine_similarity(drawing, reference))[0])
+
+
+def score_images(drawing_bytes, reference_bytes):
+    """Score a drawing against its reference image (0-100)."""
+    engine = get_engine()
+    if engine is None:
+        raise ScoringUnavailable('server-side scoring is not configured')
+    # both images go into the queue together so they can share a batch
+    futures = [engine.submit(preprocess(drawing_bytes)), engine.submit(preprocess(reference_bytes))]
+    drawing, reference = (f.result(Config.SCORING_TIMEOUT) for f in futures)
+    return score_embeddings(drawing, reference)
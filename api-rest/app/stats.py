@@ -0,0 +1,182 @@
+"""Incrementally maintained per-player aggregates and the global score histogram.
+
+Every recorded game updates the player's player_stats row and moves the player
+between score_histogram buckets when their best score changes, so stats and
+percentiles are read in constant time without scanning the games table.
+"""
+import math
+from datetime import datetime
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from . import db, history
+from .models import GameRecord, GameIngestKey, PlayerStats, ScoreBucket, UserProfile
+
+# scores from the client scorer are bounded to 0-100: one bucket per integer score
+HISTOGRAM_BUCKETS = 101
+MAX_SCORE = HISTOGRAM_BUCKETS - 1
+# weight of the newest game in the recent average (roughly the last ten games)
+RECENT_WEIGHT = 0.2
+# idempotency keys the server records for multiplayer scores; clients may not use them
+SERVER_KEY_PREFIX = 'mp:'
+
+
+def bucket_for(score):
+    return int(math.floor(min(MAX_SCORE, max(0, score))))
+
+
+def clean_score(score):
+    """`score` clamped to 0-MAX_SCORE, or None when it is not a finite number.
+
+    Routes reject such scores with a 400; this keeps anything that gets past
+    them (a job payload, a script) out of the aggregates, where one NaN or
+    huge value would skew averages and the leaderboard for good.
+    """
+    try:
+        score = float(score)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(score):
+        return None
+    return min(float(MAX_SCORE), max(0.0, score))
+
+
+def get_or_create_profile(uid):
+    profile = UserProfile.query.filter_by(uid=uid).first()
+    if not profile:
+        profile = UserProfile(uid=uid)
+        db.session.add(profile)
+        db.session.flush()
+    return profile
+
+
+def _move_player(old_bucket, new_bucket):
+    if old_bucket == new_bucket:
+        return
+    if old_bucket is not None:
+        # the player was counted there, so the row exists
+        db.session.execute(update(ScoreBucket).where(ScoreBucket.bucket == old_bucket).values(players=ScoreBucket.players - 1))
+    add = update(ScoreBucket).where(ScoreBucket.bucket == new_bucket).values(players=ScoreBucket.players + 1)
+    if db.session.execute(add).rowcount:
+        return
+    # the migration seeds every bucket, but a schema built another way starts empty
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(ScoreBucket).values(bucket=new_bucket, players=1))
+    except IntegrityError:
+        # another transaction created the bucket meanwhile
+        db.session.execute(add)
+
+
+def _locked_stats(profile):
+    return db.session.query(PlayerStats).filter_by(user_id=profile.id).with_for_update().first()
+
+
+def _fold(profile, scores):
+    """Fold scores (oldest first) into player_stats and the histogram."""
+    stats = _locked_stats(profile)
+    old_bucket = None
+    if stats is None:
+        stats = PlayerStats(user_id=profile.id, best_score=scores[0], total_score=0, games_count=0)
+        try:
+            with db.session.begin_nested():
+                db.session.add(stats)
+        except IntegrityError:
+            # the player's first game is being recorded concurrently and that one committed first
+            stats = _locked_stats(profile)
+    if stats.games_count:
+        old_bucket = bucket_for(stats.best_score)
+    for score in scores:
+        stats.total_score += score
+        stats.games_count += 1
+        stats.best_score = max(stats.best_score, score)
+        if stats.recent_avg is None:
+            stats.recent_avg = score
+        else:
+            stats.recent_avg += RECENT_WEIGHT * (score - stats.recent_avg)
+    stats.updated_at = datetime.utcnow()
+    _move_player(old_bucket, bucket_for(stats.best_score))
+    return stats
+
+
+def claim_keys(profile, keys):
+    """Record idempotency keys for a player and return the ones not seen before."""
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return set()
+    existing = {k for (k,) in db.session.query(GameIngestKey.client_key)
+                .filter(GameIngestKey.user_id == profile.id, GameIngestKey.client_key.in_(keys))}
+    new = [k for k in keys if k not in existing]
+    if new:
+        now = datetime.utcnow()
+        db.session.execute(insert(GameIngestKey), [{'user_id': profile.id, 'client_key': k, 'created_at': now} for k in new])
+    return set(new)
+
+
+def record_game(profile, score, key=None):
+    """Insert a game and fold it into the aggregates. The caller commits.
+
+    Returns None if `key` was already recorded for this player. Raises ValueError
+    for a score that is not a finite number; others are clamped to 0-MAX_SCORE.
+    """
+    cleaned = clean_score(score)
+    if cleaned is None:
+        raise ValueError(f'score must be a finite number, got {score!r}')
+    score = cleaned
+    if key is not None and not claim_keys(profile, [key]):
+        return None
+    now = datetime.utcnow()
+    game = GameRecord(user_id=profile.id, score=score, created_at=now, month=history.month_of(now))
+    db.session.add(game)
+    _fold(profile, [score])
+    return game
+
+
+def record_games(profile, games):
+    """Bulk-insert (score, played_at) pairs in one statement and fold them in. The caller commits.
+
+    Scores are clamped like record_game's; pairs whose score is not a finite number are skipped.
+    """
+    games = [(clean_score(score), played_at) for score, played_at in games]
+    games = sorted(((score, played_at) for score, played_at in games if score is not None), key=lambda item: item[1])
+    if not games:
+        return
+    # games played before the raw window (offline play uploaded late) go straight into the roll-ups
+    before = history.cutoff()
+    old = [g for g in games if g[1] < before]
+    raw = [g for g in games if g[1] >= before]
+    if old:
+        history.add_rolled_up(profile.id, old)
+    if raw:
+        db.session.execute(insert(GameRecord), [{'user_id': profile.id, 'score': score, 'created_at': played_at,
+                                                 'month': history.month_of(played_at)} for score, played_at in raw])
+    _fold(profile, [score for score, _ in games])
+
+
+def percentile(best_score):
+    """Percentile rank of a best score among all players (ties count half)."""
+    counts = dict(db.session.query(ScoreBucket.bucket, ScoreBucket.players))
+    total = sum(counts.values())
+    if not total:
+        return None
+    mine = bucket_for(best_score)
+    below = sum(n for b, n in counts.items() if b < mine)
+    return round(100.0 * (below + 0.5 * counts.get(mine, 0)) / total, 2)
+
+
+def summary(uid):
+    row = (db.session.query(PlayerStats)
+           .join(UserProfile, UserProfile.id == PlayerStats.user_id)
+           .filter(UserProfile.uid == uid).first())
+    if row is None or not row.games_count:
+        return {'games_played': 0, 'mean': None, 'best': None, 'recent_avg': None, 'trend': None, 'percentile': None}
+    mean = row.total_score / row.games_count
+    recent = row.recent_avg if row.recent_avg is not None else mean
+    return {
+        'games_played': row.games_count,
+        'mean': round(mean, 2),
+        'best': row.best_score,
+        'recent_avg': round(recent, 2),
+        # positive when recent games score above the player's overall mean
+        'trend': round(recent - mean, 2),
+        'percentile': percentile(row.best_score),
+    }
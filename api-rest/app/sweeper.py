@@ -0,0 +1,271 @@
+"""Garbage collection of finished games and answered invites in the game state store.
+
+Nothing in the multiplayer flow deletes state: invites are only marked
+accepted/rejected and finished games keep their submissions and results, so
+the `games` and `invites/<uid>` trees, and every client listener on them,
+would grow without bound. `sweep()` pages through them by key and
+  - archives games finished SWEEP_FINISHED_GAME_SECONDS ago, and games with no
+    activity for SWEEP_ABANDONED_GAME_SECONDS, into archived_games, then
+    deletes their nodes;
+  - deletes invites answered SWEEP_INVITE_SECONDS ago, and pending ones past
+    their expiresAt (or SWEEP_PENDING_INVITE_SECONDS old when they have none);
+  - deletes `matchmaking/<uid>` notices older than SWEEP_INVITE_SECONDS.
+
+Deletes go out as multi-path updates of at most SWEEP_BATCH_SIZE paths, no
+faster than SWEEP_MAX_DELETES_PER_SECOND. A batch's archive rows commit
+before its nodes are deleted, archiving skips games already archived, and
+a batch whose games are not all in archived_games afterwards is not
+deleted, so an interrupted sweep loses nothing and the next one finishes it.
+
+The `sweep_game_state` job runs it every SWEEP_INTERVAL_SECONDS; `flask
+sweeper run --dry-run` reports what a sweep would remove.
+"""
+import json
+import time
+from datetime import datetime, timezone
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import db, gamestate, games, jobs
+from .config import Config
+from .models import ArchivedGame
+
+EPOCH = datetime(1970, 1, 1)
+# how many paths a dry run lists
+DRY_RUN_SAMPLE = 20
+
+
+def _seconds(value):
+    """Epoch seconds of a stored timestamp: ISO-8601 from the server, epoch milliseconds from the app."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value / 1000
+    if isinstance(value, str):
+        try:
+            when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if when.tzinfo is not None:
+            when = when.astimezone(timezone.utc).replace(tzinfo=None)
+        return (when - EPOCH).total_seconds()
+    return None
+
+
+def _datetime(value):
+    seconds = _seconds(value)
+    return datetime.utcfromtimestamp(seconds) if seconds is not None else None
+
+
+def last_activity(game):
+    """Epoch seconds of the latest timestamp anywhere in a game node, or None when it has none."""
+    stamps = [game.get(k) for k in ('createdAt', 'updatedAt', 'startedAt', 'finishedAt')]
+    for section, field in (('players', 'joinedAt'), ('submissions', 'submittedAt')):
+        entries = game.get(section)
+        if isinstance(entries, dict):
+            stamps.extend(e.get(field) for e in entries.values() if isinstance(e, dict))
+    seconds = [s for s in map(_seconds, stamps) if s is not None]
+    return max(seconds) if seconds else None
+
+
+def game_outcome(game, now):
+    """'finished' or 'abandoned' when a game node is due for archiving at epoch `now`, else None."""
+    if not isinstance(game, dict):
+        return None
+    last = last_activity(game)
+    if last is None:
+        # nothing says how old it is; leave it alone
+        return None
+    if game.get('state') == 'results':
+        finished = _seconds(game.get('finishedAt')) or last
+        return 'finished' if now - finished >= Config.SWEEP_FINISHED_GAME_SECONDS else None
+    return 'abandoned' if now - last >= Config.SWEEP_ABANDONED_GAME_SECONDS else None
+
+
+def invite_due(invite, now):
+    """True when an invite has been answered, or has expired, long enough ago to delete."""
+    if not isinstance(invite, dict):
+        return False
+    status = invite.get('status') or 'pending'
+    if status != 'pending':
+        answered = _seconds(invite.get('respondedAt')) or _seconds(invite.get('createdAt'))
+        return answered is not None and now - answered >= Config.SWEEP_INVITE_SECONDS
+    expires = _seconds(invite.get('expiresAt'))
+    if expires is not None:
+        return now >= expires
+    created = _seconds(invite.get('createdAt'))
+    return created is not None and now - created >= Config.SWEEP_PENDING_INVITE_SECONDS
+
+
+def _archive_row(game_id, game, outcome, archived_at):
+    results = game.get('results') if isinstance(game.get('results'), dict) else {}
+    return {
+        'game_id': game_id,
+        'outcome': outcome,
+        'players': len(games.participants(game)),
+        'winner_uid': results.get('winner'),
+        'created_at': _datetime(game.get('createdAt')),
+        'finished_at': _datetime(game.get('finishedAt')),
+        'archived_at': archived_at,
+        'data': json.dumps(game, sort_keys=True),
+    }
+
+
+class _Throttle:
+    """Spaces out batches so no more than `rate` paths are deleted per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_at = time.monotonic()
+
+    def wait(self, paths):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(now, self.next_at) + paths / self.rate
+
+
+class Sweep:
+    """One pass over the store; `stats` says what it archived and deleted (or would have, on a dry run)."""
+
+    def __init__(self, store=None, now=None, dry_run=False, batch_size=None, rate=None, limit=None):
+        self.store = store or gamestate.get_store()
+        self.now = time.time() if now is None else now
+        self.dry_run = dry_run
+        self.batch_size = max(1, batch_size or Config.SWEEP_BATCH_SIZE)
+        self.limit = Config.SWEEP_MAX_DELETES_PER_RUN if limit is None else limit
+        self.throttle = _Throttle(Config.SWEEP_MAX_DELETES_PER_SECOND if rate is None else rate)
+        self.stats = {'games_scanned': 0, 'games_archived': 0, 'invites_scanned': 0, 'invites_deleted': 0,
+                      'notices_deleted': 0, 'batches': 0}
+        self.sample = []
+        self._paths = []
+        self._archive = []
+        self._deleted = 0
+
+    def full(self):
+        return bool(self.limit) and self._deleted + len(self._paths) >= self.limit
+
+    def _delete(self, path, archive=None):
+        self._paths.append(path)
+        if archive is not None:
+            self._archive.append(archive)
+        if len(self.sample) < DRY_RUN_SAMPLE:
+            self.sample.append(path)
+        if len(self._paths) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._paths:
+            return
+        if not self.dry_run:
+            self.throttle.wait(len(self._paths))
+            if self._archive:
+                self._store_archive()
+            self.store.update('/', {path: None for path in self._paths})
+        self.stats['batches'] += 1
+        self._deleted += len(self._paths)
+        self._paths, self._archive = [], []
+
+    def _store_archive(self):
+        """Commit the batch's archive rows, or raise before any of its games are deleted."""
+        # archived before deleted; a game archived by an earlier, interrupted sweep is skipped.
+        # duplicates only: INSERT IGNORE / OR IGNORE would also swallow NOT NULL, truncation or bad-value errors
+        dialect = db.engine.dialect.name
+        if dialect == 'mysql':
+            stmt = mysql_insert(ArchivedGame).on_duplicate_key_update(game_id=ArchivedGame.game_id)
+        elif dialect == 'sqlite':
+            stmt = sqlite_insert(ArchivedGame).on_conflict_do_nothing(index_elements=['game_id'])
+        else:
+            stmt = insert(ArchivedGame)
+        db.session.execute(stmt, self._archive)
+        ids = [row['game_id'] for row in self._archive]
+        archived = db.session.execute(
+            select(func.count()).select_from(ArchivedGame).where(ArchivedGame.game_id.in_(ids))).scalar()
+        if archived != len(ids):
+            db.session.rollback()
+            raise RuntimeError(f'archived {archived} of {len(ids)} games; not deleting the batch')
+        db.session.commit()
+
+    def _scan(self, path, visit):
+        cursor = None
+        while not self.full():
+            page = self.store.children(path, start_after=cursor, limit=self.batch_size)
+            if not page:
+                return
+            for key, value in page:
+                if self.full():
+                    return
+                if value is not None:
+                    visit(key, value)
+            cursor = page[-1][0]
+
+    def _game(self, game_id, game):
+        self.stats['games_scanned'] += 1
+        outcome = game_outcome(game, self.now)
+        if outcome is not None:
+            self.stats['games_archived'] += 1
+            archived_at = datetime.utcfromtimestamp(self.now)
+            self._delete(f'games/{game_id}', _archive_row(game_id, game, outcome, archived_at))
+
+    def _invites(self, uid, invites):
+        if not isinstance(invites, dict):
+            return
+        for invite_id, invite in invites.items():
+            self.stats['invites_scanned'] += 1
+            if invite_due(invite, self.now):
+                self.stats['invites_deleted'] += 1
+                self._delete(f'invites/{uid}/{invite_id}')
+
+    def _notice(self, uid, notice):
+        matched = _seconds(notice.get('matchedAt')) if isinstance(notice, dict) else None
+        if matched is not None and self.now - matched >= Config.SWEEP_INVITE_SECONDS:
+            self.stats['notices_deleted'] += 1
+            self._delete(f'matchmaking/{uid}')
+
+    def run(self):
+        self._scan('games', self._game)
+        self._scan('invites', self._invites)
+        self._scan('matchmaking', self._notice)
+        self.flush()
+        return self.stats
+
+
+def sweep(**options):
+    """Archive and delete what is due in the game state store; returns the counts."""
+    return Sweep(**options).run()
+
+
+def schedule(now=None):
+    """Enqueue the next periodic sweep unless a worker already has; the caller commits."""
+    jobs.schedule_periodic('sweep_game_state', Config.SWEEP_INTERVAL_SECONDS, now)
+
+
+@jobs.handler('sweep_game_state')
+def sweep_job(slot):
+    with jobs.rescheduling(schedule):
+        sweep()
+
+
+@click.group('sweeper')
+def cli():
+    """Game state garbage collection."""
+
+
+@cli.command('run')
+@click.option('--dry-run', is_flag=True, help='report what would be archived and deleted, change nothing')
+@click.option('--batch-size', type=int, default=None, help='paths per multi-path delete')
+@click.option('--rate', type=float, default=None, help='deletes per second (0 = unlimited)')
+@click.option('--limit', type=int, default=None, help='deletes in this run (0 = unlimited)')
+@with_appcontext
+def run_command(dry_run, batch_size, rate, limit):
+    """Sweep finished games, answered or expired invites and old matchmaking notices."""
+    swept = Sweep(dry_run=dry_run, batch_size=batch_size, rate=rate, limit=limit)
+    stats = swept.run()
+    click.echo(', '.join(f'{k} {v}' for k, v in stats.items()) + (' (dry run)' if dry_run else ''))
+    if dry_run:
+        for path in swept.sample:
+            click.echo(f'  {path}')
@@ -0,0 +1,354 @@
+"""Nearest-neighbour search over reference-image and drawing embeddings.
+
+Each index is a directory with an append-only float32 matrix of
+L2-normalized vectors (`vectors.f32`, memory-mapped) and one JSON line per
+row (`keys.jsonl`), so every gunicorn worker can append and pick up rows
+written by the others. Search is brute-force cosine over the matrix.
+
+For large collections, `flask vectors build <kind>` trains an
+inverted-file / product-quantization (IVF-PQ) index over the rows present at
+that point. Queries then scan only the `nprobe` closest lists using 1-byte
+codes and re-rank the best candidates exactly; rows appended after the
+build are still searched brute-force until the next build.
+"""
+import json
+import os
+import threading
+import click
+from flask.cli import with_appcontext
+from .config import Config
+from .scoring import EMBEDDING_SIZE
+
+try:
+    import fcntl
+except ImportError:
+    # Windows (the README's local quickstart): byte-range locks instead of flock
+    fcntl = None
+    import msvcrt
+
+CHUNK_ROWS = 65536
+RERANK_FACTOR = 4
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            # locks the first byte; LK_LOCK gives up after ten one-second tries, so keep waiting
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _normalize(vectors):
+    import numpy as np
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _top_k(scores, k):
+    import numpy as np
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    part = np.argpartition(-scores, k)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+def _kmeans(data, k, iters, spherical, seed=0):
+    """Plain Lloyd iterations; spherical k-means (cosine) for the coarse lists, L2 for PQ codebooks."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=len(data) < k)].copy()
+    for _ in range(iters):
+        if spherical:
+            assign = np.argmax(data @ centroids.T, axis=1)
+        else:
+            assign = np.argmin((centroids ** 2).sum(1) - 2 * data @ centroids.T, axis=1)
+        dim = data.shape[1]
+        sums = np.bincount((assign[:, None] * dim + np.arange(dim)).ravel(), weights=data.ravel(),
+                           minlength=k * dim).reshape(k, dim)
+        counts = np.bincount(assign, minlength=k)
+        # empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if spherical:
+            centroids = _normalize(centroids)
+    return centroids
+
+
+class IVFPQ:
+    """Coarse lists of 1-byte PQ codes over residuals, scored by inner product.
+
+    <q, c + r> = <q, c> + sum_m <q_m, codebook_m[code_m]>, so the lookup table
+    is built once per query rather than once per probed list.
+    """
+
+    FILES = ('centroids', 'codebooks', 'offsets', 'rows', 'codes')
+
+    def __init__(self, centroids, codebooks, offsets, rows, codes):
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.offsets = offsets
+        self.rows = rows
+        self.codes = codes
+
+    @property
+    def size(self):
+        return len(self.rows)
+
+    @classmethod
+    def train(cls, vectors, nlist, m, sample=65536, iters=10):
+        import numpy as np
+        n, dim = vectors.shape
+        if dim % m:
+            raise ValueError(f'dimension {dim} is not divisible by {m} subquantizers')
+        rng = np.random.default_rng(0)
+        train = np.asarray(vectors[np.sort(rng.choice(n, size=min(n, sample), replace=False))])
+        centroids = _kmeans(train, nlist, iters, spherical=True)
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, CHUNK_ROWS):
+            assign[start:start + CHUNK_ROWS] = np.argmax(vectors[start:start + CHUNK_ROWS] @ centroids.T, axis=1)
+        residuals = (train - centroids[np.argmax(train @ centroids.T, axis=1)]).reshape(len(train), m, dim // m)
+        # 256 centroids per subspace need far fewer training points than the coarse lists
+        residuals = residuals[:256 * 64]
+        codebooks = np.stack([_kmeans(residuals[:, s], 256, iters, spherical=False) for s in range(m)])
+
+        norms = (codebooks ** 2).sum(2)
+        codes = np.empty((n, m), dtype=np.uint8)
+        for start in range(0, n, CHUNK_ROWS):
+            chunk = np.asarray(vectors[start:start + CHUNK_ROWS])
+            res = (chunk - centroids[assign[start:start + len(chunk)]]).reshape(len(chunk), m, dim // m)
+            for s in range(m):
+                codes[start:start + len(chunk), s] = np.argmin(norms[s] - 2 * res[:, s] @ codebooks[s].T, axis=1)
+        # group rows by list so each probed list is one contiguous slice
+        rows = np.argsort(assign, kind='stable').astype(np.int32)
+        offsets = np.searchsorted(assign[rows], np.arange(nlist + 1)).astype(np.int64)
+        codes = codes[rows]
+        return cls(centroids, codebooks, offsets, rows, codes)
+
+    def save(self, directory):
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(directory, name + '.tmp.npy'), getattr(self, name))
+        for name in self.FILES:
+            os.replace(os.path.join(directory, name + '.tmp.npy'), os.path.join(directory, name + '.npy'))
+
+    @classmethod
+    def load(cls, directory):
+        import numpy as np
+        try:
+            return cls(*(np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in cls.FILES))
+        except FileNotFoundError:
+            return None
+
+    def candidates(self, query, nprobe, count):
+        """Approximate top rows for one normalized query: (rows, approximate scores)."""
+        import numpy as np
+        m, ksub, dsub = self.codebooks.shape
+        coarse = self.centroids @ query
+        lists = _top_k(coarse, nprobe)
+        lut = np.einsum('msd,md->ms', self.codebooks, query.reshape(m, dsub)).ravel()
+        shift = np.arange(m, dtype=np.intp) * ksub
+        rows, scores = [], []
+        for l in lists:
+            lo, hi = self.offsets[l], self.offsets[l + 1]
+            if lo == hi:
+                continue
+            codes = np.asarray(self.codes[lo:hi], dtype=np.intp)
+            scores.append(coarse[l] + lut[codes + shift].sum(1))
+            rows.append(self.rows[lo:hi])
+        if not rows:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        best = _top_k(scores, count)
+        return rows[best], scores[best]
+
+
+class VectorIndex:
+    def __init__(self, directory, dim=EMBEDDING_SIZE, on_entry=None):
+        self.directory = directory
+        self.dim = dim
+        self.on_entry = on_entry
+        self.keys = []
+        self.meta = []
+        self.rows = {}
+        self.ivf = None
+        self._vectors = None
+        self._keys_offset = 0
+        self._ivf_mtime = None
+        self._lock = threading.RLock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __len__(self):
+        self._refresh()
+        return len(self.keys)
+
+    def _refresh(self):
+        """Pick up rows appended by this or other processes since the last call."""
+        import numpy as np
+        with self._lock:
+            try:
+                size = os.path.getsize(self._path('keys.jsonl'))
+            except OSError:
+                size = 0
+            if size != self._keys_offset:
+                with open(self._path('keys.jsonl'), 'rb') as f:
+                    f.seek(self._keys_offset)
+                    data = f.read()
+                # only consume complete lines; a writer may be mid-append
+                data = data[:data.rfind(b'\n') + 1]
+                self._keys_offset += len(data)
+                for line in data.splitlines():
+                    entry = json.loads(line)
+                    key = entry.pop('key')
+                    self.rows[key] = len(self.keys)
+                    self.keys.append(key)
+                    self.meta.append(entry)
+                    if self.on_entry:
+                        self.on_entry(key, entry)
+                self._vectors = None
+            if self._vectors is None and self.keys:
+                self._vectors = np.memmap(self._path('vectors.f32'), dtype=np.float32, mode='r',
+                                          shape=(len(self.keys), self.dim))
+            try:
+                mtime = os.path.getmtime(self._path(os.path.join('ivfpq', 'codes.npy')))
+            except OSError:
+                mtime = None
+            if mtime != self._ivf_mtime:
+                self._ivf_mtime = mtime
+                self.ivf = IVFPQ.load(self._path('ivfpq')) if mtime else None
+
+    def add(self, key, vector, **meta):
+        """Append one vector; keys already in the index are ignored. Returns True if added."""
+        self._refresh()
+        if key in self.rows:
+            return False
+        vector = _normalize(vector)[0]
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self._path('keys.jsonl'), 'ab') as keys_file:
+            # the key line is the commit point: vectors are written first, under a cross-process lock
+            _lock_file(keys_file)
+            try:
+                self._refresh()
+                if key in self.rows:
+                    return False
+                with open(self._path('vectors.f32'), 'r+b' if os.path.exists(self._path('vectors.f32')) else 'wb') as f:
+                    f.seek(len(self.keys) * self.dim * 4)
+                    f.write(vector.tobytes())
+                    f.truncate()
+                keys_file.write((json.dumps({'key': key, **meta}) + '\n').encode())
+                keys_file.flush()
+            finally:
+                _unlock_file(keys_file)
+        self._refresh()
+        return True
+
+    def vector(self, key):
+        self._refresh()
+        row = self.rows.get(key)
+        return None if row is None else self._vectors[row]
+
+    def search(self, vector, k=10, exclude=(), nprobe=None):
+        """Top-k (key, meta, cosine similarity), best first."""
+        import numpy as np
+        self._refresh()
+        with self._lock:
+            vectors, ivf, n = self._vectors, self.ivf, len(self.keys)
+        if not n:
+            return []
+        query = _normalize(vector)[0]
+        want = k + len(exclude)
+        rows, scores = [], []
+        start = 0
+        if ivf is not None and ivf.size <= n:
+            cand, _ = ivf.candidates(query, nprobe or Config.VECTOR_INDEX_NPROBE, want * RERANK_FACTOR)
+            cand = np.sort(cand)
+            rows.append(cand)
+            scores.append(vectors[cand] @ query)
+            start = ivf.size
+        for lo in range(start, n, CHUNK_ROWS):
+            sims = vectors[lo:min(n, lo + CHUNK_ROWS)] @ query
+            best = _top_k(sims, want)
+            rows.append(best + lo)
+            scores.append(sims[best])
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        out = []
+        for i in _top_k(scores, want):
+            key = self.keys[rows[i]]
+            if key not in exclude:
+                out.append((key, self.meta[rows[i]], float(scores[i])))
+        return out[:k]
+
+    def build_ivfpq(self, nlist, m):
+        self._refresh()
+        if len(self.keys) < nlist:
+            raise ValueError(f'need at least {nlist} vectors to build {nlist} lists')
+        IVFPQ.train(self._vectors, nlist, m).save(self._path('ivfpq'))
+        self._refresh()
+
+
+# per-reference aggregates of server-scored drawings, kept current as rows are loaded
+_reference_scores = {}
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _count_drawing(key, meta):
+    ref = meta.get('ref')
+    if ref and meta.get('score') is not None:
+        totals = _reference_scores.setdefault(ref, [0, 0.0])
+        totals[0] += 1
+        totals[1] += meta['score']
+
+
+def get_index(kind):
+    """'references' (keyed by image hash) or 'drawings' (keyed by '<game_id>/<uid>')."""
+    with _indexes_lock:
+        index = _indexes.get(kind)
+        if index is None:
+            index = VectorIndex(os.path.join(Config.VECTOR_INDEX_DIR, kind),
+                                on_entry=_count_drawing if kind == 'drawings' else None)
+            _indexes[kind] = index
+    return index
+
+
+def reference_stats(digest):
+    """How hard a reference image is, from the scores of drawings made of it."""
+    get_index('drawings')._refresh()
+    count, total = _reference_scores.get(digest, (0, 0.0))
+    mean = total / count if count else None
+    return {'drawings': count, 'mean_score': mean, 'difficulty': None if mean is None else round(100 - mean, 2)}
+
+
+@click.group('vectors')
+def cli():
+    """Embedding index maintenance."""
+
+
+@cli.command('build')
+@click.argument('kind', type=click.Choice(['references', 'drawings']))
+@click.option('--nlist', default=1024, show_default=True, help='number of inverted lists')
+@click.option('--subquantizers', default=64, show_default=True, help='PQ code bytes per vector')
+@with_appcontext
+def build_command(kind, nlist, subquantizers):
+    """Train an IVF-PQ index over the vectors currently in KIND."""
+    index = get_index(kind)
+    index.build_ivfpq(nlist, subquantizers)
+    click.echo(f'indexed {index.ivf.size} {kind} vectors in {nlist} lists')
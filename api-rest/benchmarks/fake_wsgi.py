@@ -0,0 +1,20 @@
+"""WSGI entry point for load tests: the real app with Firebase replaced by FakeRTDB.
+
+`gunicorn -c gunicorn.conf.py benchmarks.fake_wsgi:application`. Every
+Realtime Database round trip waits FAKE_RTDB_LATENCY_MS (default 60), which
+yields to other requests under the gevent worker exactly like a socket read.
+Requests authenticate with `Authorization: Bearer <uid>`, and FAKE_INVITES
+pending invites 'invites/u<n>/inv' are created for uids u0..u<FAKE_INVITES-1>.
+"""
+import os
+
+from app import create_app
+from benchmarks.fakes import FakeRTDB, installed
+
+application = create_app()
+rtdb = FakeRTDB(latency=float(os.getenv('FAKE_RTDB_LATENCY_MS', '60')) / 1000)
+rtdb.root = {'invites': {f'u{n}': {'inv': {'fromUid': 'host', 'status': 'pending'}}
+                         for n in range(int(os.getenv('FAKE_INVITES', '1000')))}}
+# patched for the life of the worker (keep a reference: a collected context manager would undo it)
+_fakes = installed(rtdb)
+_fakes.__enter__()
@@ -0,0 +1,261 @@
+"""In-process stand-ins for the Firebase services the API talks to.
+
+FakeRTDB mimics the parts of `firebase_admin.db` the routes use and counts
+HTTP round trips the way the real client makes them (a transaction is a GET
+plus a conditional PUT, `push()` is a POST, everything else is one request).
+`latency` adds a fixed delay per round trip to model the network.
+
+FakeAuth stands in for `firebase_admin.auth`: an ID token is the uid it
+names, and users added with `add_user` can be looked up by uid or email.
+Only the user-management calls go over the network in the real SDK, so only
+they pay `latency`; token verification is local once the certificates are
+cached.
+"""
+import copy
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+
+def _split(path):
+    return [p for p in path.strip('/').split('/') if p]
+
+
+class FakeRTDB:
+    def __init__(self, latency=0.0):
+        self.root = {}
+        self.round_trips = 0
+        # seconds added to every round trip, to stand in for the network
+        self.latency = latency
+        self.lock = threading.RLock()
+
+    def reset_counter(self):
+        self.round_trips = 0
+
+    # module-level API of firebase_admin.db
+    def reference(self, path='/', app=None, url=None):
+        return FakeReference(self, _split(path))
+
+    def _round_trip(self):
+        # called without the lock held, so concurrent requests overlap like real HTTP calls
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.round_trips += 1
+
+    def _get(self, parts):
+        node = self.root
+        for p in parts:
+            if not isinstance(node, dict) or p not in node:
+                return None
+            node = node[p]
+        return copy.deepcopy(node)
+
+    def _set(self, parts, value):
+        if not parts:
+            self.root = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        node = self.root
+        for p in parts[:-1]:
+            if not isinstance(node.get(p), dict):
+                node[p] = {}
+            node = node[p]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = copy.deepcopy(value)
+
+
+class FakeReference:
+    def __init__(self, db, parts):
+        self._db = db
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self._parts)
+
+    def child(self, path):
+        return FakeReference(self._db, self._parts + _split(path))
+
+    def get(self, etag=False, shallow=False):
+        self._db._round_trip()
+        with self._db.lock:
+            value = self._db._get(self._parts)
+        if shallow and isinstance(value, dict):
+            value = {k: True for k in value}
+        return value
+
+    def set(self, value):
+        self._db._round_trip()
+        with self._db.lock:
+            self._db._set(self._parts, value)
+
+    def update(self, value):
+        self._db._round_trip()
+        with self._db.lock:
+            for k, v in value.items():
+                self._db._set(self._parts + _split(k), v)
+
+    def delete(self):
+        self._db._round_trip()
+        with self._db.lock:
+            self._db._set(self._parts, None)
+
+    def push(self, value=''):
+        from app.rtdb import push_key
+        self._db._round_trip()
+        with self._db.lock:
+            ref = self.child(push_key())
+            self._db._set(ref._parts, value)
+        return ref
+
+    def order_by_key(self):
+        return FakeQuery(self)
+
+    def transaction(self, transaction_update):
+        # GET with ETag followed by a conditional PUT, retried if the value changed in between
+        while True:
+            self._db._round_trip()
+            with self._db.lock:
+                snapshot = self._db._get(self._parts)
+            new_value = transaction_update(copy.deepcopy(snapshot))
+            self._db._round_trip()
+            with self._db.lock:
+                if self._db._get(self._parts) == snapshot:
+                    self._db._set(self._parts, new_value)
+                    return new_value
+
+
+class FakeQuery:
+    """`reference.order_by_key()` with start_at / limit_to_first; one GET."""
+
+    def __init__(self, ref):
+        self._ref = ref
+        self._start = None
+        self._limit = None
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def limit_to_first(self, limit):
+        self._limit = limit
+        return self
+
+    def get(self):
+        self._ref._db._round_trip()
+        with self._ref._db.lock:
+            node = self._ref._db._get(self._ref._parts)
+        if not isinstance(node, dict):
+            return {}
+        keys = sorted(k for k in node if self._start is None or k >= self._start)
+        if self._limit is not None:
+            keys = keys[:self._limit]
+        return {k: node[k] for k in keys}
+
+
+class FakeInvalidIdTokenError(ValueError):
+    pass
+
+
+class FakeUserNotFoundError(Exception):
+    pass
+
+
+class FakeUidIdentifier:
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class FakeUserRecord:
+    def __init__(self, uid, email=None, display_name=None):
+        self.uid = uid
+        self.email = email
+        self.display_name = display_name
+
+
+class FakeGetUsersResult:
+    def __init__(self, users, not_found):
+        self.users = users
+        self.not_found = not_found
+
+
+class FakeAuth:
+    # the exception and identifier types the app reaches through the module
+    InvalidIdTokenError = FakeInvalidIdTokenError
+    UserNotFoundError = FakeUserNotFoundError
+    UidIdentifier = FakeUidIdentifier
+
+    def __init__(self, latency=0.0):
+        self.users = {}
+        self.calls = 0
+        # seconds added to every user-management call, to stand in for the network
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def add_user(self, uid, email=None, display_name=None):
+        with self.lock:
+            self.users[uid] = FakeUserRecord(uid, email, display_name)
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+
+    def verify_id_token(self, token, app=None, check_revoked=False):
+        if not token or token.startswith('invalid'):
+            raise FakeInvalidIdTokenError('invalid token')
+        now = int(time.time())
+        return {'uid': token, 'iat': now, 'exp': now + 3600}
+
+    def get_users(self, identifiers, app=None):
+        self._call()
+        with self.lock:
+            found = [self.users[i.uid] for i in identifiers if i.uid in self.users]
+        return FakeGetUsersResult(found, [i for i in identifiers if i.uid not in self.users])
+
+    def get_user_by_email(self, email, app=None):
+        self._call()
+        with self.lock:
+            for user in self.users.values():
+                if user.email and user.email.lower() == email.lower():
+                    return user
+        raise FakeUserNotFoundError(f'No user record found for the provided email: {email}.')
+
+
+@contextmanager
+def installed(rtdb=None, store=None, auth=None):
+    """Route the API's Firebase calls to in-process fakes.
+
+    Game state goes through `store`, or by default the firebase
+    GameStateStore backed by `rtdb`, whatever Config.GAME_STATE_BACKEND says.
+
+    Requests authenticate with `Authorization: Bearer <uid>`. Given `auth`,
+    a FakeAuth, tokens go through the real verify_token (and its cache) and
+    user lookups through `auth`; otherwise verify_token itself is replaced.
+    """
+    from app.gamestate import FirebaseStore
+    rtdb = rtdb or FakeRTDB()
+
+    def verify_token(token):
+        return {'uid': token}
+
+    with ExitStack() as stack:
+        if auth is None:
+            stack.enter_context(mock.patch('app.auth.verify_token', verify_token))
+        else:
+            for module in ('app.auth', 'app.directory'):
+                stack.enter_context(mock.patch(f'{module}.firebase_auth', auth))
+                stack.enter_context(mock.patch(f'{module}.init_firebase', lambda: None))
+        stack.enter_context(mock.patch('app.auth.Config.AUTH_SKIP', False))
+        stack.enter_context(mock.patch('app.gamestate.init_firebase', lambda: None))
+        stack.enter_context(mock.patch('app.gamestate.firebase_db', rtdb))
+        stack.enter_context(mock.patch('app.gamestate._store', store or FirebaseStore()))
+        yield rtdb
@@ -0,0 +1,114 @@
+"""Latency and throughput of the multiplayer routes on each GameStateStore backend.
+
+Plays --games complete games (accept invite, set reference, two submissions,
+finalize jobs) from --concurrency threads against the memory, sql and
+firebase backends. The firebase backend runs on FakeRTDB with
+--rtdb-latency-ms per round trip, standing in for a cross-region call.
+
+Usage (from api-rest/):
+  python -m benchmarks.gamestate_backends
+  python -m benchmarks.gamestate_backends --games 400 --concurrency 16 --rtdb-latency-ms 120
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from benchmarks.fakes import FakeRTDB, installed
+
+ROUTES = ('accept_invite', 'set_reference', 'submit', 'jobs')
+
+
+def play(client, store, n, timings):
+    from app import jobs
+    auth = lambda uid: {'Authorization': f'Bearer {uid}'}
+    a, b = f'a{n}', f'b{n}'
+    store.set(f'invites/{b}/inv{n}', {'fromUid': a, 'status': 'pending'})
+
+    def timed(route, fn):
+        started = time.perf_counter()
+        result = fn()
+        timings[route].append((time.perf_counter() - started) * 1000)
+        return result
+
+    game_id = timed('accept_invite', lambda: client.post(
+        '/multiplayer/invite/accept', json={'invite_id': f'inv{n}'}, headers=auth(b)).get_json()['gameId'])
+    timed('set_reference', lambda: client.post(
+        f'/multiplayer/game/{game_id}/set_reference', json={'imageUrl': 'https://example.com/a.jpg'}, headers=auth(a)))
+    timed('submit', lambda: client.post(f'/multiplayer/game/{game_id}/submit', json={'score': 70}, headers=auth(a)))
+    timed('submit', lambda: client.post(f'/multiplayer/game/{game_id}/submit', json={'score': 55}, headers=auth(b)))
+    # drains whichever due jobs exist, including other threads' games
+    timed('jobs', jobs.drain)
+    return game_id, a
+
+
+def run(app, store, rtdb, games, concurrency):
+    from app import jobs
+    timings = defaultdict(list)
+    played = []
+    counter = iter(range(games))
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            with app.app_context():
+                played.append(play(client, store, n, timings))
+
+    with installed(rtdb, store=store):
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        with app.app_context():
+            jobs.drain()
+            for game_id, winner in played:
+                assert store.get(f'games/{game_id}/results/winner') == winner, game_id
+    return timings, games / elapsed
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--games', type=int, default=200)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--rtdb-latency-ms', type=float, default=60)
+    args = p.parse_args()
+
+    from app import create_app
+    from app import gamestate
+    from flask_migrate import upgrade
+
+    app = create_app()
+    with app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations'))
+        backends = [
+            ('memory', gamestate.MemoryStore(), None),
+            ('sql', gamestate.SqlStore(), None),
+            (f'firebase ({args.rtdb_latency_ms:g} ms RTT)', gamestate.FirebaseStore(), FakeRTDB(args.rtdb_latency_ms / 1000)),
+        ]
+    header = f"{'backend':<24} {'games/s':>8}" + ''.join(f' {r + " p50":>18} {"p95":>7}' for r in ROUTES)
+    print(header)
+    for label, store, rtdb in backends:
+        timings, throughput = run(app, store, rtdb, args.games, args.concurrency)
+        cells = ''.join(f' {percentile(timings[r], 50):>18.1f} {percentile(timings[r], 95):>7.1f}' for r in ROUTES)
+        print(f'{label:<24} {throughput:>8.1f}{cells}')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        main()
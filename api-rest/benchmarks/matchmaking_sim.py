@@ -0,0 +1,112 @@
+"""Matchmaking throughput and match quality on simulated arrivals.
+
+Engine: --players tickets arrive at --rate per second of simulated time.
+Skills come from a clipped normal distribution, like the recent averages in
+player_stats. They are offered to one Matchmaker, which is swept every
+--sweep-ms of simulated time. Reports wall-clock enqueues per second, plus
+wait time and skill gap percentiles in simulated time.
+
+API: --api-players POST /multiplayer/queue requests go through the Flask test
+client on SQLite, with MatchmakingService steps in between. This measures
+ticket writes, matching, claims and create_match jobs together, on one
+thread.
+
+Usage (from api-rest/):
+  python -m benchmarks.matchmaking_sim
+  python -m benchmarks.matchmaking_sim --players 500000 --rate 5000 --api-players 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def simulate(players, rate, sweep_ms, seed=0):
+    from app.matchmaking import Matchmaker, Ticket
+    rng = np.random.default_rng(seed)
+    skills = np.clip(rng.normal(55, 18, players), 0, 100)
+    arrivals = np.cumsum(rng.exponential(1 / rate, players))
+    mm = Matchmaker()
+    waits, gaps, peak = [], [], 0
+    next_sweep = sweep_ms / 1000
+
+    def record(a, b, now):
+        for t in (a, b):
+            waits.append(now - t.enqueued_at)
+        gaps.append(abs(a.skill - b.skill))
+
+    started = time.perf_counter()
+    for i in range(players):
+        now = arrivals[i]
+        while next_sweep <= now:
+            matches, _ = mm.sweep(next_sweep)
+            for a, b in matches:
+                record(a, b, next_sweep)
+            next_sweep += sweep_ms / 1000
+        match = mm.offer(Ticket(f'p{i}', float(skills[i]), now), now)
+        if match:
+            record(*match, now)
+        peak = max(peak, len(mm))
+    elapsed = time.perf_counter() - started
+    return elapsed, np.array(waits), np.array(gaps), peak, len(mm)
+
+
+def through_api(players, seed=0):
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/matchmaking.db'
+    from flask_migrate import upgrade
+    from app import create_app, gamestate, jobs, matchmaking, stats, db
+    from app.models import MatchTicket
+    from benchmarks.fakes import installed
+
+    app = create_app()
+    rng = np.random.default_rng(seed)
+    with app.app_context():
+        upgrade(directory='migrations')
+        for i in range(players):
+            stats.record_game(stats.get_or_create_profile(f'p{i}'), float(np.clip(rng.normal(55, 18), 0, 100)))
+        db.session.commit()
+    service = matchmaking.MatchmakingService()
+    matchmaking.service = service
+    with installed(store=gamestate.MemoryStore()), app.app_context():
+        client = app.test_client()
+        started = time.perf_counter()
+        for i in range(players):
+            client.post('/multiplayer/queue', headers={'Authorization': f'Bearer p{i}'})
+            if i % 50 == 49:
+                service.step()
+        service.step()
+        enqueue_s = time.perf_counter() - started
+        started = time.perf_counter()
+        jobs.drain()
+        jobs_s = time.perf_counter() - started
+        matched = MatchTicket.query.filter_by(status='matched').count()
+        games = len(gamestate.get_store().get('games') or {})
+    return enqueue_s, jobs_s, matched, games
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--players', type=int, default=200_000)
+    p.add_argument('--rate', type=float, default=2000, help='arrivals per simulated second')
+    p.add_argument('--sweep-ms', type=float, default=200)
+    p.add_argument('--api-players', type=int, default=1000, help='0 skips the API measurement')
+    args = p.parse_args()
+
+    elapsed, waits, gaps, peak, left = simulate(args.players, args.rate, args.sweep_ms)
+    print(f'engine: {args.players} tickets at {args.rate:.0f}/s simulated -> '
+          f'{args.players / elapsed:,.0f} enqueues/s wall clock on one thread')
+    print(f'  matched {len(waits)} players, {left} still waiting, at most {peak} waiting at once')
+    print(f'  wait  p50 {np.percentile(waits, 50) * 1000:.0f} ms  p95 {np.percentile(waits, 95) * 1000:.0f} ms  '
+          f'max {waits.max() * 1000:.0f} ms (simulated)')
+    print(f'  skill gap  p50 {np.percentile(gaps, 50):.2f}  p95 {np.percentile(gaps, 95):.2f}  max {gaps.max():.2f}')
+
+    if args.api_players:
+        enqueue_s, jobs_s, matched, games = through_api(args.api_players)
+        print(f'api (sqlite, one thread): {args.api_players / enqueue_s:,.0f} POST /multiplayer/queue per second, '
+              f'{matched} players matched into {games} games; create_match jobs {games / jobs_s:,.0f}/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Per-request cost of the /metrics instrumentation.
+
+Times what one instrumented request records (the request hooks, two
+Firebase calls and one SQL statement) directly, in process memory and in
+gunicorn's multiprocess mode (PROMETHEUS_MULTIPROC_DIR). As a sanity check
+it also times POST /multiplayer/invite/reject (two RTDB calls against
+FakeRTDB) through the Flask test client with metrics on and off; that
+number is the best of --rounds runs. Each mode runs in a fresh interpreter
+because both switches are read at import.
+
+Usage (from api-rest/):
+  python -m benchmarks.metrics_overhead
+  python -m benchmarks.metrics_overhead --requests 20000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def instrumentation(app, requests):
+    """Microseconds to record one request with two Firebase calls and one SQL statement."""
+    from app import metrics
+    with app.test_request_context('/multiplayer/invite/reject', method='POST'):
+        started = time.perf_counter()
+        for _ in range(requests):
+            metrics._before_request()
+            for op in ('rtdb_get', 'rtdb_update'):
+                with metrics.firebase_call(op):
+                    pass
+            conn = type('Conn', (), {'info': {}})()
+            metrics._before_execute(conn, None, None, None, None, False)
+            metrics._after_execute(conn, None, None, None, None, False)
+            metrics._record(200)
+            metrics._teardown_request(None)
+        return (time.perf_counter() - started) / requests * 1e6
+
+
+def child(requests, rounds):
+    from flask_migrate import upgrade
+    from app import create_app
+    from app.config import Config
+    from benchmarks.fakes import installed
+
+    app = create_app()
+    with app.app_context():
+        upgrade(directory='migrations')
+    client = app.test_client()
+    out = {'hooks': instrumentation(app, requests) if Config.METRICS_ENABLED else 0.0}
+    with installed() as rtdb:
+        rtdb.root = {'invites': {'bob': {'inv': {'fromUid': 'alice', 'status': 'pending'}}}}
+        auth = {'Authorization': 'Bearer bob'}
+        best = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(requests):
+                client.post('/multiplayer/invite/reject', json={'invite_id': 'inv'}, headers=auth)
+            elapsed = (time.perf_counter() - started) / requests * 1e6
+            best = elapsed if best is None else min(best, elapsed)
+        out['route'] = best
+    print(json.dumps(out))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--requests', type=int, default=2000)
+    p.add_argument('--rounds', type=int, default=5)
+    p.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        return child(args.requests, args.rounds)
+
+    tmp = tempfile.mkdtemp()
+    modes = {
+        'metrics off': {'METRICS_ENABLED': '0'},
+        'in-process registry': {'METRICS_ENABLED': '1'},
+        'multiprocess files': {'METRICS_ENABLED': '1', 'PROMETHEUS_MULTIPROC_DIR': os.path.join(tmp, 'prom')},
+    }
+    os.makedirs(os.path.join(tmp, 'prom'))
+    results = {}
+    for label, extra in modes.items():
+        env = {k: v for k, v in os.environ.items() if k != 'PROMETHEUS_MULTIPROC_DIR'}
+        env.update(extra, DATABASE_URL=f'sqlite:///{tmp}/{len(results)}.db')
+        run = subprocess.run([sys.executable, '-m', 'benchmarks.metrics_overhead', '--child', '--requests', str(args.requests),
+                              '--rounds', str(args.rounds)],
+                             env=env, capture_output=True, text=True, check=True)
+        results[label] = json.loads(run.stdout.strip().splitlines()[-1])
+
+    base = results['metrics off']['route']
+    print(f"{'mode':<22} {'recording, us':>14} {'reject_invite, us':>18}")
+    for label, r in results.items():
+        print(f"{label:<22} {r['hooks']:>14.1f} {r['route']:>11.0f} ({r['route'] - base:+4.0f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Count Realtime Database round trips per multiplayer route against FakeRTDB.
+
+The second table plays whole rooms of --room-sizes players: round trips per
+submit request, per submission's finalize job, and for the job that writes
+the results. Only the last should grow with the room.
+
+Usage (from api-rest/):
+  python -m benchmarks.rtdb_round_trips
+  python -m benchmarks.rtdb_round_trips --room-sizes 2,16,64
+"""
+import argparse
+import os
+import tempfile
+
+from benchmarks.fakes import installed
+
+
+def play_room(client, rtdb, app, size):
+    """(submit request, per-submission job, finishing job) round trips for one room of `size`."""
+    from app import jobs
+
+    def post(uid, url, body=None):
+        resp = client.post(url, json=body or {}, headers={'Authorization': f'Bearer {uid}'})
+        assert resp.status_code < 300, resp.get_json()
+        return resp.get_json()
+
+    players = [f'p{i}' for i in range(size)]
+    game_id = post(players[0], '/multiplayer/room', {'maxPlayers': size})['gameId']
+    for uid in players[1:]:
+        post(uid, f'/multiplayer/game/{game_id}/join')
+    post(players[0], f'/multiplayer/game/{game_id}/set_reference', {'imageUrl': 'https://example.com/a.jpg'})
+    with app.app_context():
+        jobs.drain()
+    request_trips, job_trips = [], []
+    for i, uid in enumerate(players):
+        rtdb.reset_counter()
+        post(uid, f'/multiplayer/game/{game_id}/submit', {'score': (i * 37) % 100})
+        request_trips.append(rtdb.round_trips)
+        rtdb.reset_counter()
+        with app.app_context():
+            jobs.drain()
+        job_trips.append(rtdb.round_trips)
+    results = rtdb.reference(f'games/{game_id}/results').get()
+    assert len(results['ranking']) == size and rtdb.reference(f'games/{game_id}/state').get() == 'results'
+    return max(request_trips), max(job_trips[:-1]), job_trips[-1]
+
+
+def run(room_sizes):
+    from app import create_app, db, jobs
+    from flask_migrate import upgrade
+
+    app = create_app()
+    counts = []
+    with app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations'))
+    client = app.test_client()
+    with installed() as rtdb:
+        def call(label, uid, url, body):
+            rtdb.reset_counter()
+            resp = client.post(url, json=body, headers={'Authorization': f'Bearer {uid}'})
+            counts.append((label, resp.status_code, rtdb.round_trips))
+            return resp.get_json()
+
+        rtdb.reference('invites/bob/inv1').set({'fromUid': 'alice', 'status': 'pending'})
+        game_id = call('accept_invite (new game)', 'bob', '/multiplayer/invite/accept', {'invite_id': 'inv1'})['gameId']
+        rtdb.reference('games/g2').set({'playerA': 'alice', 'status': 'waiting_for_invite'})
+        rtdb.reference('invites/bob/inv2').set({'fromUid': 'alice', 'status': 'pending', 'gameId': 'g2'})
+        call('accept_invite (existing game)', 'bob', '/multiplayer/invite/accept', {'invite_id': 'inv2'})
+        rtdb.reference('invites/bob/inv3').set({'fromUid': 'alice', 'status': 'pending'})
+        call('reject_invite', 'bob', '/multiplayer/invite/reject', {'invite_id': 'inv3'})
+        call('set_reference', 'alice', f'/multiplayer/game/{game_id}/set_reference', {'imageUrl': 'https://example.com/a.jpg'})
+        call('submit (first player)', 'alice', f'/multiplayer/game/{game_id}/submit', {'score': 70})
+        call('submit (second player)', 'bob', f'/multiplayer/game/{game_id}/submit', {'score': 55})
+        # results are written by the job workers, off the request path
+        rtdb.reset_counter()
+        with app.app_context():
+            jobs.drain()
+        counts.append(('finalize jobs (background)', '-', rtdb.round_trips))
+        assert rtdb.reference(f'games/{game_id}/results/winner').get() == 'alice'
+
+        rooms = [(size, *play_room(client, rtdb, app, size)) for size in room_sizes]
+
+    width = max(len(c[0]) for c in counts)
+    print(f"{'route'.ljust(width)}  status  rtdb round trips")
+    for label, status, trips in counts:
+        print(f'{label.ljust(width)}  {status:>6}  {trips:>16}')
+    print()
+    print(f"{'room size':>9}  {'submit request':>14}  {'submission job':>14}  {'finishing job':>13}")
+    for size, request_trips, job_trips, finish_trips in rooms:
+        print(f'{size:>9}  {request_trips:>14}  {job_trips:>14}  {finish_trips:>13}')
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--room-sizes', default='2,8,32')
+    args = p.parse_args()
+    sizes = [int(n) for n in args.room_sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        os.environ.setdefault('ROOM_MAX_PLAYERS', str(max(sizes)))
+        run(sizes)
@@ -0,0 +1,89 @@
+"""Throughput and latency of the scoring embedder, unbatched vs micro-batched.
+
+Usage (from api-rest/):
+  python -m benchmarks.scoring_throughput --model ../android/app/src/main/assets/mobilenet_v3_small.tflite
+  python -m benchmarks.scoring_throughput --model ... --clients 32 --requests 20 --max-batch 32
+"""
+import argparse
+import io
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from app import scoring
+
+
+def synthetic_images(count, seed=0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, size=(256, 256, 3), dtype=np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, format='PNG')
+        images.append(buf.getvalue())
+    return images
+
+
+def run(model, max_batch, max_wait_ms, clients, requests_per_client, images):
+    embedder = scoring.BatchingEmbedder(model, max_batch=max_batch, max_wait_ms=max_wait_ms)
+    pixels = [scoring.preprocess(img) for img in images]
+    # allocate the full-batch interpreter outside the measurement
+    for f in [embedder.submit(pixels[i % len(pixels)]) for i in range(max_batch)]:
+        f.result()
+    embedder.batches = embedder.images = 0
+    latencies = []
+    lock = threading.Lock()
+
+    def client(n):
+        mine = []
+        for i in range(requests_per_client):
+            started = time.perf_counter()
+            # a submission embeds the drawing and the reference together
+            futures = [embedder.submit(pixels[(n + i) % len(pixels)]), embedder.submit(pixels[(n + i + 1) % len(pixels)])]
+            drawing, reference = (f.result() for f in futures)
+            scoring.score_embeddings(drawing, reference)
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    ms = np.array(latencies) * 1000
+    return {
+        'submissions/s': len(latencies) / elapsed,
+        'p50 ms': np.percentile(ms, 50),
+        'p95 ms': np.percentile(ms, 95),
+        'avg batch': embedder.images / max(embedder.batches, 1),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--model', required=True, help='path to mobilenet_v3_small.tflite')
+    p.add_argument('--clients', type=int, default=16, help='concurrent submitting threads')
+    p.add_argument('--requests', type=int, default=10, help='submissions per client')
+    p.add_argument('--max-batch', type=int, default=16)
+    p.add_argument('--max-wait-ms', type=float, default=5)
+    args = p.parse_args()
+
+    images = synthetic_images(8)
+    rows = [
+        ('unbatched (max_batch=1)', run(args.model, 1, 0, args.clients, args.requests, images)),
+        (f'batched (max_batch={args.max_batch})', run(args.model, args.max_batch, args.max_wait_ms, args.clients, args.requests, images)),
+    ]
+    width = max(len(label) for label, _ in rows)
+    columns = list(rows[0][1])
+    print(' '.join([''.ljust(width)] + [c.rjust(14) for c in columns]))
+    for label, result in rows:
+        print(' '.join([label.ljust(width)] + [f'{result[c]:14.1f}' for c in columns]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Concurrent in-flight requests per container: gthread vs gevent gunicorn workers.
+
+Starts gunicorn the way entrypoint.sh does (GUNICORN_WORKERS workers, by
+default 2) with benchmarks/fake_wsgi.py, where every Realtime Database round
+trip takes --rtdb-latency-ms. Then --concurrency keep-alive clients call
+POST /multiplayer/invite/reject in a closed loop for --seconds. That route
+reads the invite and updates it, so it is two round trips of pure waiting.
+Each worker class is measured at every concurrency level. The table reports
+throughput, latency percentiles and how many requests were waiting on the
+RTDB at once on average: throughput x the route's two round trips, by
+Little's law. Requests queued behind busy gthread threads don't count.
+
+Usage (from api-rest/):
+  python -m benchmarks.serving_modes
+  python -m benchmarks.serving_modes --concurrency 8,100,1000 --rtdb-latency-ms 120
+"""
+import argparse
+import json
+import os
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.sse_subscribers import free_port, wait_until_up
+
+
+class ClosedLoop:
+    """`concurrency` keep-alive connections, each sending its next request as soon as a response arrives."""
+
+    def __init__(self, port, concurrency):
+        self.port = port
+        self.sel = selectors.DefaultSelector()
+        self.latencies = []
+        self.errors = 0
+        for n in range(concurrency):
+            self._connect(n)
+
+    def _connect(self, n):
+        s = socket.socket()
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setblocking(False)
+        s.connect_ex(('127.0.0.1', self.port))
+        body = json.dumps({'invite_id': 'inv'}).encode()
+        request = (f'POST /multiplayer/invite/reject HTTP/1.1\r\nHost: bench\r\nAuthorization: Bearer u{n}\r\n'
+                   f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body
+        self.sel.register(s, selectors.EVENT_WRITE, {'n': n, 'request': request, 'out': request, 'buf': b'',
+                                                     'sent_at': time.perf_counter()})
+
+    def run(self, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for key, mask in self.sel.select(0.1):
+                s, c = key.fileobj, key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        c['out'] = c['out'][s.send(c['out']):]
+                        if not c['out']:
+                            self.sel.modify(s, selectors.EVENT_READ, c)
+                        continue
+                    data = s.recv(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    self._reconnect(s, c)
+                    continue
+                c['buf'] += data
+                head, sep, body = c['buf'].partition(b'\r\n\r\n')
+                if not sep:
+                    continue
+                length = next((int(line.split(b':', 1)[1]) for line in head.split(b'\r\n')
+                               if line.lower().startswith(b'content-length:')), 0)
+                if len(body) < length:
+                    continue
+                if head.startswith(b'HTTP/1.1 200'):
+                    self.latencies.append(time.perf_counter() - c['sent_at'])
+                else:
+                    self.errors += 1
+                c.update(buf=body[length:], out=c['request'], sent_at=time.perf_counter())
+                self.sel.modify(s, selectors.EVENT_WRITE, c)
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+
+    def _reconnect(self, s, c):
+        self.errors += 1
+        self.sel.unregister(s)
+        s.close()
+        self._connect(c['n'])
+
+
+def measure(worker_class, args, concurrency):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_WORKERS=str(args.workers),
+               GUNICORN_THREADS=str(args.threads), FAKE_RTDB_LATENCY_MS=str(args.rtdb_latency_ms),
+               FAKE_INVITES=str(concurrency), JOB_WORKER_THREADS='0')
+    log = open(os.path.join(args.tmp, f'gunicorn-{worker_class}-{concurrency}.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}',
+                             '--access-logfile', '/dev/null', '--backlog', '4096', 'benchmarks.fake_wsgi:application'],
+                            env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        wait_until_up(port, proc)
+        ClosedLoop(port, concurrency).run(1)  # warm up connections and pools
+        load = ClosedLoop(port, concurrency)
+        load.run(args.seconds)
+    finally:
+        # kill the whole group: a gthread worker would otherwise wait out its queued requests
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        log.close()
+    ms = np.array(load.latencies) * 1000 if load.latencies else np.zeros(1)
+    rate = len(load.latencies) / args.seconds
+    return rate, ms, rate * 2 * args.rtdb_latency_ms / 1000, load.errors
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--concurrency', default='8,64,512,2000', help='comma-separated client connection counts')
+    p.add_argument('--seconds', type=float, default=10)
+    p.add_argument('--workers', type=int, default=2)
+    p.add_argument('--threads', type=int, default=4, help='GUNICORN_THREADS for gthread')
+    p.add_argument('--rtdb-latency-ms', type=float, default=60)
+    p.add_argument('--modes', default='gthread,gevent')
+    args = p.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    args.tmp = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f'sqlite:///{args.tmp}/serving.db'
+
+    print(f'{args.workers} workers; reject invite = 2 RTDB round trips of {args.rtdb_latency_ms:.0f} ms')
+    print(f"{'mode':<22} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'in RTDB':>8} {'errors':>7}")
+    for mode in args.modes.split(','):
+        label = f'gthread ({args.workers}x{args.threads})' if mode == 'gthread' else f'{mode} ({args.workers} workers)'
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            rate, ms, in_flight, errors = measure(mode, args, concurrency)
+            print(f'{label:<22} {concurrency:>8} {rate:>8.0f} {np.percentile(ms, 50):>8.0f} {np.percentile(ms, 95):>8.0f} '
+                  f'{np.percentile(ms, 99):>8.0f} {in_flight:>8.0f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Idle game-event subscribers held by one gunicorn worker, and result fan-out latency.
+
+Starts gunicorn with a single worker (gevent by default) on the sql game
+state backend, opens --subscribers event streams spread over --games games
+from one selector-driven client thread, and reports the worker's memory and
+thread count with all of them idle. It then writes every game's results
+from this process and times how long each subscriber waits for its
+`results` event; the worker sees the writes through its watch poller, so
+the latency includes up to GAME_STATE_POLL_SECONDS.
+
+Usage (from api-rest/):
+  python -m benchmarks.sse_subscribers
+  python -m benchmarks.sse_subscribers --subscribers 10000 --games 100
+  python -m benchmarks.sse_subscribers --worker-class gthread --subscribers 50
+"""
+import argparse
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def worker_stats(master_pid):
+    """(pid, RSS in MB, thread count) of the master's only worker."""
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        pid = int(f.read().split()[0])
+    fields = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()
+    return pid, int(fields['VmRSS'][0]) / 1024, int(fields['Threads'][0])
+
+
+def wait_until_up(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited; see its log')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as s:
+                s.sendall(b'GET /health HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n')
+                if s.recv(64).startswith(b'HTTP/1.1 200'):
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not come up')
+
+
+class Subscribers:
+    """Event-stream clients multiplexed on one selector; per-connection state is a byte buffer."""
+
+    def __init__(self, port, games):
+        self.port = port
+        self.games = games
+        self.sel = selectors.DefaultSelector()
+        self.conns = {}
+        self.ready = 0
+        self.received = {}  # connection -> time its results event arrived
+        self.refused = 0
+
+    def open(self, n, max_pending=256):
+        for i in range(n):
+            while len(self.conns) - self.ready - self.refused >= max_pending:
+                self.poll(0.05)
+            s = socket.socket()
+            s.setblocking(False)
+            s.connect_ex(('127.0.0.1', self.port))
+            game = self.games[i % len(self.games)]
+            request = f'GET /multiplayer/game/{game}/events HTTP/1.1\r\nHost: bench\r\n\r\n'.encode()
+            self.conns[s] = {'game': game, 'out': request, 'buf': b'', 'ready': False}
+            self.sel.register(s, selectors.EVENT_WRITE)
+        deadline = time.monotonic() + 60
+        while self.ready + self.refused < n and time.monotonic() < deadline:
+            self.poll(0.1)
+
+    def poll(self, timeout):
+        for key, mask in self.sel.select(timeout):
+            s, c = key.fileobj, self.conns[key.fileobj]
+            if mask & selectors.EVENT_WRITE:
+                try:
+                    sent = s.send(c['out'])
+                except OSError:
+                    self._drop(s, refused=True)
+                    continue
+                c['out'] = c['out'][sent:]
+                if not c['out']:
+                    self.sel.modify(s, selectors.EVENT_READ)
+                continue
+            try:
+                data = s.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self._drop(s, refused=not c['ready'])
+                continue
+            c['buf'] += data
+            if not c['ready']:
+                if b' 503 ' in c['buf'][:16]:
+                    self._drop(s, refused=True)
+                    continue
+                if b'event: state' in c['buf']:
+                    c['ready'] = True
+                    self.ready += 1
+            if b'event: results' in c['buf'] and s not in self.received:
+                self.received[s] = time.perf_counter()
+            # keep only a tail big enough to find the next marker
+            c['buf'] = c['buf'][-64:]
+
+    def _drop(self, s, refused):
+        self.sel.unregister(s)
+        s.close()
+        if refused:
+            self.refused += 1
+
+    def close(self):
+        for s in list(self.sel.get_map().values()):
+            s.fileobj.close()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--subscribers', type=int, default=5000)
+    p.add_argument('--games', type=int, default=50)
+    p.add_argument('--worker-class', default='gevent')
+    p.add_argument('--poll-seconds', default='0.5', help='GAME_STATE_POLL_SECONDS for the worker')
+    args = p.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.subscribers * 2 + 100 > hard:
+        sys.exit(f'open file limit {hard} is too low for {args.subscribers} subscribers on one host')
+
+    tmp = tempfile.mkdtemp()
+    database_url = f'sqlite:///{tmp}/sse.db'
+    os.environ['DATABASE_URL'] = database_url
+    from flask_migrate import upgrade
+    from app import create_app, gamestate
+    app = create_app()
+    store = gamestate.SqlStore()
+    games = [f'g{i}' for i in range(args.games)]
+    with app.app_context():
+        upgrade(directory='migrations')
+        for game in games:
+            # AUTH_SKIP signs every request in as dev-uid
+            store.set(f'games/{game}', {'playerA': 'dev-uid', 'playerB': 'b', 'state': 'started',
+                                        'submissions': {'dev-uid': {'score': 50}}})
+
+    port = free_port()
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=args.worker_class, GAME_STATE_BACKEND='sql', AUTH_SKIP='1',
+               JOB_WORKER_THREADS='0', GAME_STATE_POLL_SECONDS=args.poll_seconds, SSE_HEARTBEAT_SECONDS='15')
+    log = open(os.path.join(tmp, 'gunicorn.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}',
+                             '-w', '1', '--access-logfile', '/dev/null', 'wsgi:application'],
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+    clients = Subscribers(port, games)
+    try:
+        wait_until_up(port, proc)
+        _, rss_idle, threads_idle = worker_stats(proc.pid)
+
+        started = time.perf_counter()
+        clients.open(args.subscribers)
+        connect_s = time.perf_counter() - started
+        time.sleep(1)
+        _, rss_open, threads_open = worker_stats(proc.pid)
+
+        with app.app_context():
+            # every game finishes in one transaction so the clock measures fan-out, not this loop
+            updates = {}
+            for game in games:
+                updates.update({f'games/{game}/state': 'results', f'games/{game}/results': {'winner': 'dev-uid'}})
+            written = time.perf_counter()
+            store.update('/', updates)
+        deadline = time.monotonic() + 30
+        while len(clients.received) < clients.ready and time.monotonic() < deadline:
+            clients.poll(0.1)
+        latencies = np.array([(t - written) * 1000 for t in clients.received.values()]) if clients.received else np.zeros(1)
+    finally:
+        clients.close()
+        proc.terminate()
+        proc.wait(10)
+        log.close()
+
+    per_sub = (rss_open - rss_idle) * 1024 / max(clients.ready, 1)
+    print(f'worker class {args.worker_class}: {clients.ready} subscribers on {len(games)} games connected in '
+          f'{connect_s:.1f}s, {clients.refused} refused')
+    print(f'worker RSS {rss_idle:.0f} MB idle -> {rss_open:.0f} MB with streams open ({per_sub:.1f} KB/subscriber), '
+          f'threads {threads_idle} -> {threads_open}')
+    print(f'results delivered to {len(clients.received)}/{clients.ready}: p50 {np.percentile(latencies, 50):.0f} ms, '
+          f'p95 {np.percentile(latencies, 95):.0f} ms, first {latencies.min():.0f} ms, last {latencies.max():.0f} ms after the write')
+
+
+if __name__ == '__main__':
+    main()
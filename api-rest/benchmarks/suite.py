@@ -0,0 +1,321 @@
+"""Load test of the whole API against in-process Firebase fakes, with a baseline gate.
+
+Runs `create_app()` on a fresh SQLite database with FakeAuth and FakeRTDB
+(benchmarks/fakes.py) in place of Firebase, so it needs no credentials or
+network. --rtdb-latency-ms and --auth-latency-ms add a delay to every RTDB
+round trip and every Firebase Auth user lookup.
+
+Workloads follow real traffic:
+  profiles     POST /profiles, GET /profiles/me
+  games        three POST /games, GET /profiles/me/stats, GET /leaderboard
+  friends      request by email, list and accept it, list friends, friends leaderboard
+  multiplayer  accept an invite, set_reference, two submissions, then the finalize jobs
+
+Each workload first runs --warmup iterations on one thread, counting SQL
+statements, RTDB round trips and Firebase Auth calls per step, then
+--iterations iterations on --concurrency threads for throughput and
+p50/p95/p99 latency. Counts are those of the median request, so an
+occasional cache refill does not move them.
+
+--save-baseline writes the results to --baseline (benchmarks/baseline.json).
+A later run compares against it and exits 1 if any step makes more SQL
+statements, RTDB round trips or Auth calls, if a request's p50 grows by
+more than --tolerance (and --min-delta-ms), or if a workload's throughput
+drops by more than --tolerance. p95 and p99 are reported but not gated:
+under concurrency they mostly measure SQLite write-lock waits and vary too
+much between runs. Timings are only compared when the settings match;
+the committed baseline was taken on one developer machine, so save your own
+before relying on the timing gate.
+
+Usage (from api-rest/):
+  python -m benchmarks.suite
+  python -m benchmarks.suite --save-baseline
+  python -m benchmarks.suite --workloads multiplayer --rtdb-latency-ms 30 --concurrency 16
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from statistics import median
+
+import numpy as np
+
+WORKLOADS = ('profiles', 'games', 'friends', 'multiplayer')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+_sql = threading.local()
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    _sql.count = getattr(_sql, 'count', 0) + 1
+
+
+class Runner:
+    """Issues one workload's requests and records what each step cost."""
+
+    def __init__(self, app, rtdb, auth):
+        self.app = app
+        self.client = app.test_client()
+        self.rtdb = rtdb
+        self.auth = auth
+        self.counting = False
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counts = {}
+        self.requests = 0
+        self.games = []
+        self.background_steps = set()
+
+    def _measure(self, label, fn):
+        counting = self.counting
+        if counting:
+            sql, trips, calls = getattr(_sql, 'count', 0), self.rtdb.round_trips, self.auth.calls
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.requests += 1
+            if counting:
+                self.counts.setdefault(label, []).append(
+                    (getattr(_sql, 'count', 0) - sql, self.rtdb.round_trips - trips, self.auth.calls - calls))
+            else:
+                self.timings.setdefault(label, []).append(elapsed)
+        return result
+
+    def call(self, method, url, uid, body=None, label=None):
+        def send():
+            return self.client.open(url, method=method, json=body, headers={'Authorization': f'Bearer {uid}'})
+        resp = self._measure(label or f'{method} {url.split("?")[0]}', send)
+        if resp.status_code >= 300:
+            raise RuntimeError(f'{method} {url} as {uid}: {resp.status_code} {resp.get_data(as_text=True)}')
+        return resp.get_json()
+
+    def background(self, label, fn):
+        self.background_steps.add(label)
+
+        def run():
+            with self.app.app_context():
+                return fn()
+        return self._measure(label, run)
+
+
+def profiles(run, n, rng):
+    uid = f'profile-{n}'
+    run.call('POST', '/profiles', uid, {'display_name': f'Player {n}'})
+    run.call('GET', '/profiles/me', uid)
+
+
+def games(run, n, rng):
+    uid = f'games-{n}'
+    for i in range(3):
+        run.call('POST', '/games', uid, {'score': round(float(rng.uniform(0, 100)), 2), 'key': f'{uid}-{i}'})
+    run.call('GET', '/profiles/me/stats', uid)
+    run.call('GET', '/leaderboard', uid)
+
+
+def friends(run, n, rng):
+    a, b = f'friend-a{n}', f'friend-b{n}'
+    for uid in (a, b):
+        run.auth.add_user(uid, f'{uid}@example.com', uid.title())
+    # a few games each, so the friends leaderboard has something to rank
+    with run.app.app_context():
+        from app import db, stats
+        for uid in (a, b):
+            stats.record_game(stats.get_or_create_profile(uid), float(rng.uniform(0, 100)))
+        db.session.commit()
+    sent = run.call('POST', '/friends/request', a, {'to_email': f'{b}@example.com'})
+    run.call('GET', '/friends/requests', b)
+    run.call('POST', '/friends/accept', b, {'request_id': sent['id']})
+    run.call('GET', '/friends', a)
+    run.call('GET', '/leaderboard/friends', a)
+
+
+def multiplayer(run, n, rng):
+    from app import jobs
+    a, b = f'host-{n}', f'guest-{n}'
+    # clients write invites to the RTDB themselves; there is no route for it
+    run.rtdb.reference(f'invites/{b}/inv{n}').set({'fromUid': a, 'status': 'pending'})
+    game_id = run.call('POST', '/multiplayer/invite/accept', b, {'invite_id': f'inv{n}'})['gameId']
+    run.call('POST', f'/multiplayer/game/{game_id}/set_reference', a, {'imageUrl': 'https://example.com/ref.jpg'},
+             label='POST /multiplayer/game/<id>/set_reference')
+    for uid in (a, b):
+        run.call('POST', f'/multiplayer/game/{game_id}/submit', uid, {'score': round(float(rng.uniform(0, 100)), 2)},
+                 label='POST /multiplayer/game/<id>/submit')
+    # results are written by the job workers; draining here times them like a request
+    run.background('finalize jobs (background)', jobs.drain)
+    with run.lock:
+        run.games.append(game_id)
+
+
+def _run_phase(run, workload, iterations, concurrency, ids, seed):
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                n = next(ids)
+                if n >= iterations:
+                    return
+                workload(run, f'{seed}-{n}', np.random.default_rng((seed, n)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - started
+
+
+def run_workload(app, name, args):
+    from app import jobs
+    from benchmarks.fakes import FakeAuth, FakeRTDB, installed
+    rtdb = FakeRTDB(latency=args.rtdb_latency_ms / 1000)
+    auth = FakeAuth(latency=args.auth_latency_ms / 1000)
+    workload = globals()[name]
+    run = Runner(app, rtdb, auth)
+    with installed(rtdb=rtdb, auth=auth):
+        run.counting = True
+        _run_phase(run, workload, args.warmup, 1, itertools.count(), seed=0)
+        run.counting = False
+        run.requests = 0
+        elapsed = _run_phase(run, workload, args.iterations, args.concurrency, itertools.count(), seed=1)
+        requests = run.requests
+        if run.games:
+            with app.app_context():
+                jobs.drain()
+            unfinished = [g for g in run.games if rtdb.reference(f'games/{g}/state').get() != 'results']
+            if unfinished:
+                raise RuntimeError(f'{len(unfinished)} games never reached results, e.g. {unfinished[0]}')
+
+    steps = {}
+    for label, samples in run.timings.items():
+        ms = np.array(samples) * 1000
+        counts = run.counts.get(label, [(0, 0, 0)])
+        steps[label] = {
+            'p50_ms': round(float(np.percentile(ms, 50)), 2),
+            'p95_ms': round(float(np.percentile(ms, 95)), 2),
+            'p99_ms': round(float(np.percentile(ms, 99)), 2),
+            'sql': median(c[0] for c in counts),
+            'rtdb': median(c[1] for c in counts),
+            'auth': median(c[2] for c in counts),
+        }
+        if label in run.background_steps:
+            # a drain also runs other threads' jobs, so only its counts are comparable
+            steps[label]['background'] = True
+    return {
+        'iterations_per_s': round(args.iterations / elapsed, 1),
+        'requests_per_s': round(requests / elapsed, 1),
+        'steps': steps,
+    }
+
+
+def compare(baseline, results, settings, tolerance, min_delta_ms):
+    """Regressions of `results` against `baseline`, as readable lines."""
+    problems = []
+    timed = baseline.get('settings') == settings
+    for name, current in results.items():
+        before = baseline.get('workloads', {}).get(name)
+        if before is None:
+            continue
+        if timed and current['iterations_per_s'] < before['iterations_per_s'] / (1 + tolerance):
+            problems.append(f"{name}: throughput {current['iterations_per_s']}/s, baseline {before['iterations_per_s']}/s")
+        for label, step in current['steps'].items():
+            old = before['steps'].get(label)
+            if old is None:
+                continue
+            for key, what in (('sql', 'SQL statements'), ('rtdb', 'RTDB round trips'), ('auth', 'Firebase Auth calls')):
+                if step[key] > old[key]:
+                    problems.append(f'{name}: {label} makes {step[key]:g} {what} per request, baseline {old[key]:g}')
+            if timed and not step.get('background') and step['p50_ms'] > old['p50_ms'] * (1 + tolerance) and step['p50_ms'] - old['p50_ms'] > min_delta_ms:
+                problems.append(f"{name}: {label} p50 {step['p50_ms']} ms, baseline {old['p50_ms']} ms")
+    return problems, timed
+
+
+def report(results):
+    width = max(len(label) for r in results.values() for label in r['steps'])
+    for name, r in results.items():
+        print(f"{name}: {r['iterations_per_s']:,.1f} iterations/s, {r['requests_per_s']:,.1f} requests/s")
+        print(f"  {'step'.ljust(width)}  {'p50 ms':>7}  {'p95 ms':>7}  {'p99 ms':>7}  {'sql':>4}  {'rtdb':>4}  {'auth':>4}")
+        for label, s in r['steps'].items():
+            print(f"  {label.ljust(width)}  {s['p50_ms']:>7.2f}  {s['p95_ms']:>7.2f}  {s['p99_ms']:>7.2f}  "
+                  f"{s['sql']:>4g}  {s['rtdb']:>4g}  {s['auth']:>4g}")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--workloads', default=','.join(WORKLOADS))
+    p.add_argument('--iterations', type=int, default=200, help='timed iterations per workload')
+    p.add_argument('--warmup', type=int, default=20, help='single-threaded iterations that count SQL and Firebase calls')
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--rtdb-latency-ms', type=float, default=0.0)
+    p.add_argument('--auth-latency-ms', type=float, default=0.0)
+    p.add_argument('--baseline', default=DEFAULT_BASELINE)
+    p.add_argument('--save-baseline', action='store_true')
+    p.add_argument('--tolerance', type=float, default=0.5, help='allowed relative p50 growth and throughput drop')
+    p.add_argument('--min-delta-ms', type=float, default=2.0, help='p50 growth below this is noise')
+    args = p.parse_args()
+    names = [w for w in args.workloads.split(',') if w]
+    unknown = set(names) - set(WORKLOADS)
+    if unknown:
+        p.error(f'unknown workloads: {", ".join(sorted(unknown))}')
+
+    tmp = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f'sqlite:///{tmp}/suite.db'
+    # in-process metrics; the suite counts statements itself
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    from flask_migrate import upgrade
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations'))
+    event.listen(Engine, 'after_cursor_execute', _count_statement)
+
+    results = {name: run_workload(app, name, args) for name in names}
+    report(results)
+    settings = {'iterations': args.iterations, 'concurrency': args.concurrency,
+                'rtdb_latency_ms': args.rtdb_latency_ms, 'auth_latency_ms': args.auth_latency_ms}
+
+    if args.save_baseline:
+        baseline = {'settings': settings, 'workloads': results}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                old = json.load(f)
+            # saving a subset of the workloads keeps the others
+            if old.get('settings') == settings:
+                baseline['workloads'] = dict(old.get('workloads', {}), **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nbaseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'\nno baseline at {args.baseline}; run with --save-baseline to create one')
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    problems, timed = compare(baseline, results, settings, args.tolerance, args.min_delta_ms)
+    if not timed:
+        print('\nsettings differ from the baseline; only SQL and Firebase call counts were compared')
+    if problems:
+        print('\nregressions against the baseline:')
+        for line in problems:
+            print(f'  {line}')
+        return 1
+    print('\nno regressions against the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Query latency and recall of the embedding index on synthetic vectors.
+
+Writes --count clustered 1024-d vectors into a scratch index, times
+brute-force search on a few queries, builds the IVF-PQ index and times it at
+several nprobe values, reporting latency percentiles and recall against the
+exact results. recall@1 is whether the redrawn vector itself comes back first;
+the rest of a synthetic cluster is nearly tied, so recall@10 is a lower
+bound. A million vectors need ~4 GB of scratch disk.
+
+Usage (from api-rest/):
+  python -m benchmarks.vector_search
+  python -m benchmarks.vector_search --count 200000 --queries 200
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from app.scoring import EMBEDDING_SIZE
+from app.vector_index import CHUNK_ROWS, VectorIndex
+
+
+def write_synthetic(directory, count, dim, clusters, seed=0):
+    """Clustered unit vectors written straight into the index files."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'vectors.f32'), 'wb') as vf, open(os.path.join(directory, 'keys.jsonl'), 'w') as kf:
+        for start in range(0, count, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, count - start)
+            chunk = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+            chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+            vf.write(chunk.tobytes())
+            kf.writelines(json.dumps({'key': f'v{start + i}'}) + '\n' for i in range(n))
+
+
+def timed(index, queries, **kwargs):
+    latencies, results = [], []
+    for q in queries:
+        started = time.perf_counter()
+        results.append([key for key, _, _ in index.search(q, k=10, **kwargs)])
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.array(latencies), results
+
+
+def recall(found, exact, k):
+    return np.mean([len(set(f[:k]) & set(e[:k])) / k for f, e in zip(found, exact)])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--count', type=int, default=1_000_000)
+    p.add_argument('--queries', type=int, default=100)
+    p.add_argument('--exact-queries', type=int, default=10, help='brute-force queries (slow at large counts)')
+    p.add_argument('--nlist', type=int, default=1024)
+    p.add_argument('--subquantizers', type=int, default=64)
+    p.add_argument('--nprobe', default='8,16,32', help='comma-separated nprobe values')
+    p.add_argument('--dir', help='scratch directory (default: a temporary one)')
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        started = time.perf_counter()
+        write_synthetic(tmp, args.count, EMBEDDING_SIZE, clusters=max(args.count // 250, 16))
+        index = VectorIndex(tmp)
+        print(f'{len(index)} vectors written in {time.perf_counter() - started:.1f}s')
+
+        # queries are slightly perturbed stored vectors, like a redrawn picture
+        rng = np.random.default_rng(1)
+        picks = rng.integers(0, args.count, args.queries)
+        noise = rng.standard_normal((args.queries, EMBEDDING_SIZE)).astype(np.float32) / np.sqrt(EMBEDDING_SIZE)
+        queries = np.asarray(index._vectors[np.sort(picks)]) + 0.3 * noise
+
+        exact_ms, exact = timed(index, queries[:args.exact_queries])
+        rows = [('brute force', exact_ms, 1.0, 1.0)]
+
+        started = time.perf_counter()
+        index.build_ivfpq(args.nlist, args.subquantizers)
+        print(f'IVF-PQ ({args.nlist} lists, {args.subquantizers} B/vector) built in {time.perf_counter() - started:.1f}s')
+        for nprobe in (int(v) for v in args.nprobe.split(',')):
+            ms, found = timed(index, queries, nprobe=nprobe)
+            rows.append((f'ivfpq nprobe={nprobe}', ms, recall(found, exact, 1), recall(found, exact, 10)))
+
+    print(f"{'mode':<18} {'queries':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'recall@1':>9} {'recall@10':>10}")
+    for label, ms, rec1, rec10 in rows:
+        print(f'{label:<18} {len(ms):>8} {np.percentile(ms, 50):>8.2f} {np.percentile(ms, 95):>8.2f} '
+              f'{np.percentile(ms, 99):>8.2f} {rec1:>9.3f} {rec10:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
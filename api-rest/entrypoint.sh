@@ -19,14 +19,10 @@ else
 fi
 
 echo "Starting gunicorn"
-# Use gthread worker for better handling of concurrent requests and streaming
-# Increase timeout so long responses aren't cut off; tune threads/workers as needed
-exec gunicorn --bind 0.0.0.0:5000 wsgi:application \
-    --workers 2 \
-    --worker-class gthread \
-    --threads 4 \
-    --timeout 120 \
-    --keep-alive 5 \
-    --access-logfile - \
-    --error-logfile - \
-    --log-level info
+# workers/threads are read from GUNICORN_WORKERS / GUNICORN_THREADS in gunicorn.conf.py;
+# each worker initializes Firebase in post_worker_init so the first requests don't pay for it
+export GUNICORN_WORKERS=${GUNICORN_WORKERS:-2}
+export GUNICORN_THREADS=${GUNICORN_THREADS:-4}
+# gthread (default) or gevent; gevent serves many more requests that are waiting on I/O per worker
+export GUNICORN_WORKER_CLASS=${GUNICORN_WORKER_CLASS:-gthread}
+exec gunicorn -c gunicorn.conf.py wsgi:application
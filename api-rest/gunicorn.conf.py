@@ -0,0 +1,52 @@
+# Gunicorn settings; entrypoint.sh runs `gunicorn -c gunicorn.conf.py wsgi:application`.
+# Worker and thread counts come from the environment so Config.FIREBASE_HTTP_POOL_SIZE
+# (which defaults to GUNICORN_THREADS) matches the number of threads per worker.
+import os
+import shutil
+import tempfile
+
+bind = '0.0.0.0:5000'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+# gthread worker for better handling of concurrent requests and streaming; gevent
+# (GUNICORN_WORKER_CLASS=gevent) when many clients hold game event streams open
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+# open connections per gevent worker (ignored by gthread)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '10000'))
+# generous timeout so long responses aren't cut off
+timeout = 120
+keepalive = 5
+accesslog = '-'
+errorlog = '-'
+loglevel = 'info'
+
+# workers write their metrics to files here so /metrics can sum them (app/metrics.py); it must be
+# set before a worker imports prometheus_client, and is emptied when the master starts
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'drawmaster-metrics'))
+
+
+def on_starting(server):
+    # counters left by a previous run would otherwise be added to this one's
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def post_worker_init(worker):
+    # the app's loggers ('app' is the Flask app's, 'app.auth' and friends its children) write
+    # through gunicorn's error log, with its format and level
+    import logging
+    app_log = logging.getLogger('app')
+    app_log.handlers = list(worker.log.error_log.handlers)
+    app_log.setLevel(worker.log.error_log.level)
+    app_log.propagate = False
+    # pay for credentials, the Firebase app and the first access token before taking requests;
+    # this runs after a gevent worker has monkey-patched, so the Firebase clients' sockets cooperate
+    from app.auth import warm_up
+    warm_up()
+
+
+def child_exit(server, worker):
+    # a dead worker's counters stay in the totals; only its live-gauge files are dropped
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,36 @@
+"""add archived games
+
+Revision ID: a3b4c5d6e7f8
+Revises: f2a3b4c5d6e7
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3b4c5d6e7f8'
+down_revision = 'f2a3b4c5d6e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archived_games',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('game_id', sa.String(length=64), nullable=False),
+        sa.Column('outcome', sa.String(length=16), nullable=False),
+        sa.Column('players', sa.Integer(), nullable=False),
+        sa.Column('winner_uid', sa.String(length=128), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.Column('data', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('game_id', name='uq_archived_games_game_id')
+    )
+
+
+def downgrade():
+    op.drop_table('archived_games')
@@ -0,0 +1,39 @@
+"""add player stats
+
+Revision ID: a7b8c9d0e1f2
+Revises: f6a7b8c9d0e1
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7b8c9d0e1f2'
+down_revision = 'f6a7b8c9d0e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('player_stats',
+        sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('best_score', sa.Float(), nullable=False),
+        sa.Column('total_score', sa.Float(), nullable=False),
+        sa.Column('games_count', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user_profiles.id'], ),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index('ix_player_stats_best', 'player_stats', ['best_score', 'user_id'])
+    # backfill from the games already recorded
+    op.execute(
+        'INSERT INTO player_stats (user_id, best_score, total_score, games_count, updated_at) '
+        'SELECT user_id, MAX(score), SUM(score), COUNT(*), MAX(created_at) FROM games GROUP BY user_id'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_player_stats_best', table_name='player_stats')
+    op.drop_table('player_stats')
@@ -0,0 +1,99 @@
+"""partition games by month and add daily roll-ups
+
+Revision ID: b4c5d6e7f8a9
+Revises: a3b4c5d6e7f8
+Create Date: 2026-10-17 23:00:00.000000
+
+"""
+import os
+from datetime import datetime, timedelta
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4c5d6e7f8a9'
+down_revision = 'a3b4c5d6e7f8'
+branch_labels = None
+depends_on = None
+
+# the same settings as Config.HISTORY_RAW_DAYS / HISTORY_PARTITIONS_AHEAD
+RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', '90'))
+PARTITIONS_AHEAD = int(os.getenv('HISTORY_PARTITIONS_AHEAD', '3'))
+
+
+def _add_months(month, n):
+    year, index = divmod(month // 100 * 12 + month % 100 - 1 + n, 12)
+    return year * 100 + index + 1
+
+
+def upgrade():
+    bind = op.get_bind()
+    mysql = bind.dialect.name == 'mysql'
+    now = datetime.utcnow()
+
+    op.create_table('game_daily_rollups',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('games_count', sa.Integer(), nullable=False),
+        sa.Column('total_score', sa.Float(), nullable=False),
+        sa.Column('best_score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user_profiles.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+
+    # backfill: every existing row gets its month, and rows past the raw window become roll-ups
+    op.add_column('games', sa.Column('month', sa.Integer(), nullable=True))
+    op.execute(sa.text('UPDATE games SET created_at = :now WHERE created_at IS NULL').bindparams(now=now))
+    if mysql:
+        op.execute('UPDATE games SET month = EXTRACT(YEAR_MONTH FROM created_at)')
+    else:
+        op.execute("UPDATE games SET month = CAST(strftime('%Y%m', created_at) AS INTEGER)")
+    cutoff = datetime(now.year, now.month, now.day) - timedelta(days=RAW_DAYS)
+    op.execute(sa.text(
+        'INSERT INTO game_daily_rollups (user_id, day, games_count, total_score, best_score) '
+        'SELECT user_id, DATE(created_at), COUNT(*), SUM(score), MAX(score) FROM games '
+        'WHERE created_at < :cutoff GROUP BY user_id, DATE(created_at)').bindparams(cutoff=cutoff))
+    op.execute(sa.text('DELETE FROM games WHERE created_at < :cutoff').bindparams(cutoff=cutoff))
+
+    if mysql:
+        # a partitioned table can have no foreign keys, and its partition key must be in the primary key
+        for fk in sa.inspect(bind).get_foreign_keys('games'):
+            op.drop_constraint(fk['name'], 'games', type_='foreignkey')
+        op.alter_column('games', 'month', existing_type=sa.Integer(), nullable=False)
+        op.execute('ALTER TABLE games DROP PRIMARY KEY, ADD PRIMARY KEY (id, month)')
+    else:
+        with op.batch_alter_table('games') as batch_op:
+            batch_op.alter_column('month', existing_type=sa.Integer(), nullable=False)
+    op.drop_index('ix_games_user_created', table_name='games')
+    op.create_index('ix_games_user_month', 'games', ['user_id', 'month', 'created_at'])
+    op.create_index('ix_games_month', 'games', ['month', 'created_at'])
+
+    if mysql:
+        # one partition per month from the oldest row kept to PARTITIONS_AHEAD months ahead;
+        # the first also takes anything older, pmax anything past the last
+        current = now.year * 100 + now.month
+        oldest = bind.execute(sa.text('SELECT MIN(month) FROM games')).scalar() or current
+        months = [min(oldest, current)]
+        while months[-1] < _add_months(current, PARTITIONS_AHEAD):
+            months.append(_add_months(months[-1], 1))
+        partitions = ', '.join(f'PARTITION p{m} VALUES LESS THAN ({_add_months(m, 1)})' for m in months)
+        op.execute(f'ALTER TABLE games PARTITION BY RANGE (month) ({partitions}, '
+                   'PARTITION pmax VALUES LESS THAN MAXVALUE)')
+
+
+def downgrade():
+    # rolled-up games stay rolled up: only their daily totals were kept
+    bind = op.get_bind()
+    mysql = bind.dialect.name == 'mysql'
+    if mysql:
+        op.execute('ALTER TABLE games REMOVE PARTITIONING')
+        op.execute('ALTER TABLE games DROP PRIMARY KEY, ADD PRIMARY KEY (id)')
+    op.create_index('ix_games_user_created', 'games', ['user_id', 'created_at'])
+    op.drop_index('ix_games_month', table_name='games')
+    op.drop_index('ix_games_user_month', table_name='games')
+    with op.batch_alter_table('games') as batch_op:
+        batch_op.drop_column('month')
+    if mysql:
+        op.create_foreign_key(None, 'games', 'user_profiles', ['user_id'], ['id'])
+    op.drop_table('game_daily_rollups')
@@ -0,0 +1,40 @@
+"""add score histogram and recent average
+
+Revision ID: b8c9d0e1f2a3
+Revises: a7b8c9d0e1f2
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+import math
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c9d0e1f2a3'
+down_revision = 'a7b8c9d0e1f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('player_stats') as batch_op:
+        batch_op.add_column(sa.Column('recent_avg', sa.Float(), nullable=True))
+    op.execute('UPDATE player_stats SET recent_avg = total_score / games_count WHERE games_count > 0')
+
+    histogram = op.create_table('score_histogram',
+        sa.Column('bucket', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('players', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('bucket')
+    )
+    counts = [0] * 101
+    bind = op.get_bind()
+    for best, players in bind.execute(sa.text('SELECT best_score, COUNT(*) FROM player_stats GROUP BY best_score')):
+        counts[min(100, max(0, int(math.floor(best))))] += players
+    op.bulk_insert(histogram, [{'bucket': b, 'players': n} for b, n in enumerate(counts)])
+
+
+def downgrade():
+    op.drop_table('score_histogram')
+    with op.batch_alter_table('player_stats') as batch_op:
+        batch_op.drop_column('recent_avg')
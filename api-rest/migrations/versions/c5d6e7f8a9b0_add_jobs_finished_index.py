@@ -0,0 +1,24 @@
+"""index finished jobs for the retention purge
+
+Revision ID: c5d6e7f8a9b0
+Revises: b4c5d6e7f8a9
+Create Date: 2026-10-17 23:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d6e7f8a9b0'
+down_revision = 'b4c5d6e7f8a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_jobs_status_finished_at', 'jobs', ['status', 'finished_at'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_status_finished_at', table_name='jobs')
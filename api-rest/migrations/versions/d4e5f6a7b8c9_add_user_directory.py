@@ -0,0 +1,34 @@
+"""add user directory
+
+Revision ID: d4e5f6a7b8c9
+Revises: c3d9a1b2e4f6
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e5f6a7b8c9'
+down_revision = 'c3d9a1b2e4f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_directory',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('uid', sa.String(length=128), nullable=False),
+        sa.Column('email', sa.String(length=320), nullable=True),
+        sa.Column('display_name', sa.String(length=128), nullable=True),
+        sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('uid')
+    )
+    op.create_index('ix_user_directory_email', 'user_directory', ['email'])
+
+
+def downgrade():
+    op.drop_index('ix_user_directory_email', table_name='user_directory')
+    op.drop_table('user_directory')
@@ -0,0 +1,41 @@
+"""add indexes for friend, friend request and game queries
+
+Revision ID: e5f6a7b8c9d0
+Revises: d4e5f6a7b8c9
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f6a7b8c9d0'
+down_revision = 'd4e5f6a7b8c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicate friend rows (keeping the oldest) before enforcing uniqueness;
+    # the derived table keeps MySQL from rejecting a subquery on the table being deleted from
+    op.execute(
+        'DELETE FROM friends WHERE id NOT IN '
+        '(SELECT id FROM (SELECT MIN(id) AS id FROM friends GROUP BY user_id, friend_uid) AS keep)'
+    )
+    op.create_index('uq_friends_user_friend', 'friends', ['user_id', 'friend_uid'], unique=True)
+    op.create_index('ix_friend_requests_to_status', 'friend_requests', ['to_uid', 'status'])
+    op.create_index('ix_friend_requests_from_to', 'friend_requests', ['from_uid', 'to_uid'])
+    op.create_index('ix_games_user_created', 'games', ['user_id', 'created_at'])
+
+
+def downgrade():
+    # on MySQL the composite indexes also back the user_id foreign keys, so recreate plain ones first
+    bind = op.get_bind()
+    if bind.dialect.name == 'mysql':
+        op.create_index('ix_friends_user_id', 'friends', ['user_id'])
+        op.create_index('ix_games_user_id', 'games', ['user_id'])
+    op.drop_index('ix_games_user_created', table_name='games')
+    op.drop_index('ix_friend_requests_from_to', table_name='friend_requests')
+    op.drop_index('ix_friend_requests_to_status', table_name='friend_requests')
+    op.drop_index('uq_friends_user_friend', table_name='friends')
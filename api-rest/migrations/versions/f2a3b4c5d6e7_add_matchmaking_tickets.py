@@ -0,0 +1,38 @@
+"""add matchmaking tickets
+
+Revision ID: f2a3b4c5d6e7
+Revises: e1f2a3b4c5d6
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a3b4c5d6e7'
+down_revision = 'e1f2a3b4c5d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('matchmaking_tickets',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('uid', sa.String(length=128), nullable=False),
+        sa.Column('skill', sa.Float(), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('game_id', sa.String(length=64), nullable=True),
+        sa.Column('opponent_uid', sa.String(length=128), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('matched_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('uid', name='uq_matchmaking_tickets_uid'),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_matchmaking_tickets_status_created_at', 'matchmaking_tickets', ['status', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_matchmaking_tickets_status_created_at', table_name='matchmaking_tickets')
+    op.drop_table('matchmaking_tickets')
@@ -0,0 +1,94 @@
+"""add friendships
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a7b8c9d0e1'
+down_revision = 'e5f6a7b8c9d0'
+branch_labels = None
+depends_on = None
+
+# ids below max(friend_requests.id) + LEGACY_ID_RESERVE stay free for requests old workers create
+# during the rollout, so `flask friendships backfill` can keep their ids without colliding
+LEGACY_ID_RESERVE = 1000000
+
+
+def upgrade():
+    op.create_table('friendships',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_low', sa.String(length=128), nullable=False),
+        sa.Column('user_high', sa.String(length=128), nullable=False),
+        sa.Column('status', sa.String(length=32), nullable=False),
+        sa.Column('requested_by', sa.String(length=128), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('responded_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_low', 'user_high', name='uq_friendships_pair'),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_friendships_low_status', 'friendships', ['user_low', 'status'])
+    op.create_index('ix_friendships_high_status', 'friendships', ['user_high', 'status'])
+
+    # Expand step: copy the legacy tables, which stay in place so workers still running
+    # the previous release keep working. Rows they write during the rollout are picked
+    # up afterwards with `flask friendships backfill`.
+    bind = op.get_bind()
+    friendships = sa.table('friendships',
+        sa.column('id', sa.Integer), sa.column('user_low', sa.String), sa.column('user_high', sa.String),
+        sa.column('status', sa.String), sa.column('requested_by', sa.String),
+        sa.column('created_at', sa.DateTime), sa.column('responded_at', sa.DateTime))
+    rows = {}
+    requests = bind.execute(sa.text(
+        "SELECT id, from_uid, to_uid, status, created_at, responded_at FROM friend_requests "
+        "WHERE status IN ('pending', 'accepted') ORDER BY id").columns(
+            created_at=sa.DateTime, responded_at=sa.DateTime))
+    for r in requests:
+        if r.from_uid == r.to_uid:
+            continue
+        key = tuple(sorted((r.from_uid, r.to_uid)))
+        current = rows.get(key)
+        if current is None or (current['status'] == 'pending' and r.status == 'accepted'):
+            # keep the request id so clients holding a pending request id can still answer it
+            rows[key] = {'id': r.id, 'user_low': key[0], 'user_high': key[1], 'status': r.status,
+                         'requested_by': r.from_uid, 'created_at': r.created_at, 'responded_at': r.responded_at}
+    legacy = bind.execute(sa.text(
+        "SELECT user_profiles.uid AS owner_uid, friends.friend_uid AS friend_uid "
+        "FROM friends JOIN user_profiles ON user_profiles.id = friends.user_id"))
+    extra = []
+    for r in legacy:
+        if r.owner_uid == r.friend_uid:
+            continue
+        key = tuple(sorted((r.owner_uid, r.friend_uid)))
+        if key in rows:
+            rows[key]['status'] = 'accepted'
+        else:
+            rows[key] = {'user_low': key[0], 'user_high': key[1], 'status': 'accepted',
+                         'requested_by': r.owner_uid, 'created_at': datetime.utcnow(), 'responded_at': None}
+            extra.append(key)
+    with_ids = [v for k, v in rows.items() if 'id' in v]
+    if with_ids:
+        op.bulk_insert(friendships, with_ids)
+    if extra:
+        op.bulk_insert(friendships, [rows[k] for k in extra])
+
+    legacy_max = bind.execute(sa.text('SELECT MAX(id) FROM friend_requests')).scalar() or 0
+    start = max(legacy_max, bind.execute(sa.text('SELECT MAX(id) FROM friendships')).scalar() or 0) + LEGACY_ID_RESERVE
+    if bind.dialect.name == 'mysql':
+        op.execute(f'ALTER TABLE friendships AUTO_INCREMENT = {start}')
+    else:
+        op.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'friendships'"))
+        op.execute(sa.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('friendships', :seq)").bindparams(seq=start - 1))
+
+
+def downgrade():
+    op.drop_index('ix_friendships_high_status', table_name='friendships')
+    op.drop_index('ix_friendships_low_status', table_name='friendships')
+    op.drop_table('friendships')
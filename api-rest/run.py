@@ -1,7 +1,9 @@
-from app import create_app
+from app import create_app, start_background
 
 app = create_app()
 
 if __name__ == '__main__':
+    # the development server runs jobs in-process too; `flask` commands import this module without them
+    start_background(app)
     # Bind to 0.0.0.0 so the Flask app is reachable from outside the container
     app.run(host='0.0.0.0', port=5000)
@@ -1,3 +1,5 @@
-from app import create_app
+from app import create_app, start_background
 
 application = create_app()
+# job workers and maintenance run in every process that serves requests (gunicorn workers, WSGI hosts)
+start_background(application)